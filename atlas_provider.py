@@ -0,0 +1,165 @@
+"""
+Process wide provider of ibllib AllenAtlas instances shared by all apps of the repository.
+
+Reading an AllenAtlas from the nrrd/npz files decompresses the full image and label volumes
+every time. The first time an atlas is requested it is built as usual and its volumes are
+written once as uncompressed .npy files, afterwards they are memory mapped read only so that
+several apps (and several atlases in one app) share the same pages through the OS page cache.
+
+    from atlas_provider import get_atlas
+    brain_atlas = get_atlas(25)
+    hist_atlas = get_atlas(25, hist_path=hist_path_rd)
+
+Atlases returned are shared, they must not be modified.
+"""
+from pathlib import Path
+import copy
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+import ibllib
+from ibllib.atlas import AllenAtlas
+
+# Arrays larger than this are stored as separate .npy files and memory mapped
+MMAP_MIN_BYTES = 2 ** 20
+
+_atlases = {}
+_volumes = {}
+_lock = threading.RLock()
+
+
+def get_cache_dir():
+    """
+    Folder containing the memory mappable atlases, in the ONE cache directory
+    :return: cache folder
+    :type: Path
+    """
+    try:
+        from ibllib.io import params
+        cache_dir = Path(params.read('one_params').CACHE_DIR)
+    except Exception:
+        cache_dir = Path(Path.home(), 'Downloads', 'FlatIron')
+    return cache_dir.joinpath('histology', 'ATLAS', 'mmap')
+
+
+def _file_key(*args):
+    key = json.dumps([getattr(ibllib, '__version__', ''), *args], default=str, sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def get_atlas(res_um=25, hist_path=None, **kwargs):
+    """
+    Shared read only AllenAtlas
+    :param res_um: resolution of atlas
+    :type res_um: int
+    :param hist_path: path to histology volume to use as image volume instead of the Allen
+    average template
+    :type hist_path: Path
+    :param kwargs: other arguments passed to AllenAtlas, e.g brainmap
+    :return: atlas
+    :type: ibllib.atlas.AllenAtlas
+    """
+    if hist_path:
+        # Histology atlases only differ by their image, share everything else with the atlas
+        hist_path = Path(hist_path)
+        key = (res_um, str(hist_path), json.dumps(kwargs, sort_keys=True, default=str))
+        with _lock:
+            if key not in _atlases:
+                hist_atlas = copy.copy(get_atlas(res_um, **kwargs))
+                hist_atlas.image = get_volume(hist_path)
+                _atlases[key] = hist_atlas
+            return _atlases[key]
+
+    key = (res_um, None, json.dumps(kwargs, sort_keys=True, default=str))
+    with _lock:
+        if key not in _atlases:
+            _atlases[key] = _load_atlas(res_um, **kwargs)
+        return _atlases[key]
+
+
+def get_volume(file_volume):
+    """
+    Memory mapped volume read from a nrrd or npz file with AllenAtlas conventions, the volume
+    is converted to an uncompressed .npy file the first time it is read
+    :param file_volume: path to volume
+    :type file_volume: Path
+    :return: volume
+    :type: np.memmap
+    """
+    file_volume = Path(file_volume)
+    stat = os.stat(file_volume)
+    npy_file = get_cache_dir().joinpath(
+        'volume_' + _file_key(str(file_volume), stat.st_size, stat.st_mtime_ns) + '.npy')
+    with _lock:
+        if npy_file not in _volumes:
+            if not npy_file.exists():
+                read_volume = getattr(AllenAtlas, '_read_volume', None)
+                if read_volume is not None:
+                    volume = read_volume(file_volume)
+                else:
+                    volume = AllenAtlas(hist_path=file_volume).image
+                _save_array(npy_file, volume)
+            _volumes[npy_file] = np.load(npy_file, mmap_mode='r')
+        return _volumes[npy_file]
+
+
+def _save_array(file, array):
+    file.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=file.parent, suffix='.npy.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_file, file)
+
+
+def _load_atlas(res_um, **kwargs):
+    """
+    Load atlas from the memory mappable cache, creating the cache if needed. If the cache can
+    not be used the atlas is built as usual
+    """
+    atlas_dir = get_cache_dir().joinpath('atlas_' + _file_key(res_um, kwargs))
+    if not atlas_dir.joinpath('atlas.pkl').exists():
+        brain_atlas = AllenAtlas(res_um, **kwargs)
+        try:
+            _save_atlas(brain_atlas, atlas_dir)
+        except Exception as err:
+            print(f'Could not cache atlas for memory mapping: {err}')
+            return brain_atlas
+
+    try:
+        with open(atlas_dir.joinpath('atlas.pkl'), 'rb') as f:
+            brain_atlas = pickle.load(f)
+        for npy_file in atlas_dir.glob('*.npy'):
+            setattr(brain_atlas, npy_file.stem, np.load(npy_file, mmap_mode='r'))
+    except Exception as err:
+        print(f'Could not load cached atlas, building it again: {err}')
+        shutil.rmtree(atlas_dir, ignore_errors=True)
+        brain_atlas = AllenAtlas(res_um, **kwargs)
+
+    return brain_atlas
+
+
+def _save_atlas(brain_atlas, atlas_dir):
+    """
+    Save large arrays of the atlas (image, label volumes...) as .npy files and the rest of the
+    atlas as a pickle. Written to a temporary folder first so that a partially written cache is
+    never used
+    """
+    atlas_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(dir=atlas_dir.parent))
+    try:
+        skeleton = copy.copy(brain_atlas)
+        for attr, value in vars(brain_atlas).items():
+            if isinstance(value, np.ndarray) and value.nbytes >= MMAP_MIN_BYTES:
+                np.save(tmp_dir.joinpath(attr + '.npy'), value)
+                setattr(skeleton, attr, None)
+        with open(tmp_dir.joinpath('atlas.pkl'), 'wb') as f:
+            pickle.dump(skeleton, f)
+        os.replace(tmp_dir, atlas_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -26,6 +26,16 @@ class ColorBar(pg.GraphicsWidget):
     def getColourMap(self):
         return self.lut
 
+    def getColourLookup(self, n=256):
+        """
+        RGBA lookup table of the colour map sampled at n evenly spaced points between 0 and 1
+        :param n: number of points
+        :type n: int
+        :return: lookup table
+        :type: np.array((n, 4)), np.uint8
+        """
+        return self.map.getLookupTable(0.0, 1.0, n, alpha=True).astype(np.uint8)
+
     def makeColourBar(self, width, height, fig, min=0, max=1, label='', lim=False):
         self.cbar = HorizontalBar(width, height, self.grad)
         ax = fig.getAxis('top')
@@ -49,6 +59,20 @@ class ColorBar(pg.GraphicsWidget):
         return self.cbar
 
 
+def makeBrushes(lut):
+    """
+    Brush for each entry of a colour lookup table. Indexing the returned array with colour
+    indices gives a brush per point without creating a QColor for each point
+    :param lut: RGB or RGBA lookup table
+    :type lut: np.array((n, 3 or 4)), np.uint8
+    :return: brushes
+    :type: np.array((n)), QtGui.QBrush
+    """
+    brushes = np.empty(len(lut), dtype=object)
+    brushes[:] = [pg.mkBrush(*colour) for colour in np.asarray(lut).tolist()]
+    return brushes
+
+
 class HorizontalBar(pg.GraphicsWidget):
     def __init__(self, width, height, grad):
         pg.GraphicsWidget.__init__(self)
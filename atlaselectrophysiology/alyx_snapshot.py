@@ -0,0 +1,236 @@
+from pathlib import Path
+import hashlib
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+SNAPSHOT_FILE = 'alyx_snapshot.sqlite'
+# Fields used as modification time of alyx records, in order of preference
+MODIFIED_FIELDS = ['datetime', 'modified', 'date_time']
+
+
+def get_snapshot_file(base_url=''):
+    """
+    Location of the snapshot of an alyx database, in the ONE cache directory
+    :param base_url: url of alyx database, each database has its own snapshot
+    :type base_url: str
+    :return: path to snapshot file
+    :type: Path
+    """
+    try:
+        from ibllib.io import params
+        cache_dir = Path(params.read('one_params').CACHE_DIR)
+    except Exception:
+        cache_dir = Path(Path.home(), 'Downloads', 'FlatIron')
+    host = base_url.split('://')[-1].strip('/').replace('/', '_').replace(':', '_')
+    return cache_dir.joinpath('histology', host + '_' + SNAPSHOT_FILE if host else SNAPSHOT_FILE)
+
+
+def _hash(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _query_key(url, action, kwargs):
+    return json.dumps([url.strip('/'), action, kwargs], sort_keys=True, default=str)
+
+
+class AlyxSnapshot:
+    def __init__(self, db_file, alyx=None, refresh='background'):
+        """
+        Local SQLite snapshot of the alyx records read by the alignment GUI. Used in place of
+        one.alyx.rest for 'list' and 'read' queries, records are stored once per endpoint and
+        id and queries store the ids they returned. Writes are sent to alyx and the records
+        returned are stored in the snapshot
+        :param db_file: path to SQLite database
+        :type db_file: Path
+        :param alyx: alyx client used to refresh the snapshot, if None the snapshot is only
+        read from
+        :type: oneibl.webclient.AlyxClient
+        :param refresh: 'background' to answer queries from the snapshot and refresh them from
+        alyx in a background thread, 'always' to query alyx first and only use the snapshot if
+        alyx can not be reached
+        :type refresh: str
+        """
+        self.db_file = Path(db_file)
+        self.alyx = alyx
+        self.refresh = refresh
+        self.lock = threading.RLock()
+        # Queries refreshed from alyx during this session, only refreshed once in the background
+        self.refreshed = set()
+        self.db_file.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.db_file), check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS records (endpoint TEXT, id TEXT, '
+                            'hash TEXT, modified TEXT, data TEXT, PRIMARY KEY (endpoint, id))')
+            self.db.execute('CREATE TABLE IF NOT EXISTS queries (query TEXT PRIMARY KEY, '
+                            'endpoint TEXT, ids TEXT, synced TEXT)')
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def rest(self, url, action, id=None, data=None, cache=True, **kwargs):
+        """
+        Same interface as one.alyx.rest
+        :param url: endpoint, e.g 'trajectories'
+        :type url: str
+        :param action: 'list', 'read', 'create', 'partial_update', 'update' or 'delete'
+        :type action: str
+        :param id: id of record for 'read' and update actions
+        :type id: str
+        :param data: data for create and update actions
+        :type data: dict
+        :param cache: if False always query alyx, falls back to the snapshot if alyx can not
+        be reached
+        :type cache: bool
+        :param kwargs: filters of 'list' queries
+        :return: alyx records
+        """
+        endpoint = url.strip('/')
+        if action not in ['list', 'read']:
+            return self._write(endpoint, action, id, data, **kwargs)
+
+        if action == 'read':
+            kwargs = dict(kwargs, id=id)
+        key = _query_key(endpoint, action, kwargs)
+        if cache and self.refresh == 'background':
+            records = self._load(key)
+            if records is not None:
+                if key not in self.refreshed and self.alyx is not None:
+                    self.refreshed.add(key)
+                    threading.Thread(target=self._refresh, args=(endpoint, action, kwargs),
+                                     daemon=True).start()
+                return records
+
+        try:
+            return self._refresh(endpoint, action, kwargs, raise_error=True)
+        except Exception as err:
+            records = self._load(key)
+            if records is None:
+                raise
+            print(f'Could not reach alyx, using local snapshot: {err}')
+            return records
+
+    def sync(self):
+        """
+        Refresh all queries stored in the snapshot from alyx, e.g before working offline
+        :return: number of records that were added or changed
+        :type: int
+        """
+        with self.lock:
+            keys = [row[0] for row in self.db.execute('SELECT query FROM queries')]
+        n_changed = 0
+        for key in keys:
+            endpoint, action, kwargs = json.loads(key)
+            n_changed += self._refresh(endpoint, action, kwargs, count=True) or 0
+        return n_changed
+
+    def _refresh(self, endpoint, action, kwargs, raise_error=False, count=False):
+        """
+        Query alyx and store the result in the snapshot
+        """
+        if self.alyx is None:
+            if raise_error:
+                raise ConnectionError('no alyx client')
+            return
+        try:
+            query = dict(kwargs)
+            if action == 'read':
+                records = self.alyx.rest(endpoint, action, id=query.pop('id'), **query)
+            else:
+                records = list(self.alyx.rest(endpoint, action, **query))
+        except Exception as err:
+            if raise_error:
+                raise
+            print(f'Could not refresh alyx snapshot: {err}')
+            return
+
+        n_changed = self._store(_query_key(endpoint, action, kwargs), endpoint, records)
+        return n_changed if count else records
+
+    def _write(self, endpoint, action, id, data, **kwargs):
+        if self.alyx is None:
+            raise ConnectionError(f'can not {action} {endpoint} without an alyx connection')
+        records = self.alyx.rest(endpoint, action, id=id, data=data, **kwargs)
+        with self.lock, self.db:
+            if action == 'delete':
+                self.db.execute('DELETE FROM records WHERE endpoint = ? AND id = ?',
+                                (endpoint, str(id)))
+            elif isinstance(records, dict):
+                self._upsert(endpoint, [records])
+            # Lists may gain or lose records, they are refreshed the next time they are read
+            self.refreshed = {key for key in self.refreshed
+                              if json.loads(key)[0] != endpoint}
+        return records
+
+    def _upsert(self, endpoint, records):
+        """
+        Store records, only records whose content changed are written. The modification time
+        of records is not used, alyx does not update it for all changes (e.g json fields)
+        :return: ids of records and number of records written
+        """
+        ids = [str(rec['id']) if 'id' in rec else _hash(rec) for rec in records]
+        stored = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            rows = self.db.execute('SELECT id, hash FROM records WHERE endpoint = ? AND id IN '
+                                   f'({",".join("?" * len(chunk))})', (endpoint, *chunk))
+            stored.update(rows)
+
+        changed = []
+        for rid, rec in zip(ids, records):
+            rhash = _hash(rec)
+            if rhash != stored.get(rid):
+                changed.append((endpoint, rid, rhash, self._modified(rec), json.dumps(rec)))
+        self.db.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)', changed)
+        return ids, len(changed)
+
+    @staticmethod
+    def _modified(record):
+        for field in MODIFIED_FIELDS:
+            if record.get(field):
+                return str(record[field])
+        return None
+
+    def _store(self, key, endpoint, records):
+        with self.lock, self.db:
+            ids, n_changed = self._upsert(endpoint, records if isinstance(records, list)
+                                          else [records])
+            stored_ids = json.dumps(ids if isinstance(records, list) else ids[0])
+            self.db.execute('INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?)',
+                            (key, endpoint, stored_ids,
+                             datetime.now().replace(microsecond=0).isoformat()))
+        return n_changed
+
+    def _load(self, key):
+        """
+        Records returned by a query from the snapshot, None if the query is not stored
+        """
+        with self.lock:
+            row = self.db.execute('SELECT endpoint, ids FROM queries WHERE query = ?',
+                                  (key,)).fetchone()
+            if row is None:
+                return None
+            endpoint, ids = row[0], json.loads(row[1])
+            single = not isinstance(ids, list)
+            ids = [ids] if single else ids
+            records = {}
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                rows = self.db.execute('SELECT id, data FROM records WHERE endpoint = ? AND '
+                                       f'id IN ({",".join("?" * len(chunk))})', (endpoint, *chunk))
+                records.update(rows)
+        if any(rid not in records for rid in ids):
+            return None
+        records = [json.loads(records[rid]) for rid in ids]
+        return records[0] if single else records
+
+    def last_synced(self):
+        """
+        Time of the most recent refresh from alyx
+        :return: iso formatted time, None if the snapshot is empty
+        :type: str
+        """
+        with self.lock:
+            return self.db.execute('SELECT MAX(synced) FROM queries').fetchone()[0]
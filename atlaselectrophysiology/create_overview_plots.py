@@ -1,9 +1,24 @@
 import matplotlib.pyplot as plt
 from pathlib import Path
+import numpy as np
 import glob
 
 
-def make_overview_plot(folder, sess_info, save_folder=None):
+def make_overview_plot(folder, sess_info, save_folder=None, images=None, show=True):
+    """
+    Combine the plots saved by the GUI into one overview figure
+    :param folder: folder containing the saved plots
+    :type folder: Path
+    :param sess_info: prefix of saved plots
+    :type sess_info: str
+    :param save_folder: folder to save overview figure in, defaults to folder
+    :type save_folder: Path
+    :param images: plots already in memory, as returned by export_plots.export_plots. If given
+    the plots are not read back from folder
+    :type images: dict
+    :param show: whether to display the overview figure
+    :type show: bool
+    """
 
     image_folder = folder
     image_info = sess_info
@@ -11,8 +26,11 @@ def make_overview_plot(folder, sess_info, save_folder=None):
         save_folder = image_folder
 
     def load_image(image_name, ax):
-        with image_name as ifile:
-            image = plt.imread(ifile)
+        if isinstance(image_name, np.ndarray):
+            image = image_name
+        else:
+            with image_name as ifile:
+                image = plt.imread(ifile)
 
         ax.spines['right'].set_visible(False)
         ax.spines['top'].set_visible(False)
@@ -23,59 +41,83 @@ def make_overview_plot(folder, sess_info, save_folder=None):
         ax.imshow(image)
         return image
 
+    if images is not None:
+        from atlaselectrophysiology.export_plots import IMG_ORDER, SLICE_ORDER
+
+        def get_images(group, order=None):
+            group_images = images.get(group, {})
+            order = order or list(group_images.keys())
+            return [group_images[name] for name in order if name in group_images]
+
+        img_files_sort = get_images('img', IMG_ORDER)
+        probe_files_sort = get_images('probe')[:7]
+        line_files = get_images('line')
+        slice_files_sort = get_images('slice', SLICE_ORDER)
+        slice_zoom_files_sort = get_images('slice_zoom')
+        hist_files = get_images('hist')
+    else:
+        img_idx = [0, 5, 4, 6, 7, 8, 1, 2, 3]
+        img_files = glob.glob(str(image_folder.joinpath(image_info + 'img_*.png')))
+        img_files_sort = [Path(img_files[idx]) for idx in img_idx]
+
+        probe_idx = [0, 3, 1, 2, 4, 5, 6]
+        probe_files = glob.glob(str(image_folder.joinpath(image_info + 'probe_*.png')))
+        probe_files_sort = [Path(probe_files[idx]) for idx in probe_idx]
+        line_files = [Path(file) for file in
+                      glob.glob(str(image_folder.joinpath(image_info + 'line_*.png')))]
+
+        slice_files = glob.glob(str(image_folder.joinpath(image_info + 'slice_*.png')))
+        slice_idx = [0, 1, 2, 3]
+        slice_files_sort = [Path(slice_files[idx]) for idx in slice_idx]
+
+        slice_files = glob.glob(str(image_folder.joinpath(image_info + 'slice_zoom*.png')))
+        slice_zoom_files_sort = [Path(slice_files[idx]) for idx in slice_idx]
+
+        hist_files = [Path(file) for file in
+                      glob.glob(str(image_folder.joinpath(image_info + 'hist*.png')))]
+
     fig = plt.figure(constrained_layout=True, figsize=(18, 9))
     gs = fig.add_gridspec(3, 18)
     gs.update(wspace=0.025, hspace=0.05)
 
     img_row_order = [0, 0, 0, 0, 0, 0, 1, 1, 1]
     img_column_order = [0, 3, 6, 9, 12, 15, 0, 3, 6]
-    img_idx = [0, 5, 4, 6, 7, 8, 1, 2, 3]
-    img_files = glob.glob(str(image_folder.joinpath(image_info + 'img_*.png')))
-    img_files_sort = [img_files[idx] for idx in img_idx]
 
     for iF, file in enumerate(img_files_sort):
         ax = fig.add_subplot(gs[img_row_order[iF], img_column_order[iF]:img_column_order[iF] + 3])
-        load_image(Path(file), ax)
+        load_image(file, ax)
 
     probe_row_order = [1, 1, 1, 1, 1, 1, 2, 2, 2]
     probe_column_order = [9, 10, 11, 12, 13, 14, 12, 13, 14]
-    probe_idx = [0, 3, 1, 2, 4, 5, 6]
-    probe_files = glob.glob(str(image_folder.joinpath(image_info + 'probe_*.png')))
-    probe_files_sort = [probe_files[idx] for idx in probe_idx]
-    line_files = glob.glob(str(image_folder.joinpath(image_info + 'line_*.png')))
 
     for iF, file in enumerate(probe_files_sort + line_files):
         ax = fig.add_subplot(gs[probe_row_order[iF], probe_column_order[iF]])
-        load_image(Path(file), ax)
+        load_image(file, ax)
 
-    slice_files = glob.glob(str(image_folder.joinpath(image_info + 'slice_*.png')))
     slice_row_order = [2, 2, 2, 2]
-    slice_idx = [0, 1, 2, 3]
     slice_column_order = [0, 3, 6, 9]
-    slice_files_sort = [slice_files[idx] for idx in slice_idx]
 
     for iF, file in enumerate(slice_files_sort):
         ax = fig.add_subplot(gs[slice_row_order[iF],
                                 slice_column_order[iF]:slice_column_order[iF] + 3])
-        load_image(Path(file), ax)
+        load_image(file, ax)
 
-    slice_files = glob.glob(str(image_folder.joinpath(image_info + 'slice_zoom*.png')))
     slice_row_order = [2, 2, 2, 2]
-    slice_idx = [0, 1, 2, 3]
     slice_column_order = [2, 5, 8, 11]
-    slice_files_sort = [slice_files[idx] for idx in slice_idx]
 
-    for iF, file in enumerate(slice_files_sort):
+    for iF, file in enumerate(slice_zoom_files_sort):
         ax = fig.add_subplot(gs[slice_row_order[iF], slice_column_order[iF]])
-        load_image(Path(file), ax)
+        load_image(file, ax)
 
-    hist_files = glob.glob(str(image_folder.joinpath(image_info + 'hist*.png')))
     for iF, file in enumerate(hist_files):
         ax = fig.add_subplot(gs[1:3, 15:18])
-        load_image(Path(file), ax)
+        load_image(file, ax)
 
     ax.text(0.5, 0, image_info[:-1], va="center", ha="center", transform=ax.transAxes)
 
     plt.savefig(save_folder.joinpath(image_info + "overview.png"),
                 bbox_inches='tight', pad_inches=0)
-    plt.show()
\ No newline at end of file
+    if show:
+        plt.show()
+    else:
+        plt.close(fig)
@@ -7,9 +7,12 @@ from atlaselectrophysiology.load_data import LoadData
 from atlaselectrophysiology.load_data_local import LoadDataLocal
 from ibllib.pipes.ephys_alignment import EphysAlignment
 import atlaselectrophysiology.plot_data as pd
+from atlaselectrophysiology.plot_engine import PlotDataEngine, UNIT_PRODUCTS
 import atlaselectrophysiology.ColorBar as cb
 import atlaselectrophysiology.ephys_gui_setup as ephys_gui
 from atlaselectrophysiology.create_overview_plots import make_overview_plot
+import atlaselectrophysiology.export_plots as export
+import atlaselectrophysiology.slice_service as ss
 from pathlib import Path
 import os
 
@@ -21,6 +24,9 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
         self.init_variables()
         self.init_layout(self, offline=offline)
         self.configure = True
+        # Keep the point with the largest amplitude ('max') or a random point ('random') when
+        # decimating scatter plots, not reset with other variables as it is set from the menu
+        self.scatter_decimate = 'max'
         if not offline and probe_id is None:
             self.loaddata = LoadData()
             self.populate_lists(self.loaddata.get_subjects(), self.subj_list, self.subj_combobox)
@@ -88,6 +94,9 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
         self.scale_regions = np.empty((0, 1))
         self.slice_lines = []
         self.slice_items = []
+        self.slice_img = None
+        self.slice_img_type = None
+        self.slice_level = 0
         self.probe_bounds = []
 
         # Variables to keep track of popup plots
@@ -95,6 +104,15 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
         self.label_popup = []
         self.popup_status = True
 
+        # Variable to keep track of latest plot requested for each figure
+        self.plot_requests = {}
+
+        # Variables for decimation of scatter plots, keep one point per grid cell of scatter_px
+        # screen pixels
+        self.scatter_data = None
+        self.scatter_source = None
+        self.scatter_px = 2
+
         self.hist_data = {
             'region': [0] * (self.max_idx + 1),
             'axis_label': [0] * (self.max_idx + 1),
@@ -348,6 +366,8 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
 
         os.makedirs(image_path_overview, exist_ok=True)
         os.makedirs(image_path, exist_ok=True)
+        # Make sure all plots have been computed before cycling through them
+        self.plot_engine.get_all()
         # Reset all axis, put view back to 1 and remove any reference lines
         self.reset_axis_button_pressed()
         self.set_view(view=1, configure=False)
@@ -502,6 +522,42 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
 
         make_overview_plot(image_path, sess_info, save_folder=image_path_overview)
 
+    def export_plots(self, save_path=None):
+        """
+        Saves all ephys and slice plots into folder without changing what is displayed in the
+        GUI. Plots are rendered offscreen in parallel processes and the overview figure is made
+        from the rendered plots in memory. Unlike save_plots the histology panel and zoomed
+        slice images are not included. The export starts once the plot engine has computed all
+        products, the GUI is not blocked while they are computed
+        :param save_path: folder to save overview figure in, defaults to GUI_plots folder
+        :type save_path: str or Path
+        """
+        try:
+            sess_info = (self.loaddata.subj + '_' + str(self.loaddata.date) + '_' +
+                         self.loaddata.probe_label + '_')
+            image_path_overview = self.alf_path.joinpath('GUI_plots')
+            image_path = image_path_overview.joinpath(sess_info[:-1])
+        except Exception:
+            sess_info = ''
+            image_path_overview = self.alf_path.joinpath('GUI_plots')
+            image_path = image_path_overview
+
+        if save_path:
+            image_path_overview = Path(save_path)
+
+        os.makedirs(image_path_overview, exist_ok=True)
+        os.makedirs(image_path, exist_ok=True)
+
+        slice_data = self.slice_data
+
+        def export_products(products):
+            jobs = export.get_plot_jobs(products, slice_data)
+            images = export.export_plots(jobs, image_path, sess_info)
+            make_overview_plot(image_path, sess_info, save_folder=image_path_overview,
+                               images=images, show=False)
+
+        self.plot_engine.request_all(export_products)
+
     def toggle_plots(self, options_group):
         """
         Allows user to toggle through image, line, probe and slice plots using keyboard shortcuts
@@ -776,8 +832,13 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
         self.fig_slice.clear()
         self.slice_chns = []
         self.slice_lines = []
+        # Start from the full resolution so that the histogram levels are computed on all
+        # pixels, update_slice_level then picks the level matching the zoom
         img = pg.ImageItem()
         img.setImage(data[img_type])
+        self.slice_img = img
+        self.slice_img_type = img_type
+        self.slice_level = 0
 
         if img_type == 'label':
             img.translate(data['offset'][0], data['offset'][1])
@@ -811,6 +872,29 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
         self.traj_line.setData(x=self.xyz_track[:, 0], y=self.xyz_track[:, 2], pen=self.kpen_solid)
         self.fig_slice.addItem(self.traj_line)
         self.plot_channels()
+        self.update_slice_level()
+
+    def update_slice_level(self, *args):
+        """
+        Displays the level of the slice pyramid that matches the resolution of the slice figure,
+        called whenever the range of the slice figure changes so that zooming in shows the full
+        resolution and zooming out draws a smaller image
+        """
+        if self.slice_img is None:
+            return
+        try:
+            pixel_size = self.fig_slice.viewPixelSize()
+        except Exception:
+            # The figure is not displayed yet
+            pixel_size = None
+        level, img, scale = ss.get_level(self.slice_data, self.slice_img_type, pixel_size)
+        if level == self.slice_level:
+            return
+        self.slice_level = level
+        self.slice_img.setImage(img, autoLevels=False)
+        self.slice_img.resetTransform()
+        self.slice_img.translate(self.slice_data['offset'][0], self.slice_data['offset'][1])
+        self.slice_img.scale(scale[0], scale[1])
 
     def plot_channels(self):
         self.channel_status = True
@@ -846,6 +930,36 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
             self.slice_chns.setData(x=self.xyz_channels[:, 0], y=self.xyz_channels[:, 2], pen='r',
                                     brush='r')
 
+    def show_plot(self, fig, product, plot_func, index=None, key=None):
+        """
+        Requests a plot product from the background plot engine and displays it once it has been
+        computed. If another plot has been requested for the same figure in the meantime the
+        product is not displayed
+        :param fig: figure the plot is destined for, one of 'img', 'line' or 'probe'
+        :type fig: string
+        :param product: name of product, must be one of plot_engine.PLOT_PRODUCTS
+        :type product: string
+        :param plot_func: function used to display the data
+        :type plot_func: callable
+        :param index: for products that return several plots, index of plot to display
+        :type index: int
+        :param key: for products that return a dict of plots, key of plot to display
+        :type key: string
+        """
+        request = object()
+        self.plot_requests[fig] = request
+
+        def _plot(data):
+            if self.plot_requests.get(fig) is not request:
+                return
+            if index is not None:
+                data = data[index] if data is not None else None
+            if key is not None:
+                data = data.get(key) if data is not None else None
+            plot_func(data)
+
+        self.plot_engine.request(product, _plot)
+
     def plot_scatter(self, data):
         """
         Plots a 2D scatter plot with electrophysiology data
@@ -853,7 +967,10 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
             {'x': x coordinate of data, np.array((npoints)), float
              'y': y coordinate of data, np.array((npoints)), float
              'size': size of data points, np.array((npoints)), float
-             'colour': colour of data points, np.array((npoints)), QtGui.QColor
+             'colours': colour of data points, either index into 'lut' np.array((npoints)),
+                        np.uint8 or values normalised between 0 and 1 to map onto 'cmap',
+                        np.array((npoints)), float
+             'lut': optional lookup table of colours, np.array((ncolours, 4)), np.uint8
              'xrange': range to display of x axis, np.array([min range, max range]), float
              'xaxis': label for xaxis, string
             }
@@ -867,8 +984,6 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
             [self.fig_img_cb.removeItem(cbar) for cbar in self.img_cbars]
             self.img_plots = []
             self.img_cbars = []
-            connect = np.zeros(data['x'].size, dtype=int)
-            size = data['size'].tolist()
             symbol = data['symbol'].tolist()
 
             color_bar = cb.ColorBar(data['cmap'])
@@ -877,14 +992,46 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
             self.fig_img_cb.addItem(cbar)
             self.img_cbars.append(cbar)
 
-            if type(np.any(data['colours'])) == QtGui.QColor:
-                brush = data['colours'].tolist()
+            # Map colours to brushes with a lookup table, only one brush is made per colour
+            if 'lut' in data:
+                lut = data['lut']
+                colour_idx = data['colours']
             else:
-                brush = color_bar.map.mapToQColor(data['colours'])
+                lut = color_bar.getColourLookup()
+                colour_idx = np.clip(np.nan_to_num(data['colours']) * (len(lut) - 1), 0,
+                                     len(lut) - 1)
+                colour_idx = np.round(colour_idx).astype(np.int32)
+
+            x = data['x']
+            y = data['y']
+            size = data['size']
+            if 'lut' in data and size.size == len(lut):
+                size = size[colour_idx]
+
+            decimate = data.get('decimate', False)
+            if decimate:
+                # Order points by priority, decimation keeps the first point in each grid cell
+                if self.scatter_decimate == 'max':
+                    order = np.argsort(-data['amps'], kind='stable')
+                else:
+                    order = np.random.default_rng(0).permutation(x.size)
+                x, y, colour_idx = x[order], y[order], colour_idx[order]
+                if size.ndim:
+                    size = size[order]
+
+            brush = cb.makeBrushes(lut)[colour_idx]
+            size = size if size.ndim else size.tolist()
 
             plot = pg.PlotDataItem()
-            plot.setData(x=data['x'], y=data['y'], connect=connect,
-                         symbol=symbol, symbolSize=size, symbolBrush=brush, symbolPen=data['pen'])
+            if decimate:
+                self.scatter_source = data
+                self.scatter_data = {'plot': plot, 'x': x, 'y': y, 'size': size,
+                                     'brush': brush, 'symbol': symbol, 'pen': data['pen']}
+            else:
+                self.scatter_data = None
+                connect = np.zeros(x.size, dtype=int)
+                plot.setData(x=x, y=y, connect=connect, symbol=symbol, symbolSize=size,
+                             symbolBrush=brush, symbolPen=data['pen'])
             self.fig_img.addItem(plot)
             self.fig_img.setXRange(min=data['xrange'][0], max=data['xrange'][1],
                                    padding=0)
@@ -898,8 +1045,50 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
 
             if data['cluster']:
                 self.data = data['x']
+                # Cluster of each point, kept with the plot so that clicks on points of an
+                # earlier unit filter still find their cluster
+                self.clust_id = data['clust_id']
                 self.data_plot.sigPointsClicked.connect(self.cluster_clicked)
 
+            if decimate:
+                self.decimate_scatter()
+
+    def decimate_scatter(self, *args):
+        """
+        Displays a subset of the points of the current scatter plot, one point per grid cell of
+        scatter_px screen pixels over the displayed range. Called whenever the range of the
+        image figure changes so that zooming in reveals all points
+        """
+        if self.scatter_data is None or self.scatter_data['plot'] not in self.img_plots:
+            return
+
+        view_box = self.fig_img.getViewBox()
+        xlim, ylim = view_box.viewRange()
+        n_x = max(int(view_box.width() / self.scatter_px), 1)
+        n_y = max(int(view_box.height() / self.scatter_px), 1)
+        idx = pd.decimate_points(self.scatter_data['x'], self.scatter_data['y'], xlim, ylim,
+                                 n_x, n_y)
+
+        size = self.scatter_data['size']
+        self.scatter_data['plot'].setData(x=self.scatter_data['x'][idx],
+                                          y=self.scatter_data['y'][idx],
+                                          connect=np.zeros(idx.size, dtype=int),
+                                          symbol=self.scatter_data['symbol'],
+                                          symbolSize=size[idx] if np.ndim(size) else size,
+                                          symbolBrush=self.scatter_data['brush'][idx],
+                                          symbolPen=self.scatter_data['pen'])
+
+    def scatter_decimate_pressed(self, mode):
+        """
+        Changes how points are chosen when decimating scatter plots and redraws the current
+        scatter plot
+        :param mode: 'max' to keep the point with the largest amplitude or 'random'
+        :type mode: str
+        """
+        self.scatter_decimate = mode
+        if self.scatter_data is not None and self.scatter_data['plot'] in self.img_plots:
+            self.plot_scatter(self.scatter_source)
+
     def plot_line(self, data):
         """
         Plots a 1D line plot with electrophysiology data
@@ -1128,18 +1317,9 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
 
         if not self.data_status:
             self.plotdata = pd.PlotData(self.alf_path, ephys_path)
-            self.scat_drift_data = self.plotdata.get_depth_data_scatter()
-            (self.scat_fr_data, self.scat_p2t_data,
-             self.scat_amp_data) = self.plotdata.get_fr_p2t_data_scatter()
-            self.img_corr_data = self.plotdata.get_correlation_data_img()
-            self.img_fr_data = self.plotdata.get_fr_img()
-            self.img_rms_APdata, self.probe_rms_APdata = self.plotdata.get_rms_data_img_probe('AP')
-            self.img_rms_LFPdata, self.probe_rms_LFPdata = self.plotdata.get_rms_data_img_probe(
-                'LF')
-            self.img_lfp_data, self.probe_lfp_data = self.plotdata.get_lfp_spectrum_data()
-            self.line_fr_data, self.line_amp_data = self.plotdata.get_fr_amp_data_line()
-            self.probe_rfmap, self.rfmap_boundaries = self.plotdata.get_rfmap_data()
-            self.img_stim_data = self.plotdata.get_passive_events()
+            # Plots are computed in the background the first time they are displayed
+            self.plot_engine = PlotDataEngine(self.plotdata)
+            self.plot_engine.submit(self.plotdata.compute_autocorrs)
 
             self.slice_data = self.loaddata.get_slice_images(self.ephysalign.xyz_samples)
 
@@ -1155,9 +1335,9 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
         self.slice_init.setChecked(True)
 
         # Initialise ephys plots
-        self.plot_image(self.img_fr_data)
-        self.plot_probe(self.probe_rms_APdata)
-        self.plot_line(self.line_fr_data)
+        self.show_plot('img', 'img_fr', self.plot_image)
+        self.show_plot('probe', 'rms_AP', self.plot_probe, index=1)
+        self.show_plot('line', 'line_fr_amp', self.plot_line, index=0)
 
         # Initialise histology plots
         self.plot_histology_ref(self.fig_hist_ref)
@@ -1204,20 +1384,14 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
 
     def filter_unit_pressed(self, type):
         self.plotdata.filter_units(type)
-        self.scat_drift_data = self.plotdata.get_depth_data_scatter()
-        (self.scat_fr_data, self.scat_p2t_data,
-         self.scat_amp_data) = self.plotdata.get_fr_p2t_data_scatter()
-        self.img_corr_data = self.plotdata.get_correlation_data_img()
-        self.img_fr_data = self.plotdata.get_fr_img()
-        self.line_fr_data, self.line_amp_data = self.plotdata.get_fr_amp_data_line()
-        self.probe_rfmap, self.rfmap_boundaries = self.plotdata.get_rfmap_data()
-        self.img_stim_data = self.plotdata.get_passive_events()
+        self.plot_engine.invalidate(UNIT_PRODUCTS)
+        self.plot_engine.submit(self.plotdata.compute_autocorrs)
         self.img_init.setChecked(True)
         self.line_init.setChecked(True)
         self.probe_init.setChecked(True)
-        self.plot_image(self.img_fr_data)
-        self.plot_probe(self.probe_rms_APdata)
-        self.plot_line(self.line_fr_data)
+        self.show_plot('img', 'img_fr', self.plot_image)
+        self.show_plot('probe', 'rms_AP', self.plot_probe, index=1)
+        self.show_plot('line', 'line_fr_amp', self.plot_line, index=0)
 
     def fit_button_pressed(self):
         """
@@ -1653,10 +1827,10 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
             self.fit_button_pressed()
 
     def cluster_clicked(self, item, point):
-        point_pos = point[0].pos()
-        clust_idx = np.argwhere(self.data == point_pos.x())[0][0]
+        clust_idx = point[0].index()
+        clust = self.clust_id[clust_idx]
 
-        autocorr = self.plotdata.get_autocorr(clust_idx)
+        autocorr = self.plotdata.get_autocorr(clust)
         autocorr_plot = pg.PlotItem()
         autocorr_plot.setXRange(min=np.min(self.plotdata.t_autocorr),
                                 max=np.max(self.plotdata.t_autocorr))
@@ -1668,7 +1842,7 @@ class MainWindow(QtWidgets.QMainWindow, ephys_gui.Setup):
                      brush=self.bar_colour)
         autocorr_plot.addItem(plot)
 
-        template_wf = self.plotdata.get_template_wf(clust_idx)
+        template_wf = self.plotdata.get_template_wf(clust)
         template_plot = pg.PlotItem()
         plot = pg.PlotCurveItem()
         template_plot.setXRange(min=np.min(self.plotdata.t_template),
@@ -53,26 +53,32 @@ class Setup():
         # IMAGE PLOTS MENU BAR
         # Define all 2D scatter/ image plot options
         scatter_drift = QtGui.QAction('Amplitude', self, checkable=True, checked=False)
-        scatter_drift.triggered.connect(lambda: self.plot_scatter(self.scat_drift_data))
+        scatter_drift.triggered.connect(lambda: self.show_plot('img', 'scat_drift',
+                                                               self.plot_scatter))
         scatter_fr = QtGui.QAction('Cluster Amp vs Depth vs FR', self, checkable=True,
                                    checked=False)
-        scatter_fr.triggered.connect(lambda: self.plot_scatter(self.scat_fr_data))
+        scatter_fr.triggered.connect(lambda: self.show_plot('img', 'scat_fr_p2t_amp',
+                                                            self.plot_scatter, index=0))
         scatter_p2t = QtGui.QAction('Cluster Amp vs Depth vs Duration', self, checkable=True,
                                     checked=False)
-        scatter_p2t.triggered.connect(lambda: self.plot_scatter(self.scat_p2t_data))
+        scatter_p2t.triggered.connect(lambda: self.show_plot('img', 'scat_fr_p2t_amp',
+                                                             self.plot_scatter, index=1))
         scatter_amp = QtGui.QAction('Cluster FR vs Depth vs Amp', self, checkable=True,
                                     checked=False)
-        scatter_amp.triggered.connect(lambda: self.plot_scatter(self.scat_amp_data))
+        scatter_amp.triggered.connect(lambda: self.show_plot('img', 'scat_fr_p2t_amp',
+                                                             self.plot_scatter, index=2))
         img_fr = QtGui.QAction('Firing Rate', self, checkable=True, checked=True)
-        img_fr.triggered.connect(lambda: self.plot_image(self.img_fr_data))
+        img_fr.triggered.connect(lambda: self.show_plot('img', 'img_fr', self.plot_image))
         img_corr = QtGui.QAction('Correlation', self, checkable=True, checked=False)
-        img_corr.triggered.connect(lambda: self.plot_image(self.img_corr_data))
+        img_corr.triggered.connect(lambda: self.show_plot('img', 'img_corr', self.plot_image))
         img_rmsAP = QtGui.QAction('rms AP', self, checkable=True, checked=False)
-        img_rmsAP.triggered.connect(lambda: self.plot_image(self.img_rms_APdata))
+        img_rmsAP.triggered.connect(lambda: self.show_plot('img', 'rms_AP', self.plot_image,
+                                                           index=0))
         img_rmsLFP = QtGui.QAction('rms LFP', self, checkable=True, checked=False)
-        img_rmsLFP.triggered.connect(lambda: self.plot_image(self.img_rms_LFPdata))
+        img_rmsLFP.triggered.connect(lambda: self.show_plot('img', 'rms_LF', self.plot_image,
+                                                            index=0))
         img_LFP = QtGui.QAction('LFP Spectrum', self, checkable=True, checked=False)
-        img_LFP.triggered.connect(lambda: self.plot_image(self.img_lfp_data))
+        img_LFP.triggered.connect(lambda: self.show_plot('img', 'lfp', self.plot_image, index=0))
 
         # Initialise with firing rate 2D plot
         self.img_init = img_fr
@@ -102,20 +108,22 @@ class Setup():
         img_options.addAction(scatter_amp)
         self.img_options_group.addAction(scatter_amp)
 
-        stim_type = list(self.img_stim_data.keys())
+        stim_type = self.plotdata.get_passive_stim_types()
         for stim in stim_type:
             img = QtGui.QAction(stim, self, checkable=True, checked=False)
-            img.triggered.connect(lambda checked, item=stim: self.plot_image(
-                                  self.img_stim_data[item]))
+            img.triggered.connect(lambda checked, item=stim: self.show_plot(
+                                  'img', 'stim', self.plot_image, key=item))
             img_options.addAction(img)
             self.img_options_group.addAction(img)
 
         # LINE PLOTS MENU BAR
         # Define all 1D line plot options
         line_fr = QtGui.QAction('Firing Rate', self, checkable=True, checked=True)
-        line_fr.triggered.connect(lambda: self.plot_line(self.line_fr_data))
+        line_fr.triggered.connect(lambda: self.show_plot('line', 'line_fr_amp', self.plot_line,
+                                                         index=0))
         line_amp = QtGui.QAction('Amplitude', self, checkable=True, checked=False)
-        line_amp.triggered.connect(lambda: self.plot_line(self.line_amp_data))
+        line_amp.triggered.connect(lambda: self.show_plot('line', 'line_fr_amp', self.plot_line,
+                                                          index=1))
         # Initialise with firing rate 1D plot
         self.line_init = line_fr
         # Add menu bar for 1D line plot options
@@ -133,9 +141,11 @@ class Setup():
         # Define all 2D probe plot options
         # In two stages 1) RMS plots manually, 2) frequency plots in for loop
         probe_rmsAP = QtGui.QAction('rms AP', self, checkable=True, checked=True)
-        probe_rmsAP.triggered.connect(lambda: self.plot_probe(self.probe_rms_APdata))
+        probe_rmsAP.triggered.connect(lambda: self.show_plot('probe', 'rms_AP', self.plot_probe,
+                                                             index=1))
         probe_rmsLFP = QtGui.QAction('rms LFP', self, checkable=True, checked=False)
-        probe_rmsLFP.triggered.connect(lambda: self.plot_probe(self.probe_rms_LFPdata))
+        probe_rmsLFP.triggered.connect(lambda: self.show_plot('probe', 'rms_LF', self.plot_probe,
+                                                              index=1))
 
         # Initialise with rms of AP probe plot
         self.probe_init = probe_rmsAP
@@ -156,16 +166,17 @@ class Setup():
         for iF, freq in enumerate(freq_bands):
             band = f"{freq[0]} - {freq[1]} Hz"
             probe = QtGui.QAction(band, self, checkable=True, checked=False)
-            probe.triggered.connect(lambda checked, item=band: self.plot_probe(
-                                    self.probe_lfp_data[item]))
+            probe.triggered.connect(lambda checked, item=band: self.show_plot(
+                                    'probe', 'lfp', self.plot_probe, index=1, key=item))
             probe_options.addAction(probe)
             self.probe_options_group.addAction(probe)
 
-        sub_types = list(self.probe_rfmap.keys())
+        sub_types = self.plotdata.get_rfmap_types()
         for sub in sub_types:
             probe = QtGui.QAction(f'RF Map - {sub}', self, checkable=True, checked=False)
-            probe.triggered.connect(lambda checked, item=sub: self.plot_probe(
-                                    self.probe_rfmap[item], bounds=self.rfmap_boundaries))
+            probe.triggered.connect(lambda checked, item=sub: self.show_plot(
+                                    'probe', 'rfmap', lambda rfmap, sub=item: self.plot_probe(
+                                        rfmap[0][sub], bounds=rfmap[1])))
             probe_options.addAction(probe)
             self.probe_options_group.addAction(probe)
 
@@ -340,9 +351,20 @@ class Setup():
         popup_close.setShortcut('Alt+X')
         popup_close.triggered.connect(self.close_popups)
 
+        # Options for how spikes are decimated in scatter plots
+        decimate_max = QtGui.QAction('Scatter: Keep Max Amplitude', self, checkable=True,
+                                     checked=True)
+        decimate_max.triggered.connect(lambda: self.scatter_decimate_pressed('max'))
+        decimate_random = QtGui.QAction('Scatter: Keep Random', self, checkable=True,
+                                        checked=False)
+        decimate_random.triggered.connect(lambda: self.scatter_decimate_pressed('random'))
+
         # Option to save all plots
         save_plots = QtGui.QAction('Save Plots', self)
         save_plots.triggered.connect(self.save_plots)
+        # Option to save all plots without using the GUI display
+        export_plots = QtGui.QAction('Export Plots (Offscreen)', self)
+        export_plots.triggered.connect(lambda: self.export_plots())
 
         # Add menu bar with all possible display options
         display_options = menu_bar.addMenu('Display Options')
@@ -360,7 +382,17 @@ class Setup():
         display_options.addAction(toggle_histology_option)
         display_options.addAction(popup_minimise)
         display_options.addAction(popup_close)
+        display_options.addSeparator()
+        # Add action group so only one decimation option can be chosen
+        decimate_options_group = QtGui.QActionGroup(display_options)
+        decimate_options_group.setExclusive(True)
+        display_options.addAction(decimate_max)
+        decimate_options_group.addAction(decimate_max)
+        display_options.addAction(decimate_random)
+        decimate_options_group.addAction(decimate_random)
+        display_options.addSeparator()
         display_options.addAction(save_plots)
+        display_options.addAction(export_plots)
 
         # SESSION INFORMATION MENU BAR
         # Define all session information options
@@ -582,6 +614,9 @@ class Setup():
                                self.probe_extra, padding=self.pad)
         self.fig_img.addLine(y=self.probe_tip, pen=self.kpen_dot, z=50)
         self.fig_img.addLine(y=self.probe_top, pen=self.kpen_dot, z=50)
+        # Redecimate scatter plots when zooming, rate limited so that panning stays smooth
+        self.fig_img_proxy = pg.SignalProxy(self.fig_img.getViewBox().sigRangeChanged,
+                                            rateLimit=10, slot=self.decimate_scatter)
         self.set_axis(self.fig_img, 'bottom')
         self.fig_data_ax = self.set_axis(self.fig_img, 'left',
                                          label='Distance from probe tip (uV)')
@@ -716,6 +751,9 @@ class Setup():
         self.fig_slice_layout = pg.GraphicsLayout()
         self.fig_slice_hist_alt = pg.ViewBox()
         self.fig_slice = pg.ViewBox()
+        # Swap the level of the slice pyramid when zooming, rate limited as for scatter plots
+        self.fig_slice_proxy = pg.SignalProxy(self.fig_slice.sigRangeChanged, rateLimit=10,
+                                              slot=self.update_slice_level)
         self.fig_slice_layout.addItem(self.fig_slice, 0, 0)
         self.fig_slice_layout.addItem(self.fig_slice_hist_alt, 0, 1)
         self.fig_slice_layout.layout.setColumnStretchFactor(0, 3)
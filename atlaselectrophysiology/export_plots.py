@@ -0,0 +1,226 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from pathlib import Path
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import matplotlib.cm
+
+# Range of depths displayed on ephys plots, same as in the GUI
+DEPTH_RANGE = [-100, 3940]
+# Size in pixels of exported plots
+IMG_SIZE = (700, 900)
+PROBE_SIZE = (250, 900)
+LINE_SIZE = (200, 900)
+SLICE_SIZE = (500, 500)
+DPI = 100
+# Maximum number of points drawn in exported scatter plots
+MAX_SCATTER_POINTS = 200000
+
+# Order of plots in overview figure
+IMG_ORDER = ['Firing Rate', 'Correlation', 'rms AP', 'rms LFP', 'LFP Spectrum', 'Amplitude',
+             'Cluster Amp vs Depth vs FR', 'Cluster Amp vs Depth vs Duration',
+             'Cluster FR vs Depth vs Amp']
+SLICE_ORDER = ['Histology Red', 'Histology Green', 'CCF', 'Annotation']
+
+
+def get_plot_jobs(products, slice_data=None):
+    """
+    List of plots to export from the products computed by PlotDataEngine.request_all and the
+    slice data of LoadData.get_slice_images
+    :param products: PlotData products, keys are names in plot_engine.PLOT_PRODUCTS, products
+    that could not be computed are None
+    :type products: dict
+    :param slice_data: slice images
+    :type slice_data: dict
+    :return: list of (group, name, kind, data) for each plot that is available
+    :type: list of tuple
+    """
+    jobs = []
+
+    def add(group, name, kind, data):
+        if data:
+            jobs.append((group, name, kind, data))
+
+    def get(key, idx=None):
+        # Products that could not be computed are None
+        data = products.get(key)
+        if data is None or idx is None:
+            return data
+        return data[idx]
+
+    fr, p2t, amp = get('scat_fr_p2t_amp') or (None, None, None)
+    add('img', 'Firing Rate', 'img', get('img_fr'))
+    add('img', 'Correlation', 'img', get('img_corr'))
+    add('img', 'rms AP', 'img', get('rms_AP', 0))
+    add('img', 'rms LFP', 'img', get('rms_LF', 0))
+    add('img', 'LFP Spectrum', 'img', get('lfp', 0))
+    add('img', 'Amplitude', 'scatter', decimate_scatter(get('scat_drift')))
+    add('img', 'Cluster Amp vs Depth vs FR', 'scatter', fr)
+    add('img', 'Cluster Amp vs Depth vs Duration', 'scatter', p2t)
+    add('img', 'Cluster FR vs Depth vs Amp', 'scatter', amp)
+    for stim, data in (get('stim') or {}).items():
+        add('img', stim, 'img', data)
+
+    add('probe', 'rms AP', 'probe', get('rms_AP', 1))
+    add('probe', 'rms LFP', 'probe', get('rms_LF', 1))
+    for band, data in (get('lfp', 1) or {}).items():
+        add('probe', band, 'probe', data)
+    rfmap, bounds = get('rfmap') or ({}, None)
+    for sub, data in rfmap.items():
+        add('probe', f'RF Map - {sub}', 'probe', data)
+
+    add('line', 'Firing Rate', 'line', get('line_fr_amp', 0))
+    add('line', 'Amplitude', 'line', get('line_fr_amp', 1))
+
+    if slice_data:
+        for name, key in zip(SLICE_ORDER, ['hist_rd', 'hist_gr', 'ccf', 'label']):
+            add('slice', name, 'slice', {'img': slice_data[key], 'scale': slice_data['scale'],
+                                         'offset': slice_data['offset']})
+
+    return jobs
+
+
+def decimate_scatter(data):
+    """
+    Keep at most MAX_SCATTER_POINTS points of a scatter plot, done before sending the plot to
+    the workers so that the full spike arrays are not copied to each process
+    """
+    if not data or data['x'].size <= MAX_SCATTER_POINTS:
+        return data
+    idx = np.linspace(0, data['x'].size - 1, MAX_SCATTER_POINTS).astype(np.int64)
+    data = dict(data)
+    for key in ['x', 'y', 'colours', 'amps']:
+        if key in data:
+            data[key] = data[key][idx]
+    if data['size'].ndim and data['size'].size == data['colours'].size:
+        data['size'] = data['size'][idx]
+    return data
+
+
+def _render_img(ax, data):
+    img = np.asarray(data['img'])
+    extent = [data['offset'][0], data['offset'][0] + data['scale'][0] * img.shape[0],
+              data['offset'][1], data['offset'][1] + data['scale'][1] * img.shape[1]]
+    levels = data.get('levels', [None, None])
+    return ax.imshow(np.swapaxes(img, 0, 1), origin='lower', extent=extent, aspect='auto',
+                     cmap=data.get('cmap', 'binary'), vmin=levels[0], vmax=levels[1],
+                     interpolation='nearest')
+
+
+def _render_scatter(ax, data):
+    if 'lut' in data:
+        colours = data['lut'][data['colours']] / 255
+        size = data['size'][data['colours']] if data['size'].size == len(data['lut']) \
+            else data['size']
+        mappable = matplotlib.cm.ScalarMappable(cmap=data['cmap'])
+    else:
+        mappable = matplotlib.cm.ScalarMappable(cmap=data['cmap'])
+        colours = mappable.cmap(np.nan_to_num(data['colours']))
+        size = data['size']
+    mappable.set_clim(data['levels'][0], data['levels'][1])
+    edge = 'none' if data['pen'] is None else data['pen']
+    ax.scatter(data['x'], data['y'], c=colours, s=np.asarray(size) ** 2, edgecolors=edge,
+               linewidths=0.5, rasterized=True)
+    ax.set_xlim(data['xrange'][0], data['xrange'][1])
+    return mappable
+
+
+def _render_probe(ax, data):
+    image = None
+    scales = data['scale']
+    offsets = data['offset']
+    for img, scale, offset in zip(data['img'], scales, offsets):
+        image = _render_img(ax, {'img': img, 'scale': scale, 'offset': offset,
+                                 'levels': data['levels'], 'cmap': data['cmap']})
+    ax.set_xlim(data['xrange'][0], data['xrange'][1])
+    return image
+
+
+def render_plot(kind, data, title, file=None):
+    """
+    Render a single plot offscreen with matplotlib. Run in worker processes by export_plots so
+    must not use Qt
+    :param kind: type of plot, 'img', 'scatter', 'probe', 'line' or 'slice'
+    :type kind: str
+    :param data: plot data as returned by PlotData
+    :type data: dict
+    :param title: title of plot
+    :type title: str
+    :param file: path to save png to, if None the plot is not saved
+    :type file: Path
+    :return: rendered plot
+    :type: np.array((height, width, 4)), np.uint8
+    """
+    size = {'img': IMG_SIZE, 'scatter': IMG_SIZE, 'probe': PROBE_SIZE, 'line': LINE_SIZE,
+            'slice': SLICE_SIZE}[kind]
+    fig = Figure(figsize=(size[0] / DPI, size[1] / DPI), dpi=DPI)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+
+    mappable = None
+    if kind == 'img':
+        mappable = _render_img(ax, data)
+        ax.set_xlim(data['xrange'][0], data['xrange'][1])
+    elif kind == 'scatter':
+        mappable = _render_scatter(ax, data)
+    elif kind == 'probe':
+        mappable = _render_probe(ax, data)
+    elif kind == 'line':
+        ax.plot(data['x'], data['y'], color='k', linewidth=2)
+        ax.set_xlim(data['xrange'][0], data['xrange'][1])
+    elif kind == 'slice':
+        img = data['img']
+        if img.ndim == 2:
+            data = dict(data, cmap='gray', levels=np.quantile(img, [0.01, 0.99]))
+        _render_img(ax, data)
+        ax.set_axis_off()
+
+    if kind != 'slice':
+        ax.set_ylim(DEPTH_RANGE[0], DEPTH_RANGE[1])
+        ax.set_xlabel(data.get('xaxis', ''))
+        if kind != 'probe':
+            ax.set_ylabel('Distance from probe tip (um)')
+    if mappable is not None:
+        fig.colorbar(mappable, ax=ax, orientation='horizontal', label=data.get('title', ''))
+    ax.set_title(title, fontsize=8, loc='left')
+
+    fig.tight_layout()
+    canvas.draw()
+    image = np.asarray(canvas.buffer_rgba()).copy()
+    if file is not None:
+        fig.savefig(file, dpi=DPI)
+
+    return image
+
+
+def export_plots(jobs, image_path, sess_info='', n_workers=None):
+    """
+    Render plots to png files in parallel worker processes
+    :param jobs: plots to render as returned by get_plot_jobs
+    :type jobs: list of tuple
+    :param image_path: folder to save plots in
+    :type image_path: Path
+    :param sess_info: prefix of file names
+    :type sess_info: str
+    :param n_workers: number of worker processes, defaults to number of cpu cores
+    :type n_workers: int
+    :return: rendered plots for each group, {group: {name: np.array}}
+    :type: dict
+    """
+    image_path = Path(image_path)
+    images = {}
+    # Spawn rather than fork, forking a process running Qt is not safe
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx) as executor:
+        futures = []
+        for group, name, kind, data in jobs:
+            file = image_path.joinpath(f'{sess_info}{group}_{name}.png')
+            futures.append((group, name, executor.submit(render_plot, kind, data, name, file)))
+        for group, name, future in futures:
+            try:
+                images.setdefault(group, {})[name] = future.result()
+            except Exception as err:
+                print(f'Could not export {group} {name}: {err}')
+
+    return images
@@ -1,7 +1,10 @@
+from concurrent.futures import ProcessPoolExecutor
 from ibllib.io import spikeglx
 import numpy as np
 import ibllib.dsp as dsp
 from scipy import signal
+import scipy.fft
+import functools
 from ibllib.misc import print_progress
 from pathlib import Path
 import alf.io as aio
@@ -14,54 +17,297 @@ _logger = logging.getLogger('ibllib')
 
 RMS_WIN_LENGTH_SECS = 3
 WELCH_WIN_LENGTH_SAMPLES = 1024
+# Number of windows processed by a worker process at a time
+WINDOWS_PER_TASK = 20
+# Fraction of windows processed when computing a preview of the QC maps
+PREVIEW_FRACTION = 0.05
 
 
-def rmsmap(fbin, spectra=True):
+def _window_generator(sglx):
+    rms_win_length_samples = 2 ** np.ceil(np.log2(sglx.fs * RMS_WIN_LENGTH_SECS))
+    # the window generator will generates window indices
+    return dsp.WindowGenerator(ns=sglx.ns, nswin=rms_win_length_samples, overlap=0)
+
+
+@functools.lru_cache(maxsize=8)
+def _hp_taper(ns, fs):
+    """
+    Frequency response of the high pass filter removing noise below 1 Hz, as used by dsp.hp
+    """
+    f = scipy.fft.rfftfreq(ns, 1 / fs)
+    return dsp.fcn_cosine([0, 1])(f).astype(np.float32)
+
+
+@functools.lru_cache(maxsize=8)
+def _parseval_weights(ns):
+    """
+    Weights of the one sided spectrum bins such that the weighted sum of the squared spectrum
+    divided by ns is the sum of squares of the signal
+    """
+    weights = np.full(ns // 2 + 1, 2, dtype=np.float32)
+    weights[0] = 1
+    if ns % 2 == 0:
+        weights[-1] = 1
+    return weights
+
+
+@functools.lru_cache(maxsize=2)
+def _welch_window(fs):
+    """
+    Hann window of welch segments and the scale of the spectral density
     """
-    Computes RMS map in time domain and spectra for each channel of Neuropixel probe
+    window = signal.get_window('hann', WELCH_WIN_LENGTH_SAMPLES).astype(np.float32)
+    return window, 1 / (fs * np.sum(window.astype(np.float64) ** 2))
 
+
+def rms_psd(D, fs, spectra=True):
+    """
+    High pass filters a window of data above 1 Hz and computes the RMS and the Welch spectral
+    density of the filtered data, in a single pass in single precision. The RMS is computed from
+    the filtered spectrum (Parseval) so the filtered signal is only transformed back if spectra
+    are needed, its Welch segments of all channels are then transformed in one batched FFT.
+    Equivalent to dsp.rms(dsp.hp(D, 1 / fs, [0, 1])) and to scipy.signal.welch with a hann
+    window of WELCH_WIN_LENGTH_SAMPLES samples, half overlap and constant detrending
+
+    :param D: data of a window
+    :type D: np.array((nc, ns))
+    :param fs: sampling frequency
+    :type fs: float
+    :param spectra: whether to compute the spectral density, needs at least
+     WELCH_WIN_LENGTH_SAMPLES samples
+    :type spectra: bool
+    :return: rms of each channel and spectral density of each channel, None if not spectra
+    :type: np.array(nc), np.array((nc, WELCH_WIN_LENGTH_SAMPLES // 2 + 1))
+    """
+    ns = D.shape[1]
+    X = scipy.fft.rfft(np.ascontiguousarray(D, dtype=np.float32), axis=-1)
+    X *= _hp_taper(ns, fs)
+    power = np.abs(X)
+    np.square(power, out=power)
+    rms = np.sqrt((power @ _parseval_weights(ns)).astype(np.float64)) / ns
+    if not spectra:
+        return rms, None
+
+    x = scipy.fft.irfft(X, n=ns, axis=-1)
+    del X, power
+    nperseg = WELCH_WIN_LENGTH_SAMPLES
+    segments = np.lib.stride_tricks.sliding_window_view(x, nperseg, axis=-1)[:, ::nperseg // 2]
+    segments = segments - np.mean(segments, axis=-1, keepdims=True)
+    window, scale = _welch_window(fs)
+    segments *= window
+    S = np.abs(scipy.fft.rfft(segments, axis=-1))
+    np.square(S, out=S)
+    psd = np.mean(S, axis=1, dtype=np.float64) * scale
+    # one sided density, the power at frequencies other than 0 and nyquist is doubled
+    psd[:, 1:-1] *= 2
+    return rms, psd
+
+
+def _rmsmap_windows(fbin, windows, spectra=True):
+    """
+    Computes the RMS and sum of spectra of a subset of windows of a recording, run in worker
+    processes by rmsmap
+
+    :param fbin: binary file in spike glx format
+    :type fbin: pathlib.Path
+    :param windows: sorted indices of windows to process
+    :type windows: np.array
+    :param spectra: whether to compute the power spectrum
+    :type: bool
+    :return: windows, rms of each window, number of samples of each window and sum of the
+     spectra of the windows
+    """
+    sglx = spikeglx.Reader(fbin)
+    firstlast = list(_window_generator(sglx).firstlast)
+    trms = np.zeros((len(windows), sglx.nc))
+    nsamples = np.zeros((len(windows),))
+    spectral_density = np.zeros((WELCH_WIN_LENGTH_SAMPLES // 2 + 1, sglx.nc))
+    for i, iw in enumerate(windows):
+        first, last = firstlast[iw]
+        D = sglx.read_samples(first_sample=first, last_sample=last)[0].transpose()
+        # the last window may be smaller than what is needed for welch
+        trms[i, :], w = rms_psd(D, sglx.fs,
+                                spectra=spectra and last - first >= WELCH_WIN_LENGTH_SAMPLES)
+        nsamples[i] = D.shape[1]
+        if w is not None:
+            spectral_density += w.T
+    return windows, trms, nsamples, spectral_density
+
+
+def select_windows(nwin, fraction=PREVIEW_FRACTION, sampling='even', seed=None):
+    """
+    Subset of windows of a recording used to compute a preview of the QC maps
+
+    :param nwin: number of windows in recording
+    :type nwin: int
+    :param fraction: fraction of windows to select
+    :type fraction: float
+    :param sampling: 'even' for windows evenly spread across the recording or 'random'
+    :type sampling: str
+    :param seed: seed of random sampling
+    :type seed: int
+    :return: sorted indices of windows
+    :type: np.array
+    """
+    n = int(np.clip(np.ceil(nwin * fraction), 1, nwin))
+    if sampling == 'even':
+        return np.unique(np.round(np.linspace(0, nwin - 1, n)).astype(int))
+    elif sampling == 'random':
+        return np.sort(np.random.default_rng(seed).choice(nwin, n, replace=False))
+    raise ValueError(f"sampling must be 'even' or 'random', not {sampling}")
+
+
+def _spectra_scale(lengths, processed):
+    """
+    Factor scaling the sum of the spectra of the processed windows to the sum over all windows
+    """
+    welch = lengths >= WELCH_WIN_LENGTH_SAMPLES
+    n_processed = np.sum(welch & processed)
+    return np.sum(welch) / n_processed if n_processed else 1
+
+
+def submit_rmsmap(executor, fbin, spectra=True, windows=None, previous=None):
+    """
+    Splits a recording into ranges of windows and submits them to a process pool, so that
+    several recordings (e.g the AP and LF files) can be processed by the same pool at the same
+    time. Results are gathered with gather_rmsmap
+
+    :param executor: process pool
+    :type executor: concurrent.futures.ProcessPoolExecutor
     :param fbin: binary file in spike glx format (will look for attached metatdata)
-    :type fbin: str or pathlib.Path
+    :type fbin: str or pathlib.Path or spikeglx.Reader
     :param spectra: whether to compute the power spectrum (only need for lfp data)
     :type: bool
-    :return: a dictionary with amplitudes in channeltime space, channelfrequency space, time
-     and frequency scales
+    :param windows: sorted indices of windows to process, defaults to all windows
+    :type windows: np.array
+    :param previous: output of a previous preview, as returned by load_rmsmap, whose windows
+     are not processed again
+    :type previous: dict
+    :return: pre-allocated output dictionary and futures of each range of windows
     """
-    if not isinstance(fbin, spikeglx.Reader):
-        sglx = spikeglx.Reader(fbin)
-    rms_win_length_samples = 2 ** np.ceil(np.log2(sglx.fs * RMS_WIN_LENGTH_SECS))
-    # the window generator will generates window indices
-    wingen = dsp.WindowGenerator(ns=sglx.ns, nswin=rms_win_length_samples, overlap=0)
+    sglx = fbin if isinstance(fbin, spikeglx.Reader) else spikeglx.Reader(fbin)
+    wingen = _window_generator(sglx)
     # pre-allocate output dictionary of numpy arrays
     win = {'TRMS': np.zeros((wingen.nwin, sglx.nc)),
            'nsamples': np.zeros((wingen.nwin,)),
            'fscale': dsp.fscale(WELCH_WIN_LENGTH_SAMPLES, 1 / sglx.fs, one_sided=True),
            'tscale': wingen.tscale(fs=sglx.fs)}
     win['spectral_density'] = np.zeros((len(win['fscale']), sglx.nc))
-    # loop through the whole session
-    for first, last in wingen.firstlast:
-        D = sglx.read_samples(first_sample=first, last_sample=last)[0].transpose()
-        # remove low frequency noise below 1 Hz
-        D = dsp.hp(D, 1 / sglx.fs, [0, 1])
-        iw = wingen.iw
-        win['TRMS'][iw, :] = dsp.rms(D)
-        win['nsamples'][iw] = D.shape[1]
+    win['lengths'] = np.array([last - first for first, last in wingen.firstlast])
+    # windows that have been processed
+    win['windows'] = np.zeros((wingen.nwin,), dtype=bool)
+    if previous is not None:
+        done = previous['windows']
+        win['TRMS'][done, :] = previous['TRMS'][done, :]
+        win['windows'][:] = done
         if spectra:
-            # the last window may be smaller than what is needed for welch
-            if last - first < WELCH_WIN_LENGTH_SAMPLES:
-                continue
-            # compute a smoothed spectrum using welch method
-            _, w = signal.welch(D, fs=sglx.fs, window='hanning', nperseg=WELCH_WIN_LENGTH_SAMPLES,
-                                detrend='constant', return_onesided=True, scaling='density',
-                                axis=-1)
-            win['spectral_density'] += w.T
-        # print at least every 20 windows
-        if (iw % min(20, max(int(np.floor(wingen.nwin / 75)), 1))) == 0:
-            print_progress(iw, wingen.nwin)
+            win['spectral_density'] = (previous['spectral_density'] /
+                                       _spectra_scale(win['lengths'], done))
+
+    windows = np.arange(wingen.nwin) if windows is None else np.asarray(windows, dtype=int)
+    n_tasks = max(int(np.ceil(windows.size / WINDOWS_PER_TASK)), 1)
+    futures = [executor.submit(_rmsmap_windows, Path(sglx.file_bin), task_windows, spectra)
+               for task_windows in np.array_split(windows, n_tasks) if task_windows.size]
+    return win, futures
+
+
+def gather_rmsmap(win, futures):
+    """
+    Merges the results of the ranges of windows submitted by submit_rmsmap, in window order. If
+    not all windows were processed the rms of missing windows is taken from the closest
+    processed window and the sum of spectra is scaled to the number of windows of the recording
+
+    :param win: pre-allocated output dictionary returned by submit_rmsmap
+    :param futures: futures returned by submit_rmsmap
+    :return: a dictionary with amplitudes in channeltime space, channelfrequency space, time
+     and frequency scales
+    """
+    for i, future in enumerate(futures):
+        windows, trms, nsamples, spectral_density = future.result()
+        win['TRMS'][windows, :] = trms
+        win['nsamples'][windows] = nsamples
+        win['spectral_density'] += spectral_density
+        win['windows'][windows] = True
+        print_progress(i + 1, len(futures))
+
+    processed = np.where(win['windows'])[0]
+    if processed.size and processed.size < win['windows'].size:
+        iw = np.arange(win['windows'].size)
+        right = np.clip(np.searchsorted(processed, iw), 0, processed.size - 1)
+        left = np.clip(right - 1, 0, processed.size - 1)
+        closest = np.where(np.abs(processed[left] - iw) <= np.abs(processed[right] - iw),
+                           processed[left], processed[right])
+        win['TRMS'] = win['TRMS'][closest, :]
+        win['spectral_density'] *= _spectra_scale(win['lengths'], win['windows'])
     return win
 
 
-def extract_rmsmap(fbin, out_folder=None, spectra=True):
+def rmsmap(fbin, spectra=True, n_workers=None, windows=None, previous=None):
+    """
+    Computes RMS map in time domain and spectra for each channel of Neuropixel probe. The
+    recording is split into ranges of windows that are processed in parallel
+
+    :param fbin: binary file in spike glx format (will look for attached metatdata)
+    :type fbin: str or pathlib.Path or spikeglx.Reader
+    :param spectra: whether to compute the power spectrum (only need for lfp data)
+    :type: bool
+    :param n_workers: number of worker processes, defaults to the number of cpu cores
+    :type n_workers: int
+    :param windows: sorted indices of windows to process, defaults to all windows
+    :type windows: np.array
+    :param previous: output of a previous preview whose windows are not processed again
+    :type previous: dict
+    :return: a dictionary with amplitudes in channeltime space, channelfrequency space, time
+     and frequency scales and the windows that were processed
+    """
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        return gather_rmsmap(*submit_rmsmap(executor, fbin, spectra=spectra, windows=windows,
+                                            previous=previous))
+
+
+def save_rmsmap(rms, sglx, out_folder, spectra=True):
+    """
+    Saves the output of rmsmap as _iblqc_ephysTimeRms and _iblqc_ephysSpectralDensity ALF files
+    """
+    alf_object_time = f'_iblqc_ephysTimeRms{sglx.type.upper()}'
+    alf_object_freq = f'_iblqc_ephysSpectralDensity{sglx.type.upper()}'
+    # output ALF files, single precision with the optional label as suffix before extension
+    if not out_folder.exists():
+        out_folder.mkdir()
+    tdict = {'rms': rms['TRMS'].astype(np.single), 'timestamps': rms['tscale'].astype(np.single),
+             'windows': rms['windows']}
+    aio.save_object_npy(out_folder, object=alf_object_time, dico=tdict)
+    if spectra:
+        fdict = {'power': rms['spectral_density'].astype(np.single),
+                 'freqs': rms['fscale'].astype(np.single)}
+        aio.save_object_npy(out_folder, object=alf_object_freq, dico=fdict)
+
+
+def load_rmsmap(out_folder, sglx, spectra=True):
+    """
+    Loads QC maps saved by save_rmsmap, used to refine a preview
+
+    :return: rms, spectra and windows processed, None if the files do not exist
+    :type: dict
+    """
+    alf_object_time = f'_iblqc_ephysTimeRms{sglx.type.upper()}'
+    alf_object_freq = f'_iblqc_ephysSpectralDensity{sglx.type.upper()}'
+    try:
+        previous = {'TRMS': np.load(out_folder.joinpath(alf_object_time + '.rms.npy'))}
+        if spectra:
+            previous['spectral_density'] = np.load(out_folder.joinpath(alf_object_freq +
+                                                                       '.power.npy'))
+    except Exception:
+        return None
+    windows_file = out_folder.joinpath(alf_object_time + '.windows.npy')
+    # Files saved without windows come from a full pass
+    previous['windows'] = np.load(windows_file) if windows_file.exists() else \
+        np.ones(previous['TRMS'].shape[0], dtype=bool)
+    return previous
+
+
+def extract_rmsmap(fbin, out_folder=None, spectra=True, n_workers=None, fraction=None,
+                   sampling='even', refine=False):
     """
     Wrapper for rmsmap that outputs _ibl_ephysRmsMap and _ibl_ephysSpectra ALF files
 
@@ -70,6 +316,15 @@ def extract_rmsmap(fbin, out_folder=None, spectra=True):
      the `fbin` file lives.
     :param spectra: whether to compute the power spectrum (only need for lfp data)
     :type: bool
+    :param n_workers: number of worker processes, defaults to the number of cpu cores
+    :type n_workers: int
+    :param fraction: if given only this fraction of windows is processed to get a quick preview,
+     the windows processed are saved in _iblqc_ephysTimeRms.windows
+    :type fraction: float
+    :param sampling: 'even' or 'random' selection of windows for a preview
+    :type sampling: str
+    :param refine: process the windows missing from a previously saved preview
+    :type refine: bool
     :return: None
     """
     _logger.info(f"Computing QC for {fbin}")
@@ -79,20 +334,24 @@ def extract_rmsmap(fbin, out_folder=None, spectra=True):
         out_folder = Path(fbin).parent
     else:
         out_folder = Path(out_folder)
-    alf_object_time = f'_iblqc_ephysTimeRms{sglx.type.upper()}'
-    alf_object_freq = f'_iblqc_ephysSpectralDensity{sglx.type.upper()}'
+
+    windows = None
+    previous = None
+    if refine:
+        previous = load_rmsmap(out_folder, sglx, spectra=spectra)
+        if previous is not None:
+            windows = np.where(~previous['windows'])[0]
+            if windows.size == 0:
+                _logger.info(f"QC for {fbin} already computed for all windows")
+                return
+    elif fraction is not None:
+        windows = select_windows(_window_generator(sglx).nwin, fraction, sampling)
+    if windows is not None:
+        _logger.info(f"Processing {windows.size} windows of {_window_generator(sglx).nwin}")
 
     # crunch numbers
-    rms = rmsmap(fbin, spectra=spectra)
-    # output ALF files, single precision with the optional label as suffix before extension
-    if not out_folder.exists():
-        out_folder.mkdir()
-    tdict = {'rms': rms['TRMS'].astype(np.single), 'timestamps': rms['tscale'].astype(np.single)}
-    aio.save_object_npy(out_folder, object=alf_object_time, dico=tdict)
-    if spectra:
-        fdict = {'power': rms['spectral_density'].astype(np.single),
-                 'freqs': rms['fscale'].astype(np.single)}
-        aio.save_object_npy(out_folder, object=alf_object_freq, dico=fdict)
+    rms = rmsmap(sglx, spectra=spectra, n_workers=n_workers, windows=windows, previous=previous)
+    save_rmsmap(rms, sglx, out_folder, spectra=spectra)
 
 
 def _sample2v(ap_file):
@@ -118,17 +377,35 @@ def ks2_to_alf(ks_path, bin_path, out_path, bin_file=None, ampfactor=1, label=No
     ac.convert(out_path, label=label, force=force, ampfactor=ampfactor)
 
 
-def extract_data(ks_path, ephys_path, out_path):
+def extract_data(ks_path, ephys_path, out_path, n_workers=None, fraction=None, sampling='even'):
+    """
+    Converts kilosort output to ALF and computes the raw data QC maps of the AP and LF files.
+    If fraction is given only a preview of the QC maps is computed, see extract_rmsmap
+    """
     efiles = spikeglx.glob_ephys_files(ephys_path)
+    out_path = Path(out_path)
+
+    # The AP and LF files are processed by the same pool at the same time, while the kilosort
+    # output is converted in this process
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        jobs = []
+        for efile in efiles:
+            for key, spectra in zip(['ap', 'lf'], [False, True]):
+                if efile.get(key) and efile[key].exists():
+                    _logger.info(f"Computing QC for {efile[key]}")
+                    sglx = spikeglx.Reader(efile[key])
+                    windows = None if fraction is None else \
+                        select_windows(_window_generator(sglx).nwin, fraction, sampling)
+                    jobs.append((sglx, spectra, submit_rmsmap(executor, sglx, spectra=spectra,
+                                                              windows=windows)))
 
-    for efile in efiles:
-        if efile.get('ap') and efile.ap.exists():
-            ks2_to_alf(ks_path, ephys_path, out_path, bin_file=efile.ap,
-                       ampfactor=_sample2v(efile.ap), label=None, force=True)
+        for efile in efiles:
+            if efile.get('ap') and efile.ap.exists():
+                ks2_to_alf(ks_path, ephys_path, out_path, bin_file=efile.ap,
+                           ampfactor=_sample2v(efile.ap), label=None, force=True)
 
-            extract_rmsmap(efile.ap, out_folder=out_path, spectra=False)
-        if efile.get('lf') and efile.lf.exists():
-            extract_rmsmap(efile.lf, out_folder=out_path)
+        for sglx, spectra, (win, futures) in jobs:
+            save_rmsmap(gather_rmsmap(win, futures), sglx, out_path, spectra=spectra)
 
 
 # if __name__ == '__main__':
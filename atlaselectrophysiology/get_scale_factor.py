@@ -12,11 +12,11 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
-import ibllib.atlas as atlas
+from atlas_provider import get_atlas
 
 
 # Instantiate brain atlas and one
-brain_atlas = atlas.AllenAtlas(25)
+brain_atlas = get_atlas(25)
 one = ONE()
 
 # Find eid of interest
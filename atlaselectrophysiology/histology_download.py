@@ -0,0 +1,150 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import base64
+import hashlib
+import os
+import re
+import requests
+
+# Size of chunks streamed to disk
+CHUNK_SIZE = 2 ** 20
+# Number of files downloaded at the same time
+N_DOWNLOADS = 4
+# Suffix of files being downloaded
+PART_SUFFIX = '.part'
+
+
+def list_files(url, extension='.tif', auth=None):
+    """
+    Files with a given extension in an HTTP directory listing
+    :param url: url of directory
+    :type url: str
+    :param extension: extension of files
+    :type extension: str
+    :param auth: (username, password)
+    :type auth: tuple
+    :return: file names in order of listing
+    :type: list of str
+    """
+    r = requests.get(url, auth=auth)
+    r.raise_for_status()
+    return parse_listing(r.text, extension)
+
+
+def parse_listing(text, extension='.tif'):
+    """
+    Files with a given extension in the html of an HTTP directory listing
+    """
+    files = []
+    for line in text.splitlines():
+        result = re.findall(f'href="(.*){re.escape(extension)}"', line)
+        if result:
+            files.append(result[0] + extension)
+    return files
+
+
+def md5(file):
+    hash_md5 = hashlib.md5()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+
+def _is_valid(file, size=None, checksum=None):
+    """
+    Whether a downloaded file is complete, it must have the size announced by the server and
+    match the checksum if one is known
+    """
+    file = Path(file)
+    if not file.exists() or (size is not None and file.stat().st_size != size):
+        return False
+    return checksum is None or md5(file) == checksum
+
+
+def _header_checksum(headers):
+    """
+    md5 sent by the server in the Content-MD5 header, None if not sent
+    """
+    if 'Content-MD5' not in headers:
+        return None
+    try:
+        return base64.b64decode(headers['Content-MD5']).hex()
+    except Exception:
+        return None
+
+
+def download_file(url, file, auth=None, checksum=None):
+    """
+    Download a file, resuming a previous partial download if there is one. Nothing is downloaded
+    if the file already exists and is valid
+    :param url: url of file
+    :type url: str
+    :param file: path to save file to
+    :type file: Path
+    :param auth: (username, password)
+    :type auth: tuple
+    :param checksum: expected md5 of the file, if None the md5 sent by the server is used if
+    there is one, otherwise the file is only checked against its size
+    :type checksum: str
+    :return: path to file
+    :type: Path
+    """
+    file = Path(file)
+    head = requests.head(url, auth=auth, allow_redirects=True)
+    head.raise_for_status()
+    size = int(head.headers['Content-Length']) if 'Content-Length' in head.headers else None
+    checksum = checksum or _header_checksum(head.headers)
+    if _is_valid(file, size, checksum):
+        return file
+
+    part_file = Path(str(file) + PART_SUFFIX)
+    offset = part_file.stat().st_size if part_file.exists() else 0
+    if size is not None and offset > size:
+        offset = 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    with requests.get(url, auth=auth, headers=headers, stream=True) as r:
+        if r.status_code == 416:
+            # Range not satisfiable, the partial file is already complete
+            pass
+        else:
+            r.raise_for_status()
+            # Servers that do not support ranges send the whole file
+            mode = 'ab' if offset and r.status_code == 206 else 'wb'
+            with open(part_file, mode) as f:
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+
+    if not _is_valid(part_file, size, checksum):
+        part_file.unlink()
+        raise IOError(f'Downloaded file {file.name} is corrupted, download it again')
+    os.replace(part_file, file)
+    return file
+
+
+def download_files(url, files, cache_dir, auth=None, checksums=None, n_workers=N_DOWNLOADS):
+    """
+    Download files of a directory concurrently
+    :param url: url of directory
+    :type url: str
+    :param files: names of files to download
+    :type files: list of str
+    :param cache_dir: folder to save files in
+    :type cache_dir: Path
+    :param auth: (username, password)
+    :type auth: tuple
+    :param checksums: expected md5 of each file
+    :type checksums: list of str
+    :param n_workers: number of concurrent downloads
+    :type n_workers: int
+    :return: paths to files, in the same order as files
+    :type: list of Path
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(exist_ok=True, parents=True)
+    checksums = checksums or [None] * len(files)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(download_file, url.rstrip('/') + '/' + file,
+                                   cache_dir.joinpath(file), auth, checksum)
+                   for file, checksum in zip(files, checksums)]
+        return [future.result() for future in futures]
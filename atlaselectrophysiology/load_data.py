@@ -3,6 +3,7 @@ from datetime import datetime
 import ibllib.pipes.histology as histology
 from ibllib.ephys.neuropixel import SITES_COORDINATES
 import ibllib.atlas as atlas
+from atlas_provider import get_atlas
 from ibllib.qc.alignment_qc import AlignmentQC
 from oneibl.one import ONE
 from pathlib import Path
@@ -10,6 +11,9 @@ import alf.io
 import glob
 import os
 from atlaselectrophysiology.load_histology import download_histology_data, tif2nrrd
+from atlaselectrophysiology.slice_service import SliceService
+from atlaselectrophysiology.trajectory_index import TrajectoryIndex, get_index_file
+from atlaselectrophysiology.alyx_snapshot import AlyxSnapshot, get_snapshot_file
 
 ONE_BASE_URL = "https://alyx.internationalbrainlab.org"
 
@@ -17,7 +21,15 @@ ONE_BASE_URL = "https://alyx.internationalbrainlab.org"
 class LoadData:
     def __init__(self, one=None, brain_atlas=None, testing=False, probe_id=None):
         self.one = one or ONE(base_url=ONE_BASE_URL)
-        self.brain_atlas = brain_atlas or atlas.AllenAtlas(25)
+        self.brain_atlas = brain_atlas or get_atlas(25)
+        # GUI lookups are answered from a local snapshot of alyx that is refreshed in the
+        # background. Tests always query alyx so that they see their own changes, and use an
+        # in memory snapshot so that the snapshot of the user is never read or written
+        if testing:
+            self.alyx = AlyxSnapshot(':memory:', self.one.alyx, refresh='always')
+        else:
+            self.alyx = AlyxSnapshot(get_snapshot_file(self.one._par.BASE_URL), self.one.alyx)
+        self.slice_service = SliceService(self.brain_atlas)
 
         if testing:
             self.probe_id = probe_id
@@ -26,14 +38,14 @@ class LoadData:
         else:
             from atlaselectrophysiology import qc_table
             self.qc = qc_table.EphysQC()
-            self.brain_regions = self.one.alyx.rest('brain-regions', 'list')
+            self.brain_regions = self.alyx.rest('brain-regions', 'list')
             self.chn_coords = None
             self.chn_depths = None
 
         # Initialise all variables that get assigned
         self.sess_with_hist = None
-        self.traj_ids = None
-        self.traj_coords = None
+        self.traj_index = None
+        self.sess_by_traj = None
         self.subjects = None
         self.sess = None
         self.eid = None
@@ -52,8 +64,8 @@ class LoadData:
         self.alyx_str = None
 
         if probe_id is not None:
-            self.sess = self.one.alyx.rest('trajectories', 'list', provenance='Histology track',
-                                           probe_insertion=probe_id)
+            self.sess = self.alyx.rest('trajectories', 'list', provenance='Histology track',
+                                       probe_insertion=probe_id)
 
     def get_subjects(self):
         """
@@ -62,21 +74,18 @@ class LoadData:
         :type: list of strings
         """
         # All sessions that have a histology track
-        all_hist = self.one.alyx.rest('trajectories', 'list', provenance='Histology track')
+        all_hist = self.alyx.rest('trajectories', 'list', provenance='Histology track')
         # Some do not have tracing, exclude these ones
         self.sess_with_hist = [sess for sess in all_hist if sess['x'] is not None]
         self.subj_with_hist = [sess['session']['subject'] for sess in self.sess_with_hist]
 
-        # For all histology tracks find the trajectory and coordinates of active part (where
-        # electrodes are located). Used in get_nearby trajectories to find sessions close-by
-        # insertions
-        depths = np.arange(200, 4100, 20) / 1e6
-        trajectories = [atlas.Insertion.from_dict(sess) for sess in self.sess_with_hist]
-        self.traj_ids = [sess['id'] for sess in self.sess_with_hist]
-        self.traj_coords = np.empty((len(self.traj_ids), len(depths), 3))
-        for iT, traj in enumerate(trajectories):
-            self.traj_coords[iT, :] = (histology.interpolate_along_track
-                                       (np.vstack([traj.tip, traj.entry]), depths))
+        # Add the coordinates of the active part (where electrodes are located) of new histology
+        # tracks to the index used in get_nearby trajectories to find sessions close-by
+        # insertions. Tracks already in the persisted index are not recomputed
+        if self.traj_index is None:
+            self.traj_index = TrajectoryIndex(get_index_file())
+        self.traj_index.update(self.sess_with_hist)
+        self.sess_by_traj = {sess['id']: sess for sess in self.sess_with_hist}
 
         self.subjects = np.unique(self.subj_with_hist)
 
@@ -122,8 +131,8 @@ class LoadData:
     def get_previous_alignments(self):
 
         # Looks for any previous alignments
-        ephys_traj_prev = self.one.alyx.rest('trajectories', 'list', probe_insertion=self.probe_id,
-                                             provenance='Ephys aligned histology track')
+        ephys_traj_prev = self.alyx.rest('trajectories', 'list', probe_insertion=self.probe_id,
+                                         provenance='Ephys aligned histology track')
 
         if ephys_traj_prev:
             self.alignments = ephys_traj_prev[0]['json'] or {}
@@ -171,22 +180,20 @@ class LoadData:
         :type: list of float
         """
 
-        chosen_traj = self.traj_ids.index(self.traj_id)
-        avg_dist = np.mean(np.sqrt(np.sum((self.traj_coords - self.traj_coords[chosen_traj]) ** 2,
-                                          axis=2)), axis=1)
-        avg_dist_mlap = np.mean(np.sqrt(np.sum((self.traj_coords[:, :, 0:2] -
-                                                self.traj_coords[chosen_traj][:, 0:2]) ** 2,
-                                        axis=2)), axis=1)
-
-        closest_traj = np.argsort(avg_dist)
-        close_dist = avg_dist[closest_traj[0:10]] * 1e6
-        close_dist_mlap = avg_dist_mlap[closest_traj[0:10]] * 1e6
+        closest_traj, avg_dist = self.traj_index.query(self.traj_id, k=10)
+        traj_coords = self.traj_index.coords[closest_traj]
+        chosen_coords = self.traj_index.coords[self.traj_index.id2idx[self.traj_id]]
+        avg_dist_mlap = np.mean(np.sqrt(np.sum((traj_coords[:, :, 0:2] -
+                                                chosen_coords[:, 0:2]) ** 2, axis=2)), axis=1)
+        close_dist = avg_dist * 1e6
+        close_dist_mlap = avg_dist_mlap * 1e6
 
         close_sessions = []
-        for sess_idx in closest_traj[0:10]:
-            close_sessions.append((self.sess_with_hist[sess_idx]['session']['subject'] + ' ' +
-                                  self.sess_with_hist[sess_idx]['session']['start_time'][:10] +
-                                   ' ' + self.sess_with_hist[sess_idx]['probe_name']))
+        for traj_idx in closest_traj:
+            sess = self.sess_by_traj[self.traj_index.ids[traj_idx]]
+            close_sessions.append((sess['session']['subject'] + ' ' +
+                                   sess['session']['start_time'][:10] + ' ' +
+                                   sess['probe_name']))
 
         return close_sessions, close_dist, close_dist_mlap
 
@@ -253,7 +260,7 @@ class LoadData:
             print('Could not download alf data for this probe - gui will not work')
             return [None] * 4
 
-        sess = self.one.alyx.rest('sessions', 'read', id=self.eid)
+        sess = self.alyx.rest('sessions', 'read', id=self.eid)
         sess_notes = None
         if sess['notes']:
             sess_notes = sess['notes'][0]['text']
@@ -283,13 +290,26 @@ class LoadData:
         :return xyz_picks: 3D coordinates of points relative to bregma
         :type: np.array(n_picks, 3)
         """
-        insertion = self.one.alyx.rest('insertions', 'read', id=self.probe_id)
+        insertion = self.alyx.rest('insertions', 'read', id=self.probe_id)
         self.xyz_picks = np.array(insertion['json']['xyz_picks']) / 1e6
-        self.resolved = (insertion.get('json', {'temp': 0}).get('extended_qc', {'temp': 0}).
-                         get('alignment_resolved', False))
+        self.resolved = self.get_resolved(insertion)
 
         return self.xyz_picks
 
+    def get_resolved(self, insertion=None):
+        """
+        Whether the alignment of the probe insertion is resolved
+        :param insertion: insertion record, if None the insertion is read from alyx rather than
+        from the local snapshot, which may be older than a resolution by another user
+        :type insertion: dict
+        :return: resolved
+        :type: bool
+        """
+        if insertion is None:
+            insertion = self.alyx.rest('insertions', 'read', id=self.probe_id, cache=False)
+        return (insertion.get('json', {'temp': 0}).get('extended_qc', {'temp': 0}).
+                get('alignment_resolved', False))
+
     def get_slice_images(self, xyz_channels):
         # First see if the histology file exists before attempting to connect with FlatIron and
         # download
@@ -319,44 +339,7 @@ class LoadData:
                 hist_path_gr = files[0]
                 hist_path_rd = files[1]
 
-        index = self.brain_atlas.bc.xyz2i(xyz_channels)[:, self.brain_atlas.xyz2dims]
-        ccf_slice = self.brain_atlas.image[index[:, 0], :, index[:, 2]]
-        ccf_slice = np.swapaxes(ccf_slice, 0, 1)
-
-        label_slice = self.brain_atlas._label2rgb(self.brain_atlas.label[index[:, 0], :,
-                                                  index[:, 2]])
-        label_slice = np.swapaxes(label_slice, 0, 1)
-
-        width = [self.brain_atlas.bc.i2x(0), self.brain_atlas.bc.i2x(456)]
-        height = [self.brain_atlas.bc.i2z(index[0, 2]), self.brain_atlas.bc.i2z(index[-1, 2])]
-
-        if hist_path_rd:
-            hist_atlas_rd = atlas.AllenAtlas(hist_path=hist_path_rd)
-            hist_slice_rd = hist_atlas_rd.image[index[:, 0], :, index[:, 2]]
-            hist_slice_rd = np.swapaxes(hist_slice_rd, 0, 1)
-        else:
-            print('Could not find red histology image for this subject')
-            hist_slice_rd = np.copy(ccf_slice)
-
-        if hist_path_gr:
-            hist_atlas_gr = atlas.AllenAtlas(hist_path=hist_path_gr)
-            hist_slice_gr = hist_atlas_gr.image[index[:, 0], :, index[:, 2]]
-            hist_slice_gr = np.swapaxes(hist_slice_gr, 0, 1)
-        else:
-            print('Could not find green histology image for this subject')
-            hist_slice_gr = np.copy(ccf_slice)
-
-        slice_data = {
-            'hist_rd': hist_slice_rd,
-            'hist_gr': hist_slice_gr,
-            'ccf': ccf_slice,
-            'label': label_slice,
-            'scale': np.array([(width[-1] - width[0]) / ccf_slice.shape[0],
-                               (height[-1] - height[0]) / ccf_slice.shape[1]]),
-            'offset': np.array([width[0], height[0]])
-        }
-
-        return slice_data
+        return self.slice_service.get_slice_images(xyz_channels, hist_path_rd, hist_path_gr)
 
     def get_region_description(self, region_idx):
         struct_idx = np.where(self.allen_id == region_idx)[0][0]
@@ -375,6 +358,9 @@ class LoadData:
         return description, region_lookup
 
     def upload_data(self, xyz_channels, channels=True):
+        # Check the latest state of the insertion so that an alignment resolved by another user
+        # since it was loaded is never overwritten
+        self.resolved = self.get_resolved()
         if not self.resolved:
             channel_upload = True
             # Create new trajectory and overwrite previous one
@@ -398,6 +384,13 @@ class LoadData:
             else:
                 data = {key_info: [feature.tolist(), track.tolist()]}
 
+        # Alignments may have been read from the local snapshot, the changes of this alignment
+        # are applied to the latest ones so that alignments added or deleted by other users
+        # since are kept
+        ephys_traj = self.alyx.rest('trajectories', 'list', probe_insertion=self.probe_id,
+                                    provenance='Ephys aligned histology track', cache=False)
+        self.alignments = dict((ephys_traj[0]['json'] or {}) if ephys_traj else {})
+
         old_user = [key for key in self.alignments.keys() if user in key]
         # Only delete duplicated if trajectory is not resolved
         if len(old_user) > 0 and not self.resolved:
@@ -408,11 +401,10 @@ class LoadData:
 
     def update_json(self, json_data):
         # Get the new trajectory
-        ephys_traj = self.one.alyx.rest('trajectories', 'list', probe_insertion=self.probe_id,
-                                        provenance='Ephys aligned histology track')
+        ephys_traj = self.alyx.rest('trajectories', 'list', probe_insertion=self.probe_id,
+                                    provenance='Ephys aligned histology track', cache=False)
         patch_dict = {'json': json_data}
-        self.one.alyx.rest('trajectories', 'partial_update', id=ephys_traj[0]['id'],
-                           data=patch_dict)
+        self.alyx.rest('trajectories', 'partial_update', id=ephys_traj[0]['id'], data=patch_dict)
 
     def upload_dj(self, align_qc, ephys_qc, ephys_desc):
         # Upload qc results to datajoint table
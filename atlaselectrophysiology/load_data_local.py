@@ -1,6 +1,8 @@
 import numpy as np
 from datetime import datetime
 import ibllib.atlas as atlas
+from atlas_provider import get_atlas
+from atlaselectrophysiology.slice_service import SliceService
 from pathlib import Path
 import alf.io
 import glob
@@ -11,11 +13,11 @@ import json
 
 class LoadDataLocal:
     def __init__(self):
-        self.brain_atlas = atlas.AllenAtlas(25)
+        self.brain_atlas = get_atlas(25)
+        self.slice_service = SliceService(self.brain_atlas)
         self.folder_path = []
         self.chn_coords = []
         self.sess_path = []
-        self.brain_atlas = atlas.AllenAtlas(25)
 
     def get_info(self, folder_path):
         """
@@ -107,44 +109,7 @@ class LoadDataLocal:
         else:
             hist_path_gr = []
 
-        index = self.brain_atlas.bc.xyz2i(xyz_channels)[:, self.brain_atlas.xyz2dims]
-        ccf_slice = self.brain_atlas.image[index[:, 0], :, index[:, 2]]
-        ccf_slice = np.swapaxes(ccf_slice, 0, 1)
-
-        label_slice = self.brain_atlas._label2rgb(self.brain_atlas.label[index[:, 0], :,
-                                                  index[:, 2]])
-        label_slice = np.swapaxes(label_slice, 0, 1)
-
-        width = [self.brain_atlas.bc.i2x(0), self.brain_atlas.bc.i2x(456)]
-        height = [self.brain_atlas.bc.i2z(index[0, 2]), self.brain_atlas.bc.i2z(index[-1, 2])]
-
-        if hist_path_rd:
-            hist_atlas_rd = atlas.AllenAtlas(hist_path=hist_path_rd)
-            hist_slice_rd = hist_atlas_rd.image[index[:, 0], :, index[:, 2]]
-            hist_slice_rd = np.swapaxes(hist_slice_rd, 0, 1)
-        else:
-            print('Could not find red histology image for this subject')
-            hist_slice_rd = np.copy(ccf_slice)
-
-        if hist_path_gr:
-            hist_atlas_gr = atlas.AllenAtlas(hist_path=hist_path_gr)
-            hist_slice_gr = hist_atlas_gr.image[index[:, 0], :, index[:, 2]]
-            hist_slice_gr = np.swapaxes(hist_slice_gr, 0, 1)
-        else:
-            print('Could not find green histology image for this subject')
-            hist_slice_gr = np.copy(ccf_slice)
-
-        slice_data = {
-            'hist_rd': hist_slice_rd,
-            'hist_gr': hist_slice_gr,
-            'ccf': ccf_slice,
-            'label': label_slice,
-            'scale': np.array([(width[-1] - width[0]) / ccf_slice.shape[0],
-                               (height[-1] - height[0]) / ccf_slice.shape[1]]),
-            'offset': np.array([width[0], height[0]])
-        }
-
-        return slice_data
+        return self.slice_service.get_slice_images(xyz_channels, hist_path_rd, hist_path_gr)
 
     def get_region_description(self, region_idx):
         struct_idx = np.where(self.allen['id'] == region_idx)[0][0]
@@ -1,10 +1,15 @@
 
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 from pathlib import Path
+import os
 import requests
-import re
 from ibllib.io import params
-from oneibl.webclient import http_download_file
 import SimpleITK as sitk
+from atlaselectrophysiology.histology_download import parse_listing, download_files
+
+# Number of channels converted to nrrd at the same time
+N_CONVERT = 4
 
 
 def download_histology_data(subject, lab):
@@ -15,12 +20,13 @@ def download_histology_data(subject, lab):
         lab_temp = lab
 
     par = params.read('one_params')
+    auth = (par.HTTP_DATA_SERVER_LOGIN, par.HTTP_DATA_SERVER_PWD)
 
     try:
         FLAT_IRON_HIST_REL_PATH = Path('histology', lab_temp, subject,
                                        'downsampledStacks_25', 'sample2ARA')
         baseurl = (par.HTTP_DATA_SERVER + '/' + '/'.join(FLAT_IRON_HIST_REL_PATH.parts))
-        r = requests.get(baseurl, auth=(par.HTTP_DATA_SERVER_LOGIN, par.HTTP_DATA_SERVER_PWD))
+        r = requests.get(baseurl, auth=auth)
         r.raise_for_status()
     except Exception as err:
         print(err)
@@ -29,32 +35,19 @@ def download_histology_data(subject, lab):
             FLAT_IRON_HIST_REL_PATH = Path('histology', lab_temp, subject_rem,
                                            'downsampledStacks_25', 'sample2ARA')
             baseurl = (par.HTTP_DATA_SERVER + '/' + '/'.join(FLAT_IRON_HIST_REL_PATH.parts))
-            r = requests.get(baseurl, auth=(par.HTTP_DATA_SERVER_LOGIN, par.HTTP_DATA_SERVER_PWD))
+            r = requests.get(baseurl, auth=auth)
             r.raise_for_status()
         except Exception as err:
             print(err)
             path_to_nrrd = None
             return path_to_nrrd
 
-    tif_files = []
-    for line in r.text.splitlines():
-        result = re.findall('href="(.*).tif"', line)
-        if result:
-            tif_files.append(result[0] + '.tif')
+    tif_files = parse_listing(r.text, extension='.tif')
 
     CACHE_DIR = Path(Path.home(), 'Downloads', 'FlatIron', lab, 'Subjects', subject, 'histology')
-    CACHE_DIR.mkdir(exist_ok=True, parents=True)
-    path_to_files = []
-    for file in tif_files:
-        path_to_image = Path(CACHE_DIR, file)
-        if not path_to_image.exists():
-            url = (baseurl + '/' + file)
-            http_download_file(url, cache_dir=CACHE_DIR,
-                               username=par.HTTP_DATA_SERVER_LOGIN,
-                               password=par.HTTP_DATA_SERVER_PWD)
-
-        path_to_nrrd = tif2nrrd(path_to_image)
-        path_to_files.append(path_to_nrrd)
+    # Files already downloaded and complete are skipped, interrupted downloads are resumed
+    path_to_images = download_files(baseurl, tif_files, CACHE_DIR, auth=auth)
+    path_to_files = tifs2nrrd(path_to_images)
 
     if len(path_to_files) > 3:
         path_to_files = path_to_files[1:3]
@@ -63,19 +56,60 @@ def download_histology_data(subject, lab):
 
 
 def tif2nrrd(path_to_image):
+    """
+    Convert a histology tif stack to nrrd. The conversion is skipped if the nrrd file exists and
+    is more recent than the tif file, the nrrd is written to a temporary file first so that an
+    existing nrrd file is always complete
+    :param path_to_image: path to tif file
+    :type path_to_image: Path
+    :return: path to nrrd file
+    :type: Path
+    """
     path_to_nrrd = Path(path_to_image.parent, path_to_image.parts[-1][:-3] + 'nrrd')
-    if not path_to_nrrd.exists():
-        reader = sitk.ImageFileReader()
-        reader.SetImageIO("TIFFImageIO")
-        reader.SetFileName(str(path_to_image))
-        img = reader.Execute()
-
-        new_img = sitk.PermuteAxes(img, [2, 1, 0])
-        new_img = sitk.Flip(new_img, [True, False, False])
-        new_img.SetSpacing([1, 1, 1])
-        writer = sitk.ImageFileWriter()
-        writer.SetImageIO("NrrdImageIO")
-        writer.SetFileName(str(path_to_nrrd))
-        writer.Execute(new_img)
+    if path_to_nrrd.exists() and \
+            os.stat(path_to_nrrd).st_mtime_ns >= os.stat(path_to_image).st_mtime_ns:
+        return path_to_nrrd
+
+    reader = sitk.ImageFileReader()
+    reader.SetImageIO("TIFFImageIO")
+    reader.SetFileName(str(path_to_image))
+    img = reader.Execute()
+
+    new_img = sitk.PermuteAxes(img, [2, 1, 0])
+    new_img = sitk.Flip(new_img, [True, False, False])
+    new_img.SetSpacing([1, 1, 1])
+    tmp_nrrd = Path(path_to_nrrd.parent, path_to_nrrd.stem + '.tmp.nrrd')
+    writer = sitk.ImageFileWriter()
+    writer.SetImageIO("NrrdImageIO")
+    writer.SetFileName(str(tmp_nrrd))
+    writer.Execute(new_img)
+    os.replace(tmp_nrrd, path_to_nrrd)
 
     return path_to_nrrd
+
+
+def tifs2nrrd(path_to_images, n_workers=N_CONVERT):
+    """
+    Convert histology tif stacks to nrrd in parallel worker processes
+    :param path_to_images: paths to tif files
+    :type path_to_images: list of Path
+    :param n_workers: number of worker processes
+    :type n_workers: int
+    :return: paths to nrrd files, in the same order as path_to_images
+    :type: list of Path
+    """
+    path_to_images = [Path(path) for path in path_to_images]
+    path_to_nrrds = [Path(path.parent, path.parts[-1][:-3] + 'nrrd') for path in path_to_images]
+    to_convert = [path for path, nrrd in zip(path_to_images, path_to_nrrds)
+                  if not nrrd.exists() or
+                  os.stat(nrrd).st_mtime_ns < os.stat(path).st_mtime_ns]
+    if len(to_convert) > 1:
+        # Spawn rather than fork, forking a process running Qt is not safe
+        ctx = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(to_convert)),
+                                 mp_context=ctx) as executor:
+            list(executor.map(tif2nrrd, to_convert))
+    elif to_convert:
+        tif2nrrd(to_convert[0])
+
+    return path_to_nrrds
@@ -0,0 +1,184 @@
+from pathlib import Path
+import functools
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+import numpy as np
+
+# Increment whenever the output of a cached PlotData method changes so that old results are
+# not reused
+CACHE_VERSION = 1
+CACHE_FOLDER = 'plot_cache'
+
+
+def input_signature(files):
+    """
+    Cheap signature of the files a cache entry is derived from. Uses the file size and
+    modification time rather than a hash of the content, hashing the spike files of long
+    recordings takes about as long as recomputing the plots
+    :param files: paths to files
+    :type files: list of Path
+    :return: sorted list of [file name, size, mtime] for all files that exist
+    :type: list
+    """
+    signature = []
+    for file in files:
+        try:
+            stat = os.stat(file)
+        except OSError:
+            continue
+        signature.append([str(file), stat.st_size, stat.st_mtime_ns])
+    return sorted(signature)
+
+
+def _encode(data, arrays):
+    """
+    Splits a nested structure of dicts, lists and tuples into a json serialisable skeleton and a
+    dict of numpy arrays
+    """
+    if isinstance(data, np.ndarray):
+        if data.dtype.hasobject:
+            raise TypeError('object arrays can not be cached')
+        name = f'arr_{len(arrays)}'
+        arrays[name] = data
+        return {'__array__': name}
+    if isinstance(data, np.generic):
+        name = f'arr_{len(arrays)}'
+        arrays[name] = np.asarray(data)
+        return {'__array__': name, 'scalar': True}
+    if isinstance(data, dict):
+        if not all(isinstance(key, str) for key in data.keys()):
+            raise TypeError('only dicts with str keys can be cached')
+        return {'__dict__': {key: _encode(val, arrays) for key, val in data.items()}}
+    if isinstance(data, tuple):
+        return {'__tuple__': [_encode(val, arrays) for val in data]}
+    if isinstance(data, list):
+        return [_encode(val, arrays) for val in data]
+    if data is None or isinstance(data, (bool, int, float, str)):
+        return data
+    raise TypeError(f'{type(data)} can not be cached')
+
+
+def _decode(skeleton, arrays):
+    if isinstance(skeleton, list):
+        return [_decode(val, arrays) for val in skeleton]
+    if isinstance(skeleton, dict):
+        if '__array__' in skeleton:
+            data = arrays[skeleton['__array__']]
+            return data[()] if skeleton.get('scalar', False) else data
+        if '__tuple__' in skeleton:
+            return tuple(_decode(val, arrays) for val in skeleton['__tuple__'])
+        return {key: _decode(val, arrays) for key, val in skeleton['__dict__'].items()}
+    return skeleton
+
+
+class PlotCache:
+    def __init__(self, cache_path, signature):
+        """
+        Stores the output of PlotData methods as npz files so that they do not need to be
+        recomputed when an insertion is reopened
+        :param cache_path: folder to store cache files in
+        :type cache_path: Path
+        :param signature: signature of input files, results are only reused if the input
+        files have not changed
+        :type signature: list
+        """
+        self.cache_path = Path(cache_path)
+        self.signature = signature
+
+    def get_key(self, name, params):
+        """
+        Unique key for a method and its parameters
+        :param name: name of method
+        :type name: str
+        :param params: parameters that change the output of the method, must be json
+        serialisable
+        :type params: dict
+        :return: file name of cache entry
+        :type: str
+        """
+        key = json.dumps([CACHE_VERSION, name, params, self.signature], sort_keys=True,
+                         default=str)
+        return name + '_' + hashlib.sha1(key.encode()).hexdigest()[:16] + '.npz'
+
+    def load(self, key):
+        """
+        Load a cache entry
+        :param key: key returned by get_key
+        :type key: str
+        :return: cached data, None if not available
+        """
+        cache_file = self.cache_path.joinpath(key)
+        if not cache_file.exists():
+            return None
+        try:
+            with np.load(cache_file, allow_pickle=False) as npz:
+                arrays = {name: npz[name] for name in npz.files}
+            skeleton = json.loads(str(arrays.pop('__skeleton__')))
+            return {'data': _decode(skeleton, arrays)}
+        except Exception:
+            print(f'could not read plot cache {cache_file}, will recompute')
+            return None
+
+    def save(self, key, data):
+        """
+        Save a cache entry. The file is written to a temporary file first so that a cache entry
+        is never partially written
+        :param key: key returned by get_key
+        :type key: str
+        :param data: output of method, nested dicts, lists and tuples of arrays and scalars
+        """
+        try:
+            arrays = {}
+            skeleton = _encode(data, arrays)
+            arrays['__skeleton__'] = np.array(json.dumps(skeleton))
+            os.makedirs(self.cache_path, exist_ok=True)
+            fd, tmp_file = tempfile.mkstemp(dir=self.cache_path, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_file, self.cache_path.joinpath(key))
+        except Exception as err:
+            print(f'could not save {key} to plot cache: {err}')
+
+
+def cache_plot(units=False, constants=()):
+    """
+    Decorator for PlotData methods whose output only depends on the input files, the method
+    arguments and, if units is True, the unit filter. Results are loaded from the PlotData cache
+    when available and saved to it otherwise
+    :param units: whether the output depends on the unit filter
+    :type units: bool
+    :param constants: values of module constants used by the method
+    :type constants: tuple
+    """
+    def decorator(func):
+        sig = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            cache = getattr(self, 'cache', None)
+            if cache is None:
+                return func(self, *args, **kwargs)
+
+            bound = sig.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            params = dict(bound.arguments)
+            params.pop('self')
+            params['constants'] = constants
+            if units:
+                # Name of the filter whose spikes the method reads, the filter is pinned to the
+                # thread (see PlotData.with_filter) so the key always matches the data
+                params['filter'] = self.filter_type
+            key = cache.get_key(func.__name__, params)
+
+            cached = cache.load(key)
+            if cached is not None:
+                return cached['data']
+            data = func(self, *args, **kwargs)
+            cache.save(key, data)
+            return data
+
+        return wrapper
+    return decorator
@@ -6,25 +6,195 @@ from brainbox.processing import bincount2D
 from brainbox.population.decode import xcorr
 from brainbox.task import passive
 import scipy
-from PyQt5 import QtGui
 import os
+import threading
+import functools
+from merge_provenance import MergeProvenance
+from atlaselectrophysiology.plot_cache import PlotCache, CACHE_FOLDER, cache_plot, \
+    input_signature
 
 N_BNK = 4
 BNK_SIZE = 10
+# Time and depth bins used for firing rate image and correlation image
+T_BIN = 0.05
+D_BIN = 5
+CORR_D_BIN = 40
+# Number of time bins binned at once when computing correlation image
+CORR_CHUNK_BINS = 20000
+# Depth bin used for firing rate and amplitude lines
+LINE_D_BIN = 10
 AUTOCORR_BIN_SIZE = 0.25 / 1000
 AUTOCORR_WIN_SIZE = 10 / 1000
 FS = 30000
 np.seterr(divide='ignore', invalid='ignore')
 
 
+def decimate_points(x, y, xlim, ylim, n_x, n_y):
+    """
+    Select a representative subset of points to display. The displayed range is divided into a
+    grid of n_x by n_y cells (typically a few screen pixels each) and in each cell only the first
+    point is kept. Points must therefore be ordered by priority, e.g. sorted by descending spike
+    amplitude to keep the largest spike in each cell or randomly shuffled to keep a random
+    spike. Points outside the displayed range are dropped
+    :param x: x coordinates of points, ordered by priority
+    :type x: np.array((npoints))
+    :param y: y coordinates of points, ordered by priority
+    :type y: np.array((npoints))
+    :param xlim: displayed x range
+    :type xlim: [float, float]
+    :param ylim: displayed y range
+    :type ylim: [float, float]
+    :param n_x: number of grid cells along x
+    :type n_x: int
+    :param n_y: number of grid cells along y
+    :type n_y: int
+    :return: indices of points to display
+    :type: np.array(int)
+    """
+    idx = np.flatnonzero((x >= xlim[0]) & (x <= xlim[1]) & (y >= ylim[0]) & (y <= ylim[1]))
+    if idx.size <= n_x * n_y / 4:
+        # Sparse enough to display everything
+        return idx
+
+    ix = np.clip(((x[idx] - xlim[0]) * (n_x / (xlim[1] - xlim[0]))).astype(np.int64), 0, n_x - 1)
+    iy = np.clip(((y[idx] - ylim[0]) * (n_y / (ylim[1] - ylim[0]))).astype(np.int64), 0, n_y - 1)
+    cell = ix * n_y + iy
+
+    # Assign points in reverse order so the first point of each cell is the one that remains
+    first = np.full(n_x * n_y, -1, dtype=np.int64)
+    first[cell[::-1]] = np.arange(cell.size - 1, -1, -1)
+    first = first[first >= 0]
+
+    return idx[first]
+
+
+def binned_corrcoef(times, depths, t_bin, d_bin, ylim, dtype=np.float32, chunk_bins=20000):
+    """
+    Equivalent of np.corrcoef(bincount2D(times, depths, t_bin, d_bin, ylim=ylim)[0]) that never
+    builds the full depth x time matrix. Spike counts are binned a chunk of time bins at a time
+    and the sums and cross products of each pair of depth bins are accumulated, memory only
+    depends on chunk_bins and the number of depth bins
+    :param times: spike times, sorted
+    :type times: np.array((nspikes))
+    :param depths: spike depths
+    :type depths: np.array((nspikes))
+    :param t_bin: time bin size
+    :type t_bin: float
+    :param d_bin: depth bin size
+    :type d_bin: float
+    :param ylim: depth limits
+    :type ylim: [float, float]
+    :param dtype: dtype of binned spike counts, float32 halves memory and doubles speed of the
+    cross products. Sums are always accumulated in float64
+    :type dtype: np.dtype
+    :param chunk_bins: number of time bins binned at once
+    :type chunk_bins: int
+    :return corr: correlation matrix
+    :type: np.array((ndepths, ndepths))
+    :return depth_scale: depth of bins, same as yscale returned by bincount2D
+    :type: np.array((ndepths))
+    """
+    if np.any(times[1:] < times[:-1]):
+        order = np.argsort(times, kind='stable')
+        times = times[order]
+        depths = depths[order]
+
+    # Same bins as brainbox.processing.bincount2D
+    xlim = [np.min(times), np.max(times)]
+    n_t = np.arange(xlim[0], xlim[1] + t_bin / 2, t_bin).size
+    depth_scale = np.arange(ylim[0], ylim[1] + d_bin / 2, d_bin)
+    n_d = depth_scale.size
+
+    def time_bin(t):
+        return np.floor((t - xlim[0]) / t_bin).astype(np.int64)
+
+    sums = np.zeros(n_d)
+    prods = np.zeros((n_d, n_d))
+    i0 = 0
+    for k0 in range(0, n_t, chunk_bins):
+        k1 = min(k0 + chunk_bins, n_t)
+        # Find the last spike of the chunk, adjusted so that spikes on the chunk edge are
+        # assigned to the same bin as bincount2D would
+        i1 = np.searchsorted(times, xlim[0] + k1 * t_bin)
+        while i1 < times.size and time_bin(times[i1]) < k1:
+            i1 += 1
+        while i1 > i0 and time_bin(times[i1 - 1]) >= k1:
+            i1 -= 1
+
+        t_ind = time_bin(times[i0:i1]) - k0
+        d_ind = np.floor((depths[i0:i1] - ylim[0]) / d_bin).astype(np.int64)
+        kp = (d_ind >= 0) & (d_ind < n_d) & (t_ind >= 0) & (t_ind < k1 - k0)
+        counts = np.bincount(d_ind[kp] * (k1 - k0) + t_ind[kp], minlength=n_d * (k1 - k0))
+        counts = counts.reshape(n_d, k1 - k0).astype(dtype)
+
+        sums += np.sum(counts, axis=1, dtype=np.float64)
+        prods += counts @ counts.T
+        i0 = i1
+
+    cov = (prods - np.outer(sums, sums) / n_t) / (n_t - 1)
+    std = np.sqrt(np.diag(cov))
+    corr = cov / np.outer(std, std)
+    np.clip(corr, -1, 1, out=corr)
+
+    return corr, depth_scale
+
+
+class FilteredSpikes:
+    def __init__(self, spikes, clust=None, valid=None, filter_type=None):
+        """
+        Contiguous times, depths, amps and clusters of the spikes that belong to a subset of
+        clusters. The subset is applied with a per cluster mask looked up with the spike
+        clusters, so only one filtered copy of each array is made. If no filtering is needed
+        the arrays of spikes are used directly
+        :param spikes: spikes object
+        :type spikes: alf.io.AlfBunch
+        :param clust: ids of clusters to keep, None to keep all clusters
+        :type clust: np.array(int)
+        :param valid: mask of spikes to keep regardless of cluster (e.g. no nan depths), None to
+        keep all spikes
+        :type valid: np.array(bool)
+        :param filter_type: name of the unit filter, used in the keys of cached plots
+        :type filter_type: str
+        """
+        self.filter_type = filter_type
+        if clust is None:
+            keep = valid
+        else:
+            n_clust = np.max(spikes['clusters']) + 1
+            clust = np.asarray(clust)
+            clust_mask = np.zeros(n_clust, dtype=bool)
+            clust_mask[clust[clust < n_clust]] = True
+            keep = clust_mask[spikes['clusters']]
+            if valid is not None:
+                keep &= valid
+
+        for attr in ['times', 'depths', 'amps', 'clusters']:
+            setattr(self, attr, spikes[attr] if keep is None else spikes[attr][keep])
+
+    @property
+    def size(self):
+        return self.times.size
+
+
 class PlotData:
-    def __init__(self, alf_path, ephys_path):
+    def __init__(self, alf_path, ephys_path, use_cache=True):
 
         self.alf_path = alf_path
         self.ephys_path = ephys_path
+        # Spikes of the current unit filter, and of the filter pinned by with_filter on each
+        # thread
+        self._filtered = None
+        self._pinned = threading.local()
+        self.cache = self.init_cache() if use_cache else None
+        # Index of spikes of each cluster and autocorrelograms of clusters, built on demand
+        self.clust_spike_order = None
+        self.clust_spike_offset = None
+        self.clust_index_lock = threading.Lock()
+        self.autocorrs = {}
 
         self.chn_coords = np.load(Path(self.alf_path, 'channels.localCoordinates.npy'))
         self.chn_ind = np.load(Path(self.alf_path, 'channels.rawInd.npy'))
+        self.init_channel_geometry()
         # See if spike data is available
         try:
             self.spikes = alf.io.load_object(self.alf_path, 'spikes')
@@ -84,8 +254,7 @@ class PlotData:
         try:
             self.aud_stim = alf.io.load_object(self.alf_path.parent, object='passiveStims',
                                                namespace='ibl')['table']
-            if len(self.aud_stim) > 0:
-                self.passive_data_status = True
+            self.passive_data_status = len(self.aud_stim) > 0
         except Exception:
             print('passive stim data was not found, some plots will not display')
             self.passive_data_status = False
@@ -103,26 +272,92 @@ class PlotData:
             print('passive gabor data was not found, some plots will not display')
             self.gabor_data_status = False
 
+    def init_cache(self):
+        """
+        Set up the on disk cache of plot data. Results are stored in the alf folder and are
+        reused as long as the spike, cluster, channel, qc and passive files they were computed
+        from have not changed
+        :return: cache
+        :type: PlotCache
+        """
+        alf_path = Path(self.alf_path)
+        files = []
+        for obj in ['spikes', 'clusters', 'channels']:
+            files += alf_path.glob(obj + '.*')
+        files += Path(self.ephys_path).glob('_iblqc_*')
+        files += alf_path.parent.glob('_ibl_passive*')
+        files.append(alf_path.parent.parent.joinpath('raw_passive_data',
+                                                     '_iblrig_RFMapStim.raw.bin'))
+        files += [alf_path.parent.joinpath('ks_matlab', f) for f in
+                  ['cluster_group.tsv', 'spike_clusters.npy', 'spike_templates.npy']]
+
+        return PlotCache(alf_path.joinpath(CACHE_FOLDER), input_signature(files))
+
+    @property
+    def filtered(self):
+        """
+        Spikes of the unit filter pinned to the current thread with with_filter, or of the
+        current unit filter
+        :type: FilteredSpikes
+        """
+        pinned = getattr(self._pinned, 'filtered', None)
+        return pinned if pinned is not None else self._filtered
+
+    @filtered.setter
+    def filtered(self, filtered):
+        self._filtered = filtered
+
+    @property
+    def filter_type(self):
+        return getattr(self.filtered, 'filter_type', None)
+
+    def with_filter(self, func):
+        """
+        Bind a function to the current unit filter. The returned function runs func with
+        self.filtered pinned to the spikes of the filter at the time with_filter was called, so
+        that a plot computed on a worker thread uses, and is cached under, a single filter even
+        if filter_units is called while it runs
+        :param func: function to run, e.g. a PlotData method
+        :type func: callable
+        :return: bound function
+        :type: callable
+        """
+        filtered = self._filtered
+
+        @functools.wraps(func)
+        def run(*args, **kwargs):
+            previous = getattr(self._pinned, 'filtered', None)
+            self._pinned.filtered = filtered
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._pinned.filtered = previous
+
+        return run
+
     def filter_units(self, type):
+        """
+        Restrict spikes used for plots to spikes from clusters of a given type. Only the spikes
+        for the current filter are kept in memory
+        :param type: type of clusters to keep, 'all', 'KS good', 'KS mua', 'IBL good' or
+        'Phy good'
+        :type type: str
+        """
         if type == 'all':
-            self.spike_idx = np.arange(self.spikes['clusters'].size)
+            clust = None
 
         elif type == 'KS good':
-            clust = np.where(self.clusters.metrics.ks2_label == 'good')
-            self.spike_idx = np.where(np.isin(self.spikes['clusters'], clust))[0]
+            clust = np.where(self.clusters.metrics.ks2_label == 'good')[0]
 
         elif type == 'KS mua':
-            clust = np.where(self.clusters.metrics.ks2_label == 'mua')
-            self.spike_idx = np.where(np.isin(self.spikes['clusters'], clust))[0]
+            clust = np.where(self.clusters.metrics.ks2_label == 'mua')[0]
 
         elif type == 'IBL good':
             try:
-                clust = np.where(self.clusters.metrics.label == 1)
-                self.spike_idx = np.where(np.isin(self.spikes['clusters'], clust))[0]
+                clust = np.where(self.clusters.metrics.label == 1)[0]
             except Exception:
                 print('IBL metrics not implemented will return ks good units instead')
-                clust = np.where(self.clusters.metrics.ks2_label == 'good')
-                self.spike_idx = np.where(np.isin(self.spikes['clusters'], clust))[0]
+                clust = np.where(self.clusters.metrics.ks2_label == 'good')[0]
 
         # XXX: adam
         elif type == 'Phy good':
@@ -131,11 +366,28 @@ class PlotData:
             group_file = open(os.path.join(phy_dir, 'cluster_group.tsv'))
             cluster_group = np.loadtxt(group_file, dtype=str, delimiter='\t', skiprows=1)
             clust = cluster_group[cluster_group[:, 1] == 'good', 0].astype(np.int32)
-            self.spike_idx = np.where(np.isin(self.spikes['clusters'], clust))[0]
-
-        # Filter for nans in depths and also in amps
-        self.kp_idx = np.where(~np.isnan(self.spikes['depths'][self.spike_idx]) &
-                               ~np.isnan(self.spikes['amps'][self.spike_idx]))[0]
+            # Clusters merged or split in phy have new ids, map them to the original clusters
+            # of the alf spikes with the provenance of the phy spike clusters
+            provenance = MergeProvenance.from_folder(phy_dir, 'spike_clusters.npy',
+                                                     'spike_templates.npy')
+            if provenance is not None:
+                clust = provenance.templates_of(clust)
+
+        # The new spikes are built before they replace the previous ones in a single assignment,
+        # plots computed on worker threads always see a complete FilteredSpikes
+        self.filtered = FilteredSpikes(self.spikes, clust, valid=self.get_valid_spikes(),
+                                       filter_type=type)
+
+    def get_valid_spikes(self):
+        """
+        Spikes that have a depth and amplitude, computed once and reused for all filters
+        :return: mask of valid spikes, None if all spikes are valid
+        :type: np.array(bool) or None
+        """
+        if not hasattr(self, '_valid_spikes'):
+            valid = ~np.isnan(self.spikes['depths']) & ~np.isnan(self.spikes['amps'])
+            self._valid_spikes = None if np.all(valid) else valid
+        return self._valid_spikes
 
 # Plots that require spike and cluster data
     def get_depth_data_scatter(self):
@@ -143,46 +395,41 @@ class PlotData:
             data_scatter = None
             return data_scatter
         else:
+            spikes = self.filtered
             A_BIN = 10
-            amp_range = np.quantile(self.spikes['amps'][self.spike_idx][self.kp_idx], [0, 0.9])
+            amp_range = np.quantile(spikes.amps, [0, 0.9])
             amp_bins = np.linspace(amp_range[0], amp_range[1], A_BIN)
             colour_bin = np.linspace(0.0, 1.0, A_BIN + 1)
-            colours = (cm.get_cmap('BuPu')(colour_bin)[np.newaxis, :, :3][0]) * 255
-            spikes_colours = np.empty(self.spikes['amps'][self.spike_idx][self.kp_idx].size,
-                                      dtype=object)
-            spikes_size = np.empty(self.spikes['amps'][self.spike_idx][self.kp_idx].size)
-            for iA in range(amp_bins.size):
-                if iA == (amp_bins.size - 1):
-                    idx = np.where((self.spikes['amps'][self.spike_idx][self.kp_idx] >
-                                    amp_bins[iA]))[0]
-                    # Make saturated spikes a very dark purple
-                    spikes_colours[idx] = QtGui.QColor('#400080')
-                else:
-                    idx = np.where((self.spikes['amps'][self.spike_idx][self.kp_idx] >
-                                    amp_bins[iA]) &
-                                   (self.spikes['amps'][self.spike_idx][self.kp_idx] <=
-                                    amp_bins[iA + 1]))[0]
-
-                    spikes_colours[idx] = QtGui.QColor(*colours[iA])
-
-                spikes_size[idx] = iA / (A_BIN / 4)
-
+            # Lookup table of colours for each amplitude bin, spikes are assigned the index of
+            # their bin rather than a colour
+            colour_lut = np.full((A_BIN, 4), 255, dtype=np.uint8)
+            colour_lut[:, :3] = cm.get_cmap('BuPu')(colour_bin[:A_BIN])[:, :3] * 255
+            # Make saturated spikes a very dark purple
+            colour_lut[-1, :3] = [0x40, 0x00, 0x80]
+            size_lut = np.arange(A_BIN) / (A_BIN / 4)
+
+            # Spikes in (amp_bins[iA], amp_bins[iA + 1]] belong to bin iA, spikes above the last
+            # bin edge are saturated
+            spikes_colours = np.searchsorted(amp_bins, spikes.amps, side='left') - 1
+            spikes_colours = np.clip(spikes_colours, 0, A_BIN - 1).astype(np.uint8)
+
+            # All spikes are returned, the GUI decimates them according to the displayed range
             data_scatter = {
-                'x': self.spikes['times'][self.spike_idx][self.kp_idx][0:-1:100],
-                'y': self.spikes['depths'][self.spike_idx][self.kp_idx][0:-1:100],
+                'x': spikes.times,
+                'y': spikes.depths,
+                'amps': spikes.amps,
                 'levels': amp_range * 1e6,
-                'colours': spikes_colours[0:-1:100],
+                'colours': spikes_colours,
+                'lut': colour_lut,
                 'pen': None,
-                'size': spikes_size[0:-1:100],
+                'size': size_lut,
                 'symbol': np.array('o'),
-                'xrange': np.array([np.min(self.spikes['times'][self.spike_idx][self.kp_idx]
-                                           [0:-1:100]),
-                                    np.max(self.spikes['times'][self.spike_idx][self.kp_idx]
-                                           [0:-1:100])]),
+                'xrange': np.array([np.min(spikes.times), np.max(spikes.times)]),
                 'xaxis': 'Time (s)',
                 'title': 'Amplitude (uV)',
                 'cmap': 'BuPu',
-                'cluster': False
+                'cluster': False,
+                'decimate': True
             }
 
             return data_scatter
@@ -194,14 +441,12 @@ class PlotData:
             data_amp_scatter = None
             return data_fr_scatter, data_p2t_scatter, data_amp_scatter
         else:
+            spikes = self.filtered
             (clu,
              spike_depths,
              spike_amps,
-             n_spikes) = self.compute_spike_average((self.spikes['clusters'][self.spike_idx]
-                                                    [self.kp_idx]), (self.spikes['depths']
-                                                    [self.spike_idx][self.kp_idx]),
-                                                    (self.spikes['amps'][self.spike_idx]
-                                                    [self.kp_idx]))
+             n_spikes) = self.compute_spike_average(spikes.clusters, spikes.depths,
+                                                    spikes.amps)
             spike_amps = spike_amps * 1e6
             fr = n_spikes / np.max(self.spikes['times'])
             fr_norm, fr_levels = self.normalise_data(fr, lquant=0, uquant=1)
@@ -219,7 +464,8 @@ class PlotData:
                 'xaxis': 'Amplitude (uV)',
                 'title': 'Firing Rate (Sp/s)',
                 'cmap': 'hot',
-                'cluster': True
+                'cluster': True,
+                'clust_id': clu
             }
 
             #XXX: Adam
@@ -244,7 +490,8 @@ class PlotData:
                 'xaxis': 'Amplitude (uV)',
                 'title': 'Peak to Trough duration (ms)',
                 'cmap': 'RdYlGn',
-                'cluster': True
+                'cluster': True,
+                'clust_id': clu
             }
 
             spike_amps_norm, spike_amps_levels = self.normalise_data(spike_amps, lquant=0,
@@ -264,22 +511,22 @@ class PlotData:
                 'xaxis': 'Firing Rate (Sp/s)',
                 'title': 'Amplitude (uV)',
                 'cmap': 'magma',
-                'cluster': True
+                'cluster': True,
+                'clust_id': clu
             }
 
             return data_fr_scatter, data_p2t_scatter, data_amp_scatter
 
-    def get_fr_img(self):
+    @cache_plot(units=True)
+    def get_fr_img(self, t_bin=T_BIN, d_bin=D_BIN):
         if not self.spike_data_status:
             data_img = None
             return data_img
         else:
-            T_BIN = 0.05
-            D_BIN = 5
-            n, times, depths = bincount2D(self.spikes['times'][self.spike_idx][self.kp_idx],
-                                          self.spikes['depths'][self.spike_idx][self.kp_idx],
-                                          T_BIN, D_BIN, ylim=[0, np.max(self.chn_coords[:, 1])])
-            img = n.T / T_BIN
+            spikes = self.filtered
+            n, times, depths = bincount2D(spikes.times, spikes.depths,
+                                          t_bin, d_bin, ylim=[0, np.max(self.chn_coords[:, 1])])
+            img = n.T / t_bin
             xscale = (times[-1] - times[0]) / img.shape[0]
             yscale = (depths[-1] - depths[0]) / img.shape[1]
 
@@ -296,25 +543,22 @@ class PlotData:
 
             return data_img
 
-    def get_fr_amp_data_line(self):
+    @cache_plot(units=True)
+    def get_fr_amp_data_line(self, d_bin=LINE_D_BIN):
         if not self.spike_data_status:
             data_fr_line = None
             data_amp_line = None
             return data_fr_line, data_amp_line
         else:
-            T_BIN = np.max(self.spikes['times'])
-            D_BIN = 10
-            nspikes, times, depths = bincount2D(self.spikes['times'][self.spike_idx][self.kp_idx],
-                                                self.spikes['depths'][self.spike_idx][self.kp_idx],
-                                                T_BIN, D_BIN,
+            spikes = self.filtered
+            t_bin = np.max(self.spikes['times'])
+            nspikes, times, depths = bincount2D(spikes.times, spikes.depths, t_bin, d_bin,
                                                 ylim=[0, np.max(self.chn_coords[:, 1])])
 
-            amp, times, depths = bincount2D(self.spikes['amps'][self.spike_idx][self.kp_idx],
-                                            self.spikes['depths'][self.spike_idx][self.kp_idx],
-                                            T_BIN, D_BIN, ylim=[0, np.max(self.chn_coords[:, 1])],
-                                            weights=self.spikes['amps'][self.spike_idx]
-                                            [self.kp_idx])
-            mean_fr = nspikes[:, 0] / T_BIN
+            amp, times, depths = bincount2D(spikes.amps, spikes.depths,
+                                            t_bin, d_bin, ylim=[0, np.max(self.chn_coords[:, 1])],
+                                            weights=spikes.amps)
+            mean_fr = nspikes[:, 0] / t_bin
             mean_amp = np.divide(amp[:, 0], nspikes[:, 0]) * 1e6
             mean_amp[np.isnan(mean_amp)] = 0
             remove_bins = np.where(nspikes[:, 0] < 50)[0]
@@ -336,17 +580,29 @@ class PlotData:
 
             return data_fr_line, data_amp_line
 
-    def get_correlation_data_img(self):
+    @cache_plot(units=True)
+    def get_correlation_data_img(self, t_bin=T_BIN, d_bin=CORR_D_BIN, dtype=np.float32,
+                                 chunk_bins=CORR_CHUNK_BINS):
+        """
+        Correlation between the binned firing rates at different depths. The binned firing rates
+        are never held in memory for the whole recording, see binned_corrcoef
+        :param t_bin: time bin size (s)
+        :type t_bin: float
+        :param d_bin: depth bin size (um)
+        :type d_bin: float
+        :param dtype: dtype of binned firing rates, sums are always accumulated in float64
+        :type dtype: np.dtype
+        :param chunk_bins: number of time bins processed at once
+        :type chunk_bins: int
+        """
         if not self.spike_data_status:
             data_img = None
             return data_img
         else:
-            T_BIN = 0.05
-            D_BIN = 40
-            R, times, depths = bincount2D(self.spikes['times'][self.spike_idx][self.kp_idx],
-                                          self.spikes['depths'][self.spike_idx][self.kp_idx],
-                                          T_BIN, D_BIN, ylim=[0, np.max(self.chn_coords[:, 1])])
-            corr = np.corrcoef(R)
+            spikes = self.filtered
+            corr, depths = binned_corrcoef(spikes.times, spikes.depths, t_bin, d_bin,
+                                           ylim=[0, np.max(self.chn_coords[:, 1])], dtype=dtype,
+                                           chunk_bins=chunk_bins)
             corr[np.isnan(corr)] = 0
             scale = (np.max(depths) - np.min(depths)) / corr.shape[0]
             data_img = {
@@ -361,6 +617,7 @@ class PlotData:
             }
             return data_img
 
+    @cache_plot(constants=(N_BNK, BNK_SIZE))
     def get_rms_data_img_probe(self, format):
         # Finds channels that are at equivalent depth on probe and averages rms values for each
         # time point at same depth togehter
@@ -386,24 +643,10 @@ class PlotData:
             xaxis = 'Time samples'
 
         # Img data
-        _rms = np.take(rms_amps, self.chn_ind, axis=1)
-        _, self.chn_depth, chn_count = np.unique(self.chn_coords[:, 1], return_index=True,
-                                                 return_counts=True)
-        self.chn_depth_eq = np.copy(self.chn_depth)
-        self.chn_depth_eq[np.where(chn_count == 2)] += 1
-
-        def avg_chn_depth(a):
-            return(np.mean([a[self.chn_depth], a[self.chn_depth_eq]], axis=0))
-
-        def get_median(a):
-            return(np.median(a))
-
-        def median_subtract(a):
-            return(a - np.median(a))
-        img = np.apply_along_axis(avg_chn_depth, 1, _rms * 1e6)
-        median = np.mean(np.apply_along_axis(get_median, 1, img))
+        img = self.avg_chn_depth(np.take(rms_amps, self.chn_ind, axis=1) * 1e6)
+        row_median = np.median(img, axis=1)
         # Medium subtract to remove bands, but add back average median so values make sense
-        img = np.apply_along_axis(median_subtract, 1, img) + median
+        img = img - row_median[:, np.newaxis] + np.mean(row_median)
         levels = np.quantile(img, [0.1, 0.9])
         xscale = (rms_times[-1] - rms_times[0]) / img.shape[0]
         yscale = (np.max(self.chn_coords[:, 1]) - np.min(self.chn_coords[:, 1])) / img.shape[1]
@@ -441,6 +684,7 @@ class PlotData:
 
         return data_img, data_probe
 
+    @cache_plot(constants=(N_BNK, BNK_SIZE))
     def get_lfp_spectrum_data(self):
         freq_bands = np.vstack(([0, 4], [4, 10], [10, 30], [30, 80], [80, 200]))
         data_probe = {}
@@ -457,16 +701,7 @@ class PlotData:
             freq_idx = np.where((self.lfp_freq >= freq_range[0]) &
                                 (self.lfp_freq < freq_range[1]))[0]
             _lfp = np.take(self.lfp_power[freq_idx], self.chn_ind, axis=1)
-            _lfp_dB = 10 * np.log10(_lfp)
-            _, self.chn_depth, chn_count = np.unique(self.chn_coords[:, 1], return_index=True,
-                                                     return_counts=True)
-            self.chn_depth_eq = np.copy(self.chn_depth)
-            self.chn_depth_eq[np.where(chn_count == 2)] += 1
-
-            def avg_chn_depth(a):
-                return(np.mean([a[self.chn_depth], a[self.chn_depth_eq]], axis=0))
-
-            img = np.apply_along_axis(avg_chn_depth, 1, _lfp_dB)
+            img = self.avg_chn_depth(10 * np.log10(_lfp))
             levels = np.quantile(img, [0.1, 0.9])
             xscale = (freq_range[-1] - freq_range[0]) / img.shape[0]
             yscale = (np.max(self.chn_coords[:, 1]) - np.min(self.chn_coords[:, 1])) / img.shape[1]
@@ -482,13 +717,16 @@ class PlotData:
                 'title': 'PSD (dB)'
             }
 
-            # Power spectrum in bands on probe
-            for freq in freq_bands:
-                freq_idx = np.where((self.lfp_freq >= freq[0]) & (self.lfp_freq < freq[1]))[0]
-                lfp_avg = np.mean(self.lfp_power[freq_idx], axis=0)[self.chn_ind]
-                lfp_avg_dB = 10 * np.log10(lfp_avg)
-                probe_img, probe_scale, probe_offset = self.arrange_channels2banks(lfp_avg_dB)
-                probe_levels = np.quantile(lfp_avg_dB, [0.1, 0.9])
+            # Power spectrum in bands on probe, the average power in all bands is computed at
+            # once by multiplying with a matrix of weights for frequencies in each band
+            in_band = ((self.lfp_freq[np.newaxis, :] >= freq_bands[:, [0]]) &
+                       (self.lfp_freq[np.newaxis, :] < freq_bands[:, [1]]))
+            band_weights = in_band / np.sum(in_band, axis=1, keepdims=True)
+            lfp_avg_dB = 10 * np.log10((band_weights @ self.lfp_power)[:, self.chn_ind])
+            band_levels = np.quantile(lfp_avg_dB, [0.1, 0.9], axis=1).T
+
+            for freq, band_avg_dB, probe_levels in zip(freq_bands, lfp_avg_dB, band_levels):
+                probe_img, probe_scale, probe_offset = self.arrange_channels2banks(band_avg_dB)
 
                 lfp_band_data = {f"{freq[0]} - {freq[1]} Hz": {
                     'img': probe_img,
@@ -504,20 +742,19 @@ class PlotData:
 
             return data_img, data_probe
 
+    @cache_plot(units=True)
     def get_rfmap_data(self):
         data_img = dict()
         if not self.rfmap_data_status:
             return data_img, None
         else:
-
+            spikes = self.filtered
             (rf_map_times, rf_map_pos,
              rf_stim_frames) = passive.get_on_off_times_and_positions(self.rf_map)
 
             rf_map, _ = \
                 passive.get_rf_map_over_depth(rf_map_times, rf_map_pos, rf_stim_frames,
-                                              self.spikes['times'][self.spike_idx][self.kp_idx],
-                                              self.spikes['depths'][self.spike_idx][self.kp_idx],
-                                              d_bin=160)
+                                              spikes.times, spikes.depths, d_bin=160)
             rfs_svd = passive.get_svd_map(rf_map)
             img = dict()
             img['on'] = np.vstack(rfs_svd['on'])
@@ -529,8 +766,7 @@ class PlotData:
 
             depths = np.linspace(0, 3840, len(rfs_svd['on']) + 1)
 
-            sub_type = ['on', 'off']
-            for sub in sub_type:
+            for sub in self.get_rfmap_types():
                 sub_data = {sub: {
                     'img': [img[sub].T],
                     'scale': [np.array([xscale, yscale])],
@@ -545,28 +781,43 @@ class PlotData:
 
             return data_img, depths
 
+    def get_rfmap_types(self):
+        """
+        Names of the rfmap plots that get_rfmap_data will return
+        """
+        if not self.rfmap_data_status:
+            return []
+        return ['on', 'off']
+
+    def get_passive_stim_types(self):
+        """
+        Names of the stimulus types that get_passive_events will return
+        """
+        stim_types = []
+        if self.passive_data_status:
+            stim_types += ['valveOn', 'toneOn', 'noiseOn']
+        if self.gabor_data_status:
+            stim_types += ['leftGabor', 'rightGabor']
+        return stim_types
+
+    @cache_plot(units=True)
     def get_passive_events(self):
-        stim_keys = ['valveOn', 'toneOn', 'noiseOn', 'leftGabor', 'rightGabor']
         data_img = dict()
-        if not self.passive_data_status and not self.gabor_data_status:
+        stim_types = self.get_passive_stim_types()
+        if not stim_types:
             return data_img
-        elif not self.passive_data_status and self.gabor_data_status:
-            stim_types = ['leftGabor', 'rightGabor']
-            stims = self.vis_stim
-        elif self.passive_data_status and not self.gabor_data_status:
-            stim_types = ['valveOn', 'toneOn', 'noiseOn']
-            stims = {stim_type: self.aud_stim[stim_type] for stim_type in stim_types}
-        else:
-            stim_types = stim_keys
-            stims = {stim_type: self.aud_stim[stim_type] for stim_type in stim_types[0:3]}
+        stims = {}
+        if self.passive_data_status:
+            stims.update({stim_type: self.aud_stim[stim_type] for stim_type in
+                          ['valveOn', 'toneOn', 'noiseOn']})
+        if self.gabor_data_status:
             stims.update(self.vis_stim)
 
+        spikes = self.filtered
         base_stim = 1
         pre_stim = 0.4
         post_stim = 1
-        stim_events = passive.get_stim_aligned_activity(stims, self.spikes['times'][self.spike_idx]
-                                                        [self.kp_idx], self.spikes['depths']
-                                                        [self.spike_idx][self.kp_idx],
+        stim_events = passive.get_stim_aligned_activity(stims, spikes.times, spikes.depths,
                                                         pre_stim=pre_stim, post_stim=post_stim,
                                                         base_stim=base_stim)
 
@@ -591,37 +842,112 @@ class PlotData:
 
         return data_img
 
-    def get_autocorr(self, clust_idx):
-        idx = np.where(self.spikes['clusters'] == self.clust_id[clust_idx])[0]
-        autocorr = xcorr(self.spikes['times'][idx], self.spikes['clusters'][idx],
-                         AUTOCORR_BIN_SIZE, AUTOCORR_WIN_SIZE)
+    def get_cluster_spikes(self, clust):
+        """
+        Indices of spikes belonging to a cluster, in time order. Uses an index of the spikes of
+        all clusters (spikes sorted by cluster and the offset of each cluster) that is built the
+        first time it is needed
+        :param clust: cluster id
+        :type clust: int
+        :return: spike indices
+        :type: np.array(int)
+        """
+        with self.clust_index_lock:
+            if self.clust_spike_order is None:
+                self.clust_spike_order = np.argsort(self.spikes['clusters'], kind='stable')
+                self.clust_spike_offset = np.r_[0, np.cumsum(
+                    np.bincount(self.spikes['clusters']))]
+
+        if clust + 1 >= self.clust_spike_offset.size:
+            return np.array([], dtype=np.int64)
+        return self.clust_spike_order[self.clust_spike_offset[clust]:
+                                      self.clust_spike_offset[clust + 1]]
+
+    def compute_autocorr(self, clust):
+        """
+        Autocorrelogram of a cluster, stored so that it is only computed once
+        :param clust: cluster id
+        :type clust: int
+        :return: autocorrelogram
+        :type: np.array
+        """
+        autocorr = self.autocorrs.get(clust)
+        if autocorr is None:
+            idx = self.get_cluster_spikes(clust)
+            autocorr = xcorr(self.spikes['times'][idx], self.spikes['clusters'][idx],
+                             AUTOCORR_BIN_SIZE, AUTOCORR_WIN_SIZE)[0, 0, :]
+            self.autocorrs[clust] = autocorr
+        return autocorr
+
+    def compute_autocorrs(self):
+        """
+        Compute autocorrelograms of all clusters in the current unit filter, run in the
+        background so that cluster popups open instantly. The filter pinned by with_filter is
+        the generation of the pass, the pass stops once filter_units has replaced it
+        """
+        if not self.spike_data_status:
+            return
+        clusters = np.flatnonzero(np.bincount(self.filtered.clusters))
+        for clust in clusters:
+            if self.filtered is not self._filtered:
+                return
+            try:
+                self.compute_autocorr(clust)
+            except Exception:
+                # Clusters with too few spikes, the popup will try again and report it
+                continue
 
-        return autocorr[0, 0, :]
+    def get_autocorr(self, clust):
+        return self.compute_autocorr(clust)
 
-    def get_template_wf(self, clust_idx):
-        template_wf = (self.clusters['waveforms'][self.clust_id[clust_idx], :, 0])
+    def get_template_wf(self, clust):
+        template_wf = (self.clusters['waveforms'][clust, :, 0])
         return template_wf * 1e6
 
-    def arrange_channels2banks(self, data):
+    def init_channel_geometry(self):
+        """
+        Precompute how channels are grouped by depth and arranged in banks on the probe. Only
+        depends on the channel coordinates so is done once
+        """
+        # Channels sorted by depth and the start of each group of channels at the same depth
+        self.chn_depth_order = np.argsort(self.chn_coords[:, 1], kind='stable')
+        sorted_depths = self.chn_coords[self.chn_depth_order, 1]
+        self.chn_depth_start = np.flatnonzero(np.r_[True, np.diff(sorted_depths) != 0])
+        self.chn_depth_count = np.diff(np.r_[self.chn_depth_start, sorted_depths.size])
+
+        # Channels, scale and offset of each bank
         Y_OFFSET = 20
-        bnk_data = []
-        bnk_scale = np.empty((N_BNK, 2))
-        bnk_offset = np.empty((N_BNK, 2))
+        self.bnk_idx = []
+        self.bnk_scale = np.empty((N_BNK, 2))
+        self.bnk_offset = np.empty((N_BNK, 2))
         for iX, x in enumerate(np.unique(self.chn_coords[:, 0])):
             bnk_idx = np.where(self.chn_coords[:, 0] == x)[0]
-            bnk_vals = data[bnk_idx]
-            _bnk_data = np.reshape(bnk_vals, (bnk_vals.size, 1)).T
             _bnk_yscale = ((np.max(self.chn_coords[bnk_idx, 1]) -
-                            np.min(self.chn_coords[bnk_idx, 1])) / _bnk_data.shape[1])
-            _bnk_xscale = BNK_SIZE / _bnk_data.shape[0]
+                            np.min(self.chn_coords[bnk_idx, 1])) / bnk_idx.size)
+            _bnk_xscale = BNK_SIZE
             _bnk_yoffset = np.min(self.chn_coords[bnk_idx, 1]) - Y_OFFSET
             _bnk_xoffset = BNK_SIZE * iX
 
-            bnk_data.append(_bnk_data)
-            bnk_scale[iX, :] = np.array([_bnk_xscale, _bnk_yscale])
-            bnk_offset[iX, :] = np.array([_bnk_xoffset, _bnk_yoffset])
+            self.bnk_idx.append(bnk_idx)
+            self.bnk_scale[iX, :] = np.array([_bnk_xscale, _bnk_yscale])
+            self.bnk_offset[iX, :] = np.array([_bnk_xoffset, _bnk_yoffset])
+
+    def avg_chn_depth(self, data):
+        """
+        Average data over channels at the same depth
+        :param data: data for each channel, channels along last axis
+        :type data: np.array((..., nchannels))
+        :return: data for each depth, sorted by depth
+        :type: np.array((..., ndepths))
+        """
+        data_sum = np.add.reduceat(data[..., self.chn_depth_order], self.chn_depth_start,
+                                   axis=-1)
+        return data_sum / self.chn_depth_count
+
+    def arrange_channels2banks(self, data):
+        bnk_data = [np.reshape(data[bnk_idx], (1, bnk_idx.size)) for bnk_idx in self.bnk_idx]
 
-        return bnk_data, bnk_scale, bnk_offset
+        return bnk_data, np.copy(self.bnk_scale), np.copy(self.bnk_offset)
 
     def compute_spike_average(self, spike_clusters, spike_depth, spike_amp):
         clust, inverse, counts = np.unique(spike_clusters, return_inverse=True, return_counts=True)
@@ -631,7 +957,6 @@ class PlotData:
                                               np.zeros(inverse.size, dtype=int))))
         spike_depth_avg = np.ravel(_spike_depth.toarray()) / counts
         spike_amp_avg = np.ravel(_spike_amp.toarray()) / counts
-        self.clust_id = clust
         return clust, spike_depth_avg, spike_amp_avg, counts
 
     def compute_timescales(self):
@@ -0,0 +1,205 @@
+from PyQt5 import QtCore
+import functools
+import threading
+import traceback
+
+# Products that can be displayed in the GUI and the PlotData method (and arguments) that computes
+# each of them. Methods that return several plots (e.g get_fr_p2t_data_scatter) are a single
+# product, the GUI picks the element it needs from the result
+PLOT_PRODUCTS = {
+    'scat_drift': ('get_depth_data_scatter', ()),
+    'scat_fr_p2t_amp': ('get_fr_p2t_data_scatter', ()),
+    'img_fr': ('get_fr_img', ()),
+    'img_corr': ('get_correlation_data_img', ()),
+    'rms_AP': ('get_rms_data_img_probe', ('AP',)),
+    'rms_LF': ('get_rms_data_img_probe', ('LF',)),
+    'lfp': ('get_lfp_spectrum_data', ()),
+    'line_fr_amp': ('get_fr_amp_data_line', ()),
+    'rfmap': ('get_rfmap_data', ()),
+    'stim': ('get_passive_events', ())
+}
+
+# Products that depend on the unit filter and must be recomputed when the filter changes
+UNIT_PRODUCTS = ['scat_drift', 'scat_fr_p2t_amp', 'img_fr', 'img_corr', 'line_fr_amp', 'rfmap',
+                 'stim']
+
+
+class PlotTaskSignals(QtCore.QObject):
+    """
+    Signals emitted by a PlotTask. QRunnable is not a QObject so the signals live here, the
+    object is created on the GUI thread so connected slots are run on the GUI thread
+    """
+    finished = QtCore.pyqtSignal(object)
+
+
+class PlotTask(QtCore.QRunnable):
+    def __init__(self, key, func, args=()):
+        """
+        Computes a single PlotData product on a worker thread
+        :param key: name of product
+        :type key: str
+        :param func: PlotData method used to compute the product
+        :type func: callable
+        :param args: arguments to pass to func
+        :type args: tuple
+        """
+        super(PlotTask, self).__init__()
+        self.setAutoDelete(False)
+        self.key = key
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self.signals = PlotTaskSignals()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception:
+            self.error = traceback.format_exc()
+        self.done.set()
+        self.signals.finished.emit(self)
+
+
+class PlotDataEngine(QtCore.QObject):
+    def __init__(self, plotdata, max_workers=None):
+        """
+        Computes PlotData products on a pool of worker threads. Products are only computed the
+        first time they are requested, results are kept until invalidated (e.g. when the unit
+        filter changes) and handed to the requesting callbacks on the GUI thread
+        :param plotdata: PlotData object for the current insertion
+        :type plotdata: atlaselectrophysiology.plot_data.PlotData
+        :param max_workers: maximum number of products computed concurrently, defaults to the
+        number of cpu cores
+        :type max_workers: int
+        """
+        super(PlotDataEngine, self).__init__()
+        self.plotdata = plotdata
+        self.pool = QtCore.QThreadPool()
+        if max_workers:
+            self.pool.setMaxThreadCount(max_workers)
+        self.results = {}
+        self.pending = {}
+        self.callbacks = {}
+        self.background = []
+
+    def request(self, key, callback=None):
+        """
+        Request a product. If the product is already available the callback is called
+        immediately, otherwise the product is computed in the background and the callback is
+        called on the GUI thread once it has finished
+        :param key: name of product, must be one of PLOT_PRODUCTS
+        :type key: str
+        :param callback: function called with the computed product
+        :type callback: callable
+        """
+        if key in self.results:
+            if callback:
+                callback(self.results[key])
+            return
+
+        if callback:
+            self.callbacks.setdefault(key, []).append(callback)
+        if key not in self.pending:
+            method, args = PLOT_PRODUCTS[key]
+            # The unit filter is taken when the task is submitted, not when it starts
+            task = PlotTask(key, self.plotdata.with_filter(getattr(self.plotdata, method)), args)
+            task.signals.finished.connect(self.task_finished)
+            self.pending[key] = task
+            self.pool.start(task)
+
+    def get(self, key):
+        """
+        Blocking version of request, returns the product once it is computed
+        :param key: name of product, must be one of PLOT_PRODUCTS
+        :type key: str
+        :return: computed product
+        """
+        if key in self.results:
+            return self.results[key]
+
+        if key not in self.pending:
+            method, args = PLOT_PRODUCTS[key]
+            task = PlotTask(key, self.plotdata.with_filter(getattr(self.plotdata, method)), args)
+            task.run()
+            self.pending[key] = task
+        task = self.pending[key]
+        task.done.wait()
+        self.task_finished(task)
+        return task.result
+
+    def get_all(self):
+        """
+        Computes all products that are not yet available, in parallel, and waits for them
+        """
+        [self.request(key) for key in PLOT_PRODUCTS.keys()]
+        return {key: self.get(key) for key in PLOT_PRODUCTS.keys()}
+
+    def request_all(self, callback):
+        """
+        Non-blocking version of get_all, the callback is called on the GUI thread with the dict
+        of all products once they have all finished. Products that could not be computed are
+        None. The callback is not called if products are invalidated before they have finished
+        :param callback: function called with the dict of products
+        :type callback: callable
+        """
+        products = {}
+
+        def collect(key, result):
+            products[key] = result
+            if len(products) == len(PLOT_PRODUCTS):
+                callback(products)
+
+        for key in PLOT_PRODUCTS.keys():
+            self.request(key, functools.partial(collect, key))
+
+    def task_finished(self, task):
+        # Ignore tasks that have been invalidated or already been handled
+        if self.pending.get(task.key) is not task:
+            return
+        self.pending.pop(task.key)
+        if task.error:
+            # Failed products are not kept, the next request computes them again
+            print(f'Could not compute {task.key}, some plots will not display\n{task.error}')
+        else:
+            self.results[task.key] = task.result
+        for callback in self.callbacks.pop(task.key, []):
+            callback(task.result)
+
+    def submit(self, func, *args):
+        """
+        Run a function on the worker threads without keeping its result, used to precompute
+        data that PlotData stores itself (e.g. autocorrelograms)
+        :param func: function to run
+        :type func: callable
+        :param args: arguments to pass to func
+        """
+        task = PlotTask(func.__name__, self.plotdata.with_filter(func), args)
+        task.signals.finished.connect(self.background_finished)
+        self.background.append(task)
+        self.pool.start(task)
+
+    def background_finished(self, task):
+        if task in self.background:
+            self.background.remove(task)
+        if task.error:
+            print(f'Could not compute {task.key}\n{task.error}')
+
+    def invalidate(self, keys=None):
+        """
+        Discard computed products so that they are recomputed the next time they are requested.
+        Products waiting for a worker are removed from the pool, products still being computed
+        are discarded when they finish. Background tasks waiting for a worker are bound to the
+        unit filter that is being replaced and are removed from the pool too
+        :param keys: names of products to discard, defaults to all products
+        :type keys: list of str
+        """
+        keys = keys or list(PLOT_PRODUCTS.keys())
+        for key in keys:
+            self.results.pop(key, None)
+            task = self.pending.pop(key, None)
+            if task is not None:
+                self.pool.tryTake(task)
+            self.callbacks.pop(key, None)
+        self.background = [task for task in self.background if not self.pool.tryTake(task)]
@@ -0,0 +1,150 @@
+from collections import OrderedDict
+import hashlib
+import threading
+import numpy as np
+from atlas_provider import get_atlas
+
+# Levels of the slice pyramid are halved until their smallest side is below this size
+MIN_LEVEL_SIZE = 64
+# Number of slices (one per track) kept in memory
+MAX_CACHED_SLICES = 8
+SLICE_KEYS = ['hist_rd', 'hist_gr', 'ccf', 'label']
+
+
+def build_pyramid(img, label=False, min_size=MIN_LEVEL_SIZE):
+    """
+    Multi resolution levels of a slice image, each level has half the resolution of the previous
+    one
+    :param img: full resolution image, first two dimensions are x and y
+    :type img: np.array
+    :param label: whether the image is a label image, label images are subsampled rather than
+    averaged so that region colours are not mixed
+    :type label: bool
+    :param min_size: smallest size of the last level
+    :type min_size: int
+    :return: levels of pyramid, level 0 is the input image
+    :type: list of np.array
+    """
+    levels = [img]
+    while min(levels[-1].shape[:2]) >= 2 * min_size:
+        prev = levels[-1]
+        n_x = prev.shape[0] // 2
+        n_y = prev.shape[1] // 2
+        if label:
+            levels.append(np.ascontiguousarray(prev[0:2 * n_x:2, 0:2 * n_y:2]))
+        else:
+            blocks = prev[:2 * n_x, :2 * n_y].reshape(n_x, 2, n_y, 2, *prev.shape[2:])
+            levels.append(blocks.mean(axis=(1, 3), dtype=np.float32).astype(prev.dtype))
+    return levels
+
+
+def get_level(slice_data, img_type, pixel_size):
+    """
+    Coarsest level of the slice pyramid that still has at least one image pixel per screen
+    pixel
+    :param slice_data: slice data returned by SliceService.get_slice_images
+    :type slice_data: dict
+    :param img_type: type of slice, one of SLICE_KEYS
+    :type img_type: str
+    :param pixel_size: size of a screen pixel in data coordinates (x, y), None for the full
+    resolution
+    :type pixel_size: tuple
+    :return: index of level, image and scale of image
+    :type: int, np.array, np.array
+    """
+    pyramid = slice_data.get('pyramid', {}).get(img_type, [slice_data[img_type]])
+    level = 0
+    if pixel_size is not None and np.all(np.isfinite(pixel_size)):
+        factor = np.min(np.abs(pixel_size) / slice_data['scale'])
+        if factor > 1:
+            level = int(np.clip(np.floor(np.log2(factor)), 0, len(pyramid) - 1))
+    img = pyramid[level]
+    # Levels may lose a row or column when halved, the scale is adjusted so that all levels
+    # cover the same extent
+    scale = slice_data['scale'] * np.array(pyramid[0].shape[:2]) / np.array(img.shape[:2])
+    return level, img, scale
+
+
+class SliceService:
+    def __init__(self, brain_atlas):
+        """
+        Computes the slices of the atlas and histology volumes along the track of a probe and
+        their multi resolution pyramids. Slices are cached per track, so reloading a probe or
+        switching between probes of a session does not index the volumes again
+        :param brain_atlas: atlas
+        :type brain_atlas: ibllib.atlas.AllenAtlas
+        """
+        self.brain_atlas = brain_atlas
+        self.slices = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_slice_images(self, xyz_channels, hist_path_rd=None, hist_path_gr=None):
+        """
+        Slices through the atlas image, label and histology volumes along the track
+        :param xyz_channels: coordinates of points along the track
+        :type xyz_channels: np.array((n_points, 3))
+        :param hist_path_rd: path to red histology volume, if not given the atlas image is used
+        :type hist_path_rd: Path
+        :param hist_path_gr: path to green histology volume, if not given the atlas image is used
+        :type hist_path_gr: Path
+        :return: slice images with keys in SLICE_KEYS, their scale and offset and their
+        pyramids with key 'pyramid'
+        :type: dict
+        """
+        index = self.brain_atlas.bc.xyz2i(xyz_channels)[:, self.brain_atlas.xyz2dims]
+        key = (hashlib.sha1(np.ascontiguousarray(index).tobytes()).hexdigest(),
+               str(hist_path_rd or ''), str(hist_path_gr or ''))
+        with self.lock:
+            if key in self.slices:
+                self.slices.move_to_end(key)
+                return self.slices[key]
+
+        slice_data = self.compute_slice_images(index, hist_path_rd, hist_path_gr)
+
+        with self.lock:
+            self.slices[key] = slice_data
+            while len(self.slices) > MAX_CACHED_SLICES:
+                self.slices.popitem(last=False)
+        return slice_data
+
+    def compute_slice_images(self, index, hist_path_rd=None, hist_path_gr=None):
+        # Points along the track are sampled more finely than the atlas so many of them fall
+        # in the same voxel column, only read each column once, in sorted order
+        columns, inverse = np.unique(index[:, [0, 2]], axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+
+        def get_slice(volume):
+            return np.swapaxes(volume[columns[:, 0], :, columns[:, 1]][inverse], 0, 1)
+
+        ccf_slice = get_slice(self.brain_atlas.image)
+        label_slice = np.swapaxes(self.brain_atlas._label2rgb(
+            self.brain_atlas.label[columns[:, 0], :, columns[:, 1]])[inverse], 0, 1)
+
+        width = [self.brain_atlas.bc.i2x(0), self.brain_atlas.bc.i2x(456)]
+        height = [self.brain_atlas.bc.i2z(index[0, 2]), self.brain_atlas.bc.i2z(index[-1, 2])]
+
+        if hist_path_rd:
+            hist_slice_rd = get_slice(get_atlas(25, hist_path=hist_path_rd).image)
+        else:
+            print('Could not find red histology image for this subject')
+            hist_slice_rd = np.copy(ccf_slice)
+
+        if hist_path_gr:
+            hist_slice_gr = get_slice(get_atlas(25, hist_path=hist_path_gr).image)
+        else:
+            print('Could not find green histology image for this subject')
+            hist_slice_gr = np.copy(ccf_slice)
+
+        slice_data = {
+            'hist_rd': hist_slice_rd,
+            'hist_gr': hist_slice_gr,
+            'ccf': ccf_slice,
+            'label': label_slice,
+            'scale': np.array([(width[-1] - width[0]) / ccf_slice.shape[0],
+                               (height[-1] - height[0]) / ccf_slice.shape[1]]),
+            'offset': np.array([width[0], height[0]])
+        }
+        slice_data['pyramid'] = {key: build_pyramid(slice_data[key], label=key == 'label')
+                                 for key in SLICE_KEYS}
+
+        return slice_data
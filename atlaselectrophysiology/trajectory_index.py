@@ -0,0 +1,190 @@
+from pathlib import Path
+import os
+import tempfile
+import numpy as np
+from scipy.spatial import cKDTree
+import ibllib.atlas as atlas
+import ibllib.pipes.histology as histology
+
+# Depths along the active part of the probe (where electrodes are located) at which tracks are
+# sampled to compute the distance between two tracks
+DEPTHS = np.arange(200, 4100, 20) / 1e6
+# Fields of an alyx trajectory that define the track, a track is resampled if any of them change
+TRACK_KEYS = ['x', 'y', 'z', 'depth', 'theta', 'phi']
+INDEX_FILE = 'histology_track_index.npz'
+# The tree is rebuilt when the number of tracks added since the last build exceeds this
+# fraction of the tracks in the tree, until then new tracks are searched exhaustively
+REBUILD_FRACTION = 0.1
+REBUILD_MIN = 50
+
+
+def get_index_file():
+    """
+    Location of the persisted track index, in the ONE cache directory
+    :return: path to index file
+    :type: Path
+    """
+    try:
+        from ibllib.io import params
+        cache_dir = Path(params.read('one_params').CACHE_DIR)
+    except Exception:
+        cache_dir = Path(Path.home(), 'Downloads', 'FlatIron')
+    return cache_dir.joinpath('histology', INDEX_FILE)
+
+
+def sample_track(traj, depths=DEPTHS):
+    """
+    Coordinates of points along a histology track
+    :param traj: alyx trajectory
+    :type traj: dict
+    :param depths: depths along track to sample
+    :type depths: np.array
+    :return: coordinates of points
+    :type: np.array((n_depths, 3))
+    """
+    insertion = atlas.Insertion.from_dict(traj)
+    return histology.interpolate_along_track(np.vstack([insertion.tip, insertion.entry]),
+                                             depths)
+
+
+class TrajectoryIndex:
+    def __init__(self, index_file=None, depths=DEPTHS):
+        """
+        Spatial index of histology tracks used to find the tracks closest to a given track. The
+        distance between two tracks is the mean distance between their points sampled at the
+        same depths. The distance between the centroids of two tracks is a lower bound of this
+        distance, so a kd-tree over the centroids gives candidates that are then refined with
+        the exact distance
+        :param index_file: file the index is persisted to, if None the index is not persisted
+        :type index_file: Path
+        :param depths: depths along track to sample
+        :type depths: np.array
+        """
+        self.index_file = index_file
+        self.depths = depths
+        self.ids = []
+        self.keys = np.empty((0, len(TRACK_KEYS)))
+        self.coords = np.empty((0, len(depths), 3))
+        self.centroids = np.empty((0, 3))
+        self.id2idx = {}
+        # Tracks with index below n_tree are in the tree, the others are searched exhaustively
+        self.tree = None
+        self.n_tree = 0
+        self.load()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def load(self):
+        if self.index_file is None or not Path(self.index_file).exists():
+            return
+        try:
+            with np.load(self.index_file, allow_pickle=False) as index:
+                if not np.array_equal(index['depths'], self.depths):
+                    return
+                self.ids = list(index['ids'])
+                self.keys = index['keys']
+                self.coords = index['coords']
+        except Exception as err:
+            print(f'Could not read track index {self.index_file}, will recompute: {err}')
+            return
+        self.centroids = np.mean(self.coords, axis=1)
+        self.id2idx = {traj_id: i for i, traj_id in enumerate(self.ids)}
+        self.build_tree()
+
+    def save(self):
+        if self.index_file is None:
+            return
+        try:
+            index_file = Path(self.index_file)
+            index_file.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_file = tempfile.mkstemp(dir=index_file.parent, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, ids=np.array(self.ids, dtype=str), keys=self.keys,
+                         coords=self.coords, depths=self.depths)
+            os.replace(tmp_file, index_file)
+        except Exception as err:
+            print(f'Could not save track index {self.index_file}: {err}')
+
+    def build_tree(self):
+        self.tree = cKDTree(self.centroids) if len(self.ids) else None
+        self.n_tree = len(self.ids)
+
+    def update(self, trajectories):
+        """
+        Synchronise the index with a list of trajectories. Tracks that are new or whose
+        coordinates changed are sampled and added, tracks no longer in the list are removed
+        :param trajectories: alyx trajectories
+        :type trajectories: list of dict
+        """
+        keys = np.array([[traj[key] for key in TRACK_KEYS] for traj in trajectories],
+                        dtype=float).reshape(-1, len(TRACK_KEYS))
+        keep = []
+        new = []
+        for i, traj in enumerate(trajectories):
+            idx = self.id2idx.get(traj['id'])
+            if idx is not None and np.array_equal(self.keys[idx], keys[i]):
+                keep.append(idx)
+            else:
+                new.append(i)
+
+        if len(keep) == len(self.ids) and not new:
+            return
+
+        if len(keep) < len(self.ids):
+            # Tracks were removed or changed, rows are deleted so the tree must be rebuilt
+            keep = np.sort(keep).astype(int)
+            self.ids = [self.ids[idx] for idx in keep]
+            self.keys = self.keys[keep]
+            self.coords = self.coords[keep]
+            self.centroids = self.centroids[keep]
+            self.tree = None
+
+        if new:
+            self.ids += [trajectories[i]['id'] for i in new]
+            self.keys = np.r_[self.keys, keys[new]]
+            coords = np.stack([sample_track(trajectories[i], self.depths) for i in new])
+            self.coords = np.r_[self.coords, coords]
+            self.centroids = np.r_[self.centroids, np.mean(coords, axis=1)]
+
+        self.id2idx = {traj_id: i for i, traj_id in enumerate(self.ids)}
+        n_buffer = len(self.ids) - self.n_tree
+        if self.tree is None or n_buffer > max(REBUILD_MIN, REBUILD_FRACTION * self.n_tree):
+            self.build_tree()
+        self.save()
+
+    def _distance(self, idx, target):
+        return np.mean(np.sqrt(np.sum((self.coords[idx] - target) ** 2, axis=2)), axis=1)
+
+    def query(self, traj_id, k=10):
+        """
+        Find the k tracks closest to a track, including the track itself
+        :param traj_id: id of trajectory
+        :type traj_id: str
+        :param k: number of tracks to return
+        :type k: int
+        :return: index of closest tracks in self.ids ordered by distance and their distance
+        :type: np.array(k), np.array(k)
+        """
+        target = self.coords[self.id2idx[traj_id]]
+        centroid = np.mean(target, axis=0)
+        k = min(k, len(self.ids))
+        # Tracks added since the tree was built are always candidates
+        buffer = np.arange(self.n_tree, len(self.ids))
+
+        n_cand = k
+        while True:
+            n_cand = min(n_cand, self.n_tree)
+            if n_cand:
+                bound, cand = self.tree.query(centroid, k=n_cand)
+                bound = np.atleast_1d(bound)
+                cand = np.atleast_1d(cand)
+            else:
+                bound, cand = np.empty(0), np.empty(0, dtype=int)
+            cand = np.r_[cand, buffer].astype(int)
+            dist = self._distance(cand, target)
+            order = np.argsort(dist, kind='stable')[:k]
+            # All tracks not yet visited are at least as far as the furthest tree candidate
+            if n_cand == self.n_tree or dist[order[-1]] <= bound[-1]:
+                return cand[order], dist[order]
+            n_cand *= 2
@@ -20,7 +20,7 @@ from PyQt5.QtGui import QTransform
 import pyqtgraph as pg
 import matplotlib
 
-from ibllib.atlas import AllenAtlas
+from atlas_provider import get_atlas
 import qt
 
 
@@ -264,7 +264,7 @@ class ControllerTopView(PgImageController):
     def __init__(self, qmain: TopView, res: int = 25, volume='image', brainmap='Allen'):
         super(ControllerTopView, self).__init__(qmain)
         self.volume = volume
-        self.atlas = AllenAtlas(res, brainmap=brainmap)
+        self.atlas = get_atlas(res, brainmap=brainmap)
         self.fig_top = self.qwidget = qmain
         # Setup Coronal slice: width: ml, height: dv, depth: ap
         self.fig_coronal = SliceView(qmain, waxis=0, haxis=2, daxis=1)
@@ -16,6 +16,8 @@ import random
 import json
 import sys
 import logging
+import threading
+from collections import OrderedDict
 from itertools import cycle
 from more_itertools import chunked
 
@@ -33,6 +35,15 @@ from oneibl.webclient import http_download_file_list
 import brainbox.behavior.wheel as wh
 from ibllib.misc.exp_ref import eid2ref
 
+# Size of the cache of decoded video frames, in MB
+CACHE_MB = 512
+# Fraction of the cache filled with frames ahead of the playhead, the rest is kept for frames
+# behind it (stepping back with the left key)
+PREFETCH_AHEAD = 0.75
+# Forward jumps up to this many frames are decoded sequentially rather than by seeking, a seek
+# restarts decoding from the previous keyframe
+MAX_GRAB_FRAMES = 64
+
 
 def get_video_frame(video_path, frame_number):
     """
@@ -77,9 +88,204 @@ def get_video_frames_preload(video_path, frame_numbers):
     return np.array(frame_images), fps, total_frames
 
 
+class FrameCache:
+    def __init__(self, max_bytes):
+        """
+        Least recently used cache of decoded frames by frame number, bounded in bytes. Not
+        thread safe, calls are made with the lock of the VideoStream held
+        :param max_bytes: maximum size of the cached frames
+        """
+        self.max_bytes = max_bytes
+        self.frames = OrderedDict()
+        self.nbytes = 0
+
+    def __contains__(self, frame_number):
+        return frame_number in self.frames
+
+    def get(self, frame_number):
+        frame = self.frames.get(frame_number)
+        if frame is not None:
+            self.frames.move_to_end(frame_number)
+        return frame
+
+    def put(self, frame_number, frame, keep=()):
+        """
+        Add a frame, evicting the least recently used frames that are not in `keep` first
+        :param frame_number: video frame number
+        :param frame: frame as numpy array
+        :param keep: frame numbers to evict last, e.g. the prefetch window
+        """
+        if frame_number in self.frames:
+            self.nbytes -= self.frames.pop(frame_number).nbytes
+        self.frames[frame_number] = frame
+        self.nbytes += frame.nbytes
+        if self.nbytes <= self.max_bytes:
+            return
+        for evict in [f for f in self.frames if f not in keep] + list(self.frames):
+            if self.nbytes <= self.max_bytes or len(self.frames) == 1:
+                break
+            if evict in self.frames and evict != frame_number:
+                self.nbytes -= self.frames.pop(evict).nbytes
+
+
+class VideoStream:
+    def __init__(self, video_path, cache_mb=CACHE_MB):
+        """
+        Decodes the frames of a video in a background thread. The frames in a sliding window
+        around the playhead are prefetched into a LRU cache bounded in size, so playback starts
+        as soon as the first frame is decoded and memory does not grow with the length of the
+        trial.  The cache is shared by all trials of the video
+        :param video_path: local path to mp4 file
+        :param cache_mb: size of the frame cache in MB
+        """
+        self.video_path = video_path
+        self.cache = FrameCache(cache_mb * 1024 ** 2)
+        self.cond = threading.Condition()
+        self._frame_ids = np.array([], dtype=int)  # Frame numbers of the current trial
+        self._playhead = 0  # Index in the trial's frame list
+        self._window = None  # Number of frames prefetched, set once the frame size is known
+        self._failed = set()  # Frames that could not be decoded
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def frames(self, frame_ids):
+        """
+        Frames of a trial, decoding starts at the first frame of the trial
+        :param frame_ids: video frame numbers of the trial
+        :return: TrialFrames sequence of frames
+        """
+        with self.cond:
+            self._frame_ids = np.asarray(frame_ids)
+            self._playhead = 0
+            self.cond.notify_all()
+        return TrialFrames(self, self._frame_ids)
+
+    def get(self, frame_ids, index):
+        """
+        Frame at an index of a trial's frame list, moves the playhead to the index and waits
+        for the frame to be decoded if it isn't cached
+        :param frame_ids: video frame numbers of the trial
+        :param index: index in the trial's frame list
+        :return: frame as numpy array, or None if the frame could not be decoded or the stream
+        has stopped
+        """
+        frame_number = int(frame_ids[index])
+        with self.cond:
+            if frame_ids is self._frame_ids:
+                self._playhead = index
+                self.cond.notify_all()
+            while frame_number not in self.cache and frame_number not in self._failed:
+                if self._stop or not self._thread.is_alive():
+                    break
+                if frame_ids is not self._frame_ids:
+                    # Not the current trial, decode this frame first
+                    self._frame_ids, self._playhead = frame_ids, index
+                    self.cond.notify_all()
+                self.cond.wait(timeout=1)  # Check regularly that the decoding thread is alive
+            return self.cache.get(frame_number)
+
+    def blank_frame(self):
+        """
+        Black frame of the size of the video frames, displayed in place of a frame that could
+        not be decoded
+        :return: numpy array of zeros
+        """
+        cap = cv2.VideoCapture(str(self.video_path))
+        shape = (int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)))
+        cap.release()
+        return np.zeros(shape + (3,), dtype=np.uint8)
+
+    def close(self):
+        with self.cond:
+            self._stop = True
+            self.cond.notify_all()
+
+    def _window_frames(self):
+        """
+        Frames to prefetch: the frame at the playhead, then the frames ahead of it, then the
+        frames behind it
+        :return: frame numbers
+        """
+        ids = self._frame_ids
+        i = self._playhead
+        if self._window is None:
+            ahead, behind = 1, 0
+        else:
+            ahead = int(self._window * PREFETCH_AHEAD)
+            behind = self._window - ahead
+        return np.r_[ids[i:i + ahead], ids[max(i - behind, 0):i][::-1]].tolist()
+
+    def _next_frame(self):
+        """
+        :return: next frame of the window to decode, None if all of them are cached
+        """
+        for frame_number in self._window_frames():
+            if frame_number not in self.cache and frame_number not in self._failed:
+                return frame_number
+        return None
+
+    def _run(self):
+        cap = None
+        position = 0  # Number of the frame decoded by the next read, None if unknown
+        try:
+            cap = cv2.VideoCapture(str(self.video_path))
+            while True:
+                with self.cond:
+                    frame_number = self._next_frame()
+                    while not self._stop and frame_number is None:
+                        self.cond.wait()
+                        frame_number = self._next_frame()
+                    if self._stop:
+                        return
+                # Decode outside the lock so the cached frames stay available to the viewer
+                if position is None or not 0 <= frame_number - position <= MAX_GRAB_FRAMES:
+                    # Seeking decodes from the keyframe before the frame
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+                    position = frame_number
+                while position < frame_number and cap.grab():
+                    position += 1
+                ret, frame = cap.read() if position == frame_number else (False, None)
+                position = frame_number + 1 if ret else None
+                with self.cond:
+                    if ret:
+                        if self._window is None:
+                            self._window = max(int(self.cache.max_bytes // frame.nbytes), 1)
+                        self.cache.put(frame_number, frame, keep=set(self._window_frames()))
+                    else:
+                        self._failed.add(frame_number)
+                    self.cond.notify_all()
+        except Exception:
+            logging.getLogger('ibllib').exception('Could not decode %s', self.video_path)
+        finally:
+            if cap is not None:
+                cap.release()
+            with self.cond:
+                # Frames that are not cached are returned as None from now on
+                self._stop = True
+                self.cond.notify_all()
+
+
+class TrialFrames:
+    def __init__(self, stream, frame_ids):
+        """
+        Sequence of the frames of a trial, decoded on demand by a VideoStream
+        :param stream: VideoStream of the video
+        :param frame_ids: video frame numbers of the trial
+        """
+        self.stream = stream
+        self.frame_ids = frame_ids
+
+    def __len__(self):
+        return len(self.frame_ids)
+
+    def __getitem__(self, index):
+        return self.stream.get(self.frame_ids, index)
+
+
 class Viewer:
     def __init__(self, eid=None, trial=None, camera='left', dlc_features=None, quick_load=True,
-                 t_win=3, one=None, start=True):
+                 t_win=3, one=None, start=True, cache_mb=CACHE_MB):
         """
         Plot the wheel trace alongside the video frames.  Below is list of key bindings:
         :key n: plot movements of next trial
@@ -99,6 +305,7 @@ class Viewer:
         instead of entire session
         :param t_win: the window in seconds over which to plot the wheel trace
         :param start: if False, the Viewer must be started by calling the `run` method
+        :param cache_mb: size of the cache of decoded video frames in MB
         :return: Viewer object
         """
         self._logger = logging.getLogger('ibllib')
@@ -161,6 +368,8 @@ class Viewer:
         self._logger.info("Frame rate = %.0fHz", fps)
         # cam_ts = cam_ts[-count:]  # Remove extraneous timestamps
         self._session_data['camera_ts'] = cam_ts
+        # Frames are decoded in the background around the playhead
+        self._video = VideoStream(self.video_path, cache_mb=cache_mb)
 
         # Load wheel data
         self._session_data['wheel'] = self.one.load_object(self._session_data['eid'], 'wheel')
@@ -173,6 +382,7 @@ class Viewer:
         fig, axes = plt.subplots(nrows=2)
         fig.canvas.mpl_disconnect(fig.canvas.manager.key_press_handler_id)  # Disable defaults
         fig.canvas.mpl_connect('key_press_event', self.process_key)  # Connect our own key press fn
+        fig.canvas.mpl_connect('close_event', lambda _: self._video.close())
 
         self._plot_data['figure'] = fig
         self._plot_data['axes'] = axes
@@ -213,22 +423,11 @@ class Viewer:
 
         # Our plot data, e.g. data that falls within trial
         frame_ids = self.frames_for_period(self._session_data['camera_ts'], trial - 1)
-        try:
-            data = {
-                'frames': frame_ids,
-                'camera_ts': self._session_data['camera_ts'][frame_ids],
-                'frame_images': get_video_frames_preload(self.video_path, frame_ids)[0]
-            }
-        except cv2.error as ex:
-            # Log errors when out of memory; occurs when there are too many frames to load
-            if ex.func.endswith('OutOfMemoryError'):
-                self._logger.error(f'{ex.func}: {ex.err}')
-                return
-            else:
-                raise ex
-        except MemoryError:
-            self._logger.error('Out of memory; please try loading another trial')
-            return
+        data = {
+            'frames': frame_ids,
+            'camera_ts': self._session_data['camera_ts'][frame_ids],
+            'frame_images': self._video.frames(frame_ids)  # Decoded when first displayed
+        }
         #  frame = get_video_frame(video_path, frames[0])
 
         on, off, ts, pos, units = self.extract_onsets_for_trial()
@@ -466,10 +665,13 @@ class Viewer:
         data = self._plot_data
         trials = self._session_data['trials']
         trial_idx = self.trial_num - 1
+        frame = data['frame_images'][0]
+        if frame is None:  # The frame could not be decoded
+            frame = self._video.blank_frame()
         if 'im' in data:
-            data['im'].set_data(data['frame_images'][0])
+            data['im'].set_data(frame)
         else:
-            data['im'] = data['axes'][0].imshow(data['frame_images'][0])
+            data['im'] = data['axes'][0].imshow(frame)
 
         # Plot DLC features
         dlc = self._session_data.get('dlc')
@@ -576,7 +778,8 @@ class Viewer:
         t_x = data['camera_ts'][i]
         data['ln'].set_xdata([t_x, t_x])
         data['axes'][1].set_xlim([t_x - (self.t_win / 2), t_x + (self.t_win / 2)])
-        data['im'].set_data(frame)
+        if frame is not None:  # None if the frame could not be decoded
+            data['im'].set_data(frame)
         if data['dlc']:
             self.update_dlc_plot(i)
         self._logger.debug('Render time: %.3f', time.time() - t_start)
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Computes the quality metrics of gen_metrics_labels for all units at once.
+
+Spikes are sorted by cluster once, and the metrics that only depend on the spikes of a unit
+(drifts, coefficients of variation, isi violations, false positive estimates and presence
+ratios) are computed for all units with segmented numpy reductions over the sorted spikes.
+The metrics that rely on per unit histograms or correlograms are computed on views of the
+sorted spikes, so that the spikes of each unit are never searched for.
+
+"""
+
+import numpy as np
+import brainbox as bb
+from contamination import contamination_tests
+from defined_metrics import noise_cutoff, feat_cutoff
+from raw_data import peak_to_peak_amps
+
+
+class SortedSpikes:
+    def __init__(self, spks_b):
+        '''
+        Spikes sorted by cluster, spikes of each cluster keep their original (time) order.
+
+        Parameters
+        ----------
+        spks_b : bunch
+            A spikes bunch with fields 'clusters', 'times', 'amps', 'depths' and 'samples'.
+        '''
+        clusters = np.asarray(spks_b['clusters'])
+        self.n_units = int(np.max(clusters)) + 1
+        order = np.argsort(clusters, kind='stable')
+        self.clusters = clusters[order]
+        self.counts = np.bincount(clusters, minlength=self.n_units)
+        self.starts = np.r_[0, np.cumsum(self.counts)[:-1]]
+        self.ends = self.starts + self.counts
+        self.feats = {feat: np.asarray(spks_b[feat])[order]
+                      for feat in ['times', 'amps', 'depths', 'samples'] if feat in spks_b}
+        # whether two consecutive sorted spikes belong to the same unit
+        self.same_unit = self.clusters[1:] == self.clusters[:-1]
+
+    def get(self, feat, unit):
+        return self.feats[feat][self.starts[unit]:self.ends[unit]]
+
+    def segment_sum(self, x):
+        '''
+        Sum of a spike feature over the spikes of each unit, 0 for units without spikes.
+        '''
+        out = np.zeros(self.n_units)
+        nz = self.counts > 0
+        if np.any(nz):
+            out[nz] = np.add.reduceat(np.asarray(x, dtype=float), self.starts[nz])
+        return out
+
+    def abs_diff_sum(self, x):
+        '''
+        Sum of the absolute differences of a spike feature between consecutive spikes of each
+        unit.
+        '''
+        dx = np.r_[np.where(self.same_unit, np.abs(np.diff(x)), 0), 0]
+        return self.segment_sum(dx)
+
+
+def batch_unit_metrics(sorted_spks, rp=0.002, hist_win=10):
+    '''
+    Computes the metrics that only depend on the spikes of each unit for all units.
+
+    Parameters
+    ----------
+    sorted_spks : SortedSpikes
+        Spikes sorted by cluster.
+    rp : float
+        The refractory period (in s).
+    hist_win : float
+        The time window (in s) to use for computing the presence ratio.
+
+    Returns
+    -------
+    metrics : dict
+        For each metric an array with a value per unit (nan for units without spikes):
+        'cum_amp_drift', 'cum_depth_drift', 'cv_amp', 'frac_isi_viol', 'fp_est',
+        'pres_ratio' and 'pres_ratio_std', as computed by the functions of defined_metrics.
+    '''
+    s = sorted_spks
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n = np.where(s.counts > 0, s.counts, np.nan)
+        times = s.feats['times']
+        amps = s.feats['amps']
+        metrics = {}
+
+        # Cumulative drifts, see cum_drift
+        metrics['cum_amp_drift'] = s.abs_diff_sum(amps) / n
+        metrics['cum_depth_drift'] = s.abs_diff_sum(s.feats['depths']) / n
+
+        # Coefficient of variation of spike amplitudes, two pass as np.std
+        mean_amp = s.segment_sum(amps) / n
+        std_amp = np.sqrt(s.segment_sum((amps - np.repeat(mean_amp, s.counts)) ** 2) / n)
+        metrics['cv_amp'] = std_amp / mean_amp
+
+        # Isi violations, see isi_viol and fp_est
+        n_isi_viol = s.segment_sum(np.r_[s.same_unit & (np.diff(times) < rp), False])
+        metrics['frac_isi_viol'] = n_isi_viol / n
+        nz = s.counts > 0
+        first = np.full(s.n_units, np.nan)
+        last = np.full(s.n_units, np.nan)
+        first[nz] = times[s.starts[nz]]
+        last[nz] = times[s.ends[nz] - 1]
+        t = last - first
+        c = (t * n_isi_viol) / (2 * rp * n ** 2)
+        # smallest root in absolute value of -x**2 + x + c
+        metrics['fp_est'] = (np.sqrt(1 + 4 * c) - 1) / 2
+
+        # Presence ratio, see pres_ratio. Bins are the same as np.arange(0, ts[-1] + hist_win,
+        # hist_win) for all units so spikes are binned once with the bins of the longest unit
+        n_bins = np.zeros(s.n_units, dtype=int)
+        n_bins[nz] = np.array([np.arange(0, ts_last + hist_win, hist_win).size - 1
+                               for ts_last in last[nz]])
+        edges = np.arange(0, np.nanmax(last) + hist_win, hist_win) if np.any(nz) else [0]
+        spk_bin = np.searchsorted(edges, times, side='right') - 1
+        # the last edge is included in the last bin
+        spk_bin = np.minimum(spk_bin, np.repeat(n_bins - 1, s.counts))
+        # spikes are sorted by unit and time so each run of equal (unit, bin) is a bin count
+        key_change = np.r_[True, ~s.same_unit | (np.diff(spk_bin) != 0)]
+        run_starts = np.where(key_change)[0]
+        run_counts = np.diff(np.r_[run_starts, times.size])
+        run_unit = s.clusters[run_starts]
+        n_nonzero = np.bincount(run_unit, minlength=s.n_units)
+        metrics['pres_ratio'] = n_nonzero / np.where(nz, n_bins, np.nan)
+        mean_count = s.counts / n_bins
+        sq_dev = np.bincount(run_unit, weights=(run_counts - mean_count[run_unit]) ** 2,
+                             minlength=s.n_units)
+        sq_dev += (n_bins - n_nonzero) * mean_count ** 2
+        metrics['pres_ratio_std'] = metrics['pres_ratio'] / np.sqrt(sq_dev / n_bins)
+        # np.histogram fails for units without bins, i.e. all spikes at time 0
+        metrics['pres_ratio'][n_bins == 0] = np.nan
+        metrics['pres_ratio_std'][n_bins == 0] = np.nan
+
+    return metrics
+
+
+def gen_unit_metrics(spks_b, ephys_file=None):
+    '''
+    Computes the quality metrics and labels of gen_metrics_labels for all units.
+
+    Parameters
+    ----------
+    spks_b : bunch
+        A spikes bunch with fields 'clusters', 'times', 'amps', 'depths' and 'samples'.
+    ephys_file : string (optional)
+        The file path to the binary ephys data, used to compute the true mean amplitudes.
+
+    Returns
+    -------
+    metrics : dict
+        Arrays of metrics with the same indexing as in gen_metrics_labels: 'label', 'refp_viol',
+        'noise_cutoff' (indexed by position among units with spikes, allocated for all units),
+        'mean_amp_true' (indexed by unit) and the other metrics (one value per unit with
+        spikes). 'units' are all units and 'units_nonzeros' the units with spikes.
+    '''
+    s = SortedSpikes(spks_b)
+    units = np.arange(s.n_units)
+    units_nonzeros = np.where(s.counts > 0)[0]
+    n_units = len(units_nonzeros)
+
+    batch = batch_unit_metrics(s)
+    metrics = {key: val[units_nonzeros] for key, val in batch.items()}
+    metrics['units'] = units
+    metrics['units_nonzeros'] = units_nonzeros
+
+    cv_fr = np.full((n_units,), np.nan)
+    frac_missing_spks = np.full((n_units,), np.nan)
+    label = np.empty([len(units)])
+    RefPViol = np.empty([len(units)])
+    NoiseCutoff = np.empty([len(units)])
+    MeanAmpTrue = np.empty([len(units)])
+    units_missing_metrics = set()
+    # pres_ratio fails for units without bins, i.e. with all their spikes at time 0
+    for unit in units_nonzeros[np.isnan(metrics['pres_ratio'])]:
+        print("Failed to compute 'pres_ratio' for unit {}.".format(unit))
+        units_missing_metrics.add(unit)
+    RefPViol[:n_units] = contamination_tests([s.get('times', unit) for unit in units_nonzeros])
+    # Mean amplitudes from the raw data, read once for all units
+    try:
+        mean_amps = peak_to_peak_amps(ephys_file, [s.get('samples', unit)
+                                                   for unit in units_nonzeros], nsamps=20)
+    except Exception:
+        mean_amps = None
+
+    for idx, unit in enumerate(units_nonzeros):
+        print('computing metrics for unit ' + str(unit) + '...')
+        ts = s.get('times', unit)
+        amps = s.get('amps', unit)
+
+        NoiseCutoff[idx] = noise_cutoff(amps, quartile_length=.25)
+
+        # create 'label' based on RPviol, NoiseCutoff, and MeanAmp
+        passed = RefPViol[idx] and NoiseCutoff[idx] < 20
+        if mean_amps is not None:
+            MeanAmpTrue[int(unit)] = mean_amps[idx]
+            label[idx] = int(passed and MeanAmpTrue[int(unit)] > 50)
+        else:
+            label[idx] = int(passed)
+
+        # Coefficient of variation of computed instantaneous firing rate.
+        try:
+            fr = bb.singlecell.firing_rate(ts, hist_win=0.01, fr_win=0.25)
+            cv_fr[idx] = np.std(fr) / np.mean(fr)
+        except Exception as err:
+            print("Failed to compute 'cv_fr' for unit {}. Details: \n {}".format(unit, err))
+            units_missing_metrics.add(unit)
+
+        # Estimated fraction of missing spikes.
+        try:
+            frac_missing_spks[idx], _, _ = feat_cutoff(
+                amps, spks_per_bin=10, sigma=4, min_num_bins=50)
+        except Exception as err:
+            print("Failed to compute 'frac_missing_spks' for unit {}. Details: \n {}"
+                  .format(unit, err))
+            units_missing_metrics.add(unit)
+
+    metrics.update({'cv_fr': cv_fr, 'frac_missing_spks': frac_missing_spks, 'label': label,
+                    'refp_viol': RefPViol, 'noise_cutoff': NoiseCutoff,
+                    'mean_amp_true': MeanAmpTrue, 'units_missing_metrics': units_missing_metrics})
+    return metrics
@@ -0,0 +1,101 @@
+"""
+Bulk synchronisation of phy curation results with the datajoint cluster tables.
+
+All rows are built in one pass from the phy cluster tables, rows whose content did not
+change since the last sync are skipped by comparing content hashes, and the remaining rows
+are inserted with a single batched insert per table inside one transaction.
+"""
+from datetime import datetime
+import hashlib
+import json
+
+import pandas as pd
+
+LABEL_FIELDS = ['cluster_uuid', 'cluster_label', 'cluster_note']
+
+
+def content_hash(cluster_uuid, cluster_label, cluster_note):
+    """
+    Hash of the content of a cluster label row
+    :param cluster_uuid: uuid of cluster
+    :param cluster_label: label assigned in phy, e.g 'good'
+    :param cluster_note: note assigned in phy
+    :return: sha1 hex digest
+    :type: str
+    """
+    values = [None if pd.isnull(val) else str(val)
+              for val in (cluster_uuid, cluster_label, cluster_note)]
+    return hashlib.sha1(json.dumps(values).encode()).hexdigest()
+
+
+def label_rows(cluster_info):
+    """
+    Cluster label rows of the phy cluster tables
+    :param cluster_info: phy clusters with columns 'cluster_uuid', 'group' and 'notes'
+    :type cluster_info: pandas.DataFrame
+    :return: rows with columns 'cluster_uuid', 'cluster_label', 'cluster_note' and 'hash'
+    :type: pandas.DataFrame
+    """
+    rows = pd.DataFrame({'cluster_uuid': cluster_info['cluster_uuid'].astype(str).values,
+                         'cluster_label': cluster_info['group'].values,
+                         'cluster_note': cluster_info['notes'].values
+                         if 'notes' in cluster_info else None})
+    rows = rows.astype(object).where(rows.notnull(), None)
+    rows['hash'] = [content_hash(*row) for row in rows[LABEL_FIELDS].itertuples(index=False)]
+    return rows
+
+
+def fetch_labels(cluster, user, cluster_uuids):
+    """
+    Labels of clusters stored by a user
+    :param cluster: ClusterLabel table
+    :param user: user name
+    :type user: str
+    :param cluster_uuids: uuids of clusters
+    :type cluster_uuids: list of str
+    :return: rows with columns 'cluster_uuid', 'cluster_label', 'cluster_note' and 'hash'
+    :type: pandas.DataFrame
+    """
+    restriction = [{'cluster_uuid': cluster_uuid} for cluster_uuid in cluster_uuids]
+    stored = (cluster & {'user_name': user} & restriction).fetch(*LABEL_FIELDS, as_dict=True) \
+        if restriction else []
+    stored = pd.DataFrame(list(stored), columns=LABEL_FIELDS)
+    stored['cluster_uuid'] = stored['cluster_uuid'].astype(str)
+    stored['hash'] = [content_hash(*row) for row in
+                      stored[LABEL_FIELDS].itertuples(index=False)]
+    return stored
+
+
+def sync_cluster_labels(cluster, cluster_info, user, label_time=None, merge=None,
+                        merge_rows=None):
+    """
+    Insert the new and changed labels of clusters, and new merged clusters, in one
+    transaction
+    :param cluster: ClusterLabel table, or any table with the same interface
+    :param cluster_info: phy clusters with columns 'cluster_uuid', 'group' and 'notes'
+    :type cluster_info: pandas.DataFrame
+    :param user: user name
+    :type user: str
+    :param label_time: time of labelling, defaults to now
+    :type label_time: datetime
+    :param merge: MergedClusters table
+    :param merge_rows: new rows of merged clusters
+    :type merge_rows: list of dict
+    :return: number of new labels and number of changed labels
+    :type: tuple of int
+    """
+    label_time = label_time or datetime.now().replace(microsecond=0)
+    rows = label_rows(cluster_info)
+    stored = fetch_labels(cluster, user, rows['cluster_uuid'].tolist())
+
+    is_new = ~rows['cluster_uuid'].isin(stored['cluster_uuid'])
+    is_changed = ~is_new & ~rows['hash'].isin(stored['hash'])
+    to_insert = rows[is_new | is_changed][LABEL_FIELDS]
+    to_insert = to_insert.assign(user_name=user, label_time=label_time).to_dict('records')
+
+    with cluster.connection.transaction:
+        if merge is not None and merge_rows:
+            merge.insert(merge_rows, allow_direct_insert=True)
+        if to_insert:
+            cluster.insert(to_insert, allow_direct_insert=True, replace=True)
+    return int(is_new.sum()), int(is_changed.sum())
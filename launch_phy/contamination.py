@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Refractory period contamination test of FP_RP.
+
+The autocorrelogram of FP_RP is only used through its cumulative sum at a few test bins and
+its sum from 1 to 2 s, i.e. through numbers of pairs of spikes closer than given delays. These
+are counted directly on the spike samples with one searchsorted per delay. Phylib zeroes the
+first bin of autocorrelograms, so pairs closer than one bin are counted too and subtracted.
+The Poisson thresholds of max_acceptable_cont are computed for all test bins (and units) at
+once.
+
+"""
+
+import numpy as np
+import scipy.stats as stats
+
+# Autocorrelogram parameters of FP_RP, phylib bins spike samples at 20 kHz
+SAMPLE_RATE = 20000
+BIN_SIZE = 0.25  # in ms
+WINDOW_SIZE = 2  # in s
+# Test bins, refractory periods tested are the upper edges of the bins
+TEST_BINS = np.array([5, 6, 7, 8, 10, 12, 14, 16, 18, 20, 24, 28, 32, 36, 40])
+RP_GRID = tuple((np.arange(0, 10.25, BIN_SIZE) / 1000 + 1e-6)[TEST_BINS])
+# Maximum contamination allowed, as a fraction of the firing rate, and confidence of the test
+ACCEPT_THRESH = 0.1
+THRESH = 0.2
+
+_BIN_SAMPLES = int(SAMPLE_RATE * BIN_SIZE / 1000)
+_HALF_WINDOW_BINS = int(.5 * WINDOW_SIZE / (BIN_SIZE / 1000))
+# Delays (in samples) below which pairs of spikes are counted: the first bin, which phylib
+# zeroes, the test bins, and the 1 to 2 s bins used to estimate the firing rate
+_TEST_DELAYS = (TEST_BINS + 1) * _BIN_SAMPLES
+_FR_DELAYS = np.array([_HALF_WINDOW_BINS // 2, _HALF_WINDOW_BINS + 1]) * _BIN_SAMPLES
+PAIR_DELAYS = np.r_[_BIN_SAMPLES, _TEST_DELAYS, _FR_DELAYS]
+
+
+def _n_pairs_within(samples, delays, chunk_size=2 ** 20):
+    '''
+    Number of pairs of spikes with a delay smaller than each of the given delays.
+
+    Parameters
+    ----------
+    samples : ndarray
+        Sorted spike samples.
+    delays : ndarray
+        Delays (in samples).
+
+    Returns
+    -------
+    n_pairs : ndarray
+        The number of pairs for each delay.
+    '''
+    n_pairs = np.zeros(len(delays), dtype=np.int64)
+    for i0 in range(0, len(samples), chunk_size):
+        chunk = samples[i0:i0 + chunk_size]
+        # spikes before samples + delay, minus the spike itself and the spikes before it. Keys
+        # are sorted for each delay, which makes searchsorted faster
+        n_after = np.searchsorted(samples, delays[:, np.newaxis] + chunk[np.newaxis, :])
+        n_pairs += np.sum(n_after, axis=1) - np.sum(np.arange(i0 + 1, i0 + len(chunk) + 1))
+    return n_pairs
+
+
+def _n_cross_pairs_within(samples_a, samples_b, delays):
+    '''
+    Number of pairs of a spike of `samples_a` and a spike of `samples_b` with a delay smaller
+    than each of the given delays.
+    '''
+    if len(samples_a) > len(samples_b):
+        samples_a, samples_b = samples_b, samples_a
+    n_pairs = np.zeros(len(delays), dtype=np.int64)
+    for i0 in range(0, len(samples_a), 2 ** 20):
+        chunk = samples_a[i0:i0 + 2 ** 20][np.newaxis, :]
+        n_pairs += np.sum(np.searchsorted(samples_b, chunk + delays[:, np.newaxis]) -
+                          np.searchsorted(samples_b, chunk - delays[:, np.newaxis], side='right'),
+                          axis=1)
+    return n_pairs
+
+
+def to_samples(ts):
+    '''
+    Spike times in samples, as binned by the phylib autocorrelogram of FP_RP.
+    '''
+    return (np.asarray(ts, dtype=np.float64) * SAMPLE_RATE).astype(np.int64)
+
+
+def pair_counts(samples):
+    '''
+    Number of pairs of spikes within each delay of PAIR_DELAYS. The counts of a merge of
+    spike trains are the sum of their counts and of their cross_pair_counts.
+    '''
+    return _n_pairs_within(samples, PAIR_DELAYS)
+
+
+def cross_pair_counts(samples_a, samples_b):
+    '''
+    Number of pairs of a spike from each spike train within each delay of PAIR_DELAYS.
+    '''
+    return _n_cross_pairs_within(samples_a, samples_b, PAIR_DELAYS)
+
+
+def rp_violations(ts, n_pairs=None):
+    '''
+    Refractory period violations and firing rate of a unit, from the same counts as the
+    autocorrelogram of FP_RP.
+
+    Parameters
+    ----------
+    ts : ndarray
+        The spike timestamps (in s).
+    n_pairs : ndarray (optional)
+        The pair_counts of the unit, computed if not given.
+
+    Returns
+    -------
+    res : ndarray
+        The number of pairs of spikes within each of the refractory periods of RP_GRID.
+    fr : float
+        The firing rate estimated from the autocorrelogram between 1 and 2 s.
+    '''
+    if n_pairs is None:
+        n_pairs = pair_counts(to_samples(ts))
+    # pairs in the first bin are not in the autocorrelogram
+    res = n_pairs[1:len(_TEST_DELAYS) + 1] - n_pairs[0]
+    n_bins_fr = _HALF_WINDOW_BINS // 2
+    fr = (n_pairs[-1] - n_pairs[-2]) / len(ts) / BIN_SIZE * 1000 / n_bins_fr
+    return res, fr
+
+
+def max_acceptable_table(fr, rec_duration, rp_grid=RP_GRID):
+    '''
+    Maximum number of refractory period violations allowed for each refractory period, see
+    max_acceptable_cont. Works on arrays of units, i.e. fr and rec_duration of shape (n_units,)
+    give a table of shape (n_units, len(rp_grid)).
+    '''
+    fr = np.asarray(fr, dtype=float)[..., np.newaxis]
+    rec_duration = np.asarray(rec_duration, dtype=float)[..., np.newaxis]
+    rp = np.asarray(rp_grid)
+    expected = (fr * ACCEPT_THRESH) * (rp * 2 * fr * rec_duration)
+    max_acceptable = stats.poisson.ppf(THRESH, expected)
+    no_spike = (max_acceptable == 0) & (stats.poisson.pmf(0, expected) > 0)
+    max_acceptable[no_spike] = -1
+    return max_acceptable
+
+
+def contamination_test(ts, n_pairs=None):
+    '''
+    Whether a unit passes the refractory period contamination test, same as FP_RP.
+
+    Parameters
+    ----------
+    ts : ndarray
+        The spike timestamps (in s).
+    n_pairs : ndarray (optional)
+        The pair_counts of the unit, computed if not given.
+
+    Returns
+    -------
+    didpass : int
+        1 if the number of violations is acceptable for any of the refractory periods tested.
+    '''
+    if not (len(ts) > 0 and ts[-1] > ts[0]):
+        return 0
+    res, fr = rp_violations(ts, n_pairs)
+    m = max_acceptable_table(fr, ts[-1] - ts[0])
+    return int(np.any(np.less_equal(res, m)))
+
+
+def contamination_tests(ts_list):
+    '''
+    Contamination test of several units, the Poisson thresholds of all units are computed at
+    once.
+
+    Parameters
+    ----------
+    ts_list : list of ndarray
+        The spike timestamps (in s) of each unit.
+
+    Returns
+    -------
+    didpass : ndarray
+        1 for units that pass the test, 0 otherwise.
+    '''
+    didpass = np.zeros(len(ts_list), dtype=int)
+    valid = [i for i, ts in enumerate(ts_list) if len(ts) > 0 and ts[-1] > ts[0]]
+    if not valid:
+        return didpass
+    counts = [rp_violations(ts_list[i]) for i in valid]
+    res = np.array([c[0] for c in counts])
+    fr = np.array([c[1] for c in counts])
+    rec_duration = np.array([ts_list[i][-1] - ts_list[i][0] for i in valid])
+    m = max_acceptable_table(fr, rec_duration)
+    didpass[valid] = np.any(np.less_equal(res, m), axis=1)
+    return didpass
@@ -22,34 +22,15 @@ from ibllib.io import spikeglx
 import scipy.stats as stats
 import scipy.ndimage.filters as filters
 from ibllib.io import spikeglx
+from contamination import contamination_test
+from raw_data import get_reader, noise_mad
 
 
 def FP_RP(ts):
-    binSize=0.25 #in ms
-    b= np.arange(0,10.25,binSize)/1000 + 1e-6 #bins in seconds
-    bTestIdx = [5, 6, 7, 8, 10, 12, 14, 16, 18, 20, 24, 28, 32, 36, 40]
-    bTest = [b[i] for i in bTestIdx]
-
-    thresh = 0.2
-    acceptThresh=0.1
-    if(len(ts)>0 and ts[-1]>ts[0]): #only do this for units with samples
-        recDur = (ts[-1]-ts[0])
-        c0 = correlograms(ts,np.zeros(len(ts),dtype='int8'),cluster_ids=[0],bin_size=binSize/1000,sample_rate=20000,window_size=2,symmetrize=False) #compute acg
-        cumsumc0 = np.cumsum(c0[0,0,:]) #cumulative sum of acg, i.e. number of total spikes occuring from 0 to end of that bin
-        res = cumsumc0[bTestIdx] #cumulative sum at each of the testing bins
-        total_spike_count = len(ts)
-
-        bin_count_normalized = c0[0,0]/total_spike_count/binSize*1000 #divide each bin's count by the unit's total spike count and the bin size
-        num_bins_2s = len(c0[0,0]) #number of total bins that equal 2 seconds
-        num_bins_1s = int(num_bins_2s/2) #number of bins that equal 1 second
-        fr = np.sum(bin_count_normalized[num_bins_1s:num_bins_2s])/num_bins_1s #compute fr based on the  mean of bin_count_normalized from 1 to 2 s instead of as before (len(ts)/recDur) for a better estimate
-        mfunc =np.vectorize(max_acceptable_cont)
-        m = mfunc(fr,bTest,recDur,fr*acceptThresh,thresh) #compute the maximum allowed number of spikes per testing bin
-        didpass = int(np.any(np.less_equal(res,m))) #did the unit pass (resulting number of spikes less than maximum allowed spikes) at any of the testing bins?
-    else:
-        didpass=0
-
-    return didpass
+    # Refractory period contamination test, see contamination.contamination_test. The number
+    # of violations is counted directly instead of from the autocorrelogram and the Poisson
+    # thresholds of all test bins are computed at once
+    return contamination_test(ts)
 
 
 
@@ -84,8 +65,8 @@ def noise_cutoff(amps,quartile_length=.2, nbins=100, end_low = 2):
 
 def peak_to_peak_amp(ephys_file, samp_inds, nsamps):
 
-    #read raw ephys file
-    sr = spikeglx.Reader(ephys_file)
+    #read raw ephys file, the reader is kept open for the next units
+    sr = get_reader(ephys_file)
 
     #take a subset (nsamps) of the spike samples
     samples = np.random.choice(samp_inds,nsamps)
@@ -639,30 +620,9 @@ def ptp_over_noise(ephys_file, ts, ch, t=2.0, sr=30000, n_ch_probe=385, dtype='i
         mean_ptp[cur_ch] = np.mean(np.max(wf[:, :, cur_ch], axis=1) -
                                    np.min(wf[:, :, cur_ch], axis=1))
 
-    # Compute MAD for `ch` in chunks.
-    s_reader = spikeglx.Reader(ephys_file)
-    file_m = s_reader.data  # the memmapped array
-    n_chunk_samples = 5e6  # number of samples per chunk
-    n_chunks = np.ceil(file_m.shape[0] / n_chunk_samples).astype('int')
-    # Get samples that make up each chunk. e.g. `chunk_sample[1] - chunk_sample[0]` are the
-    # samples that make up the first chunk.
-    chunk_sample = np.arange(0, file_m.shape[0], n_chunk_samples, dtype=int)
-    chunk_sample = np.append(chunk_sample, file_m.shape[0])
-    # Give time estimate for computing MAD.
-    t0 = time.perf_counter()
-    stats.median_absolute_deviation(file_m[chunk_sample[0]:chunk_sample[1], ch], axis=0)
-    dt = time.perf_counter() - t0
-    print('Performing MAD computation. Estimated time is {:.2f} mins.'
-          ' ({})'.format(dt * n_chunks / 60, time.ctime()))
-    # Compute MAD for each chunk, then take the median MAD of all chunks.
-    mad_chunks = np.zeros((n_chunks, ch.size), dtype=np.int16)
-    for chunk in range(n_chunks):
-        mad_chunks[chunk, :] = stats.median_absolute_deviation(
-            file_m[chunk_sample[chunk]:chunk_sample[chunk + 1], ch], axis=0, scale=1)
-    print('Done. ({})'.format(time.ctime()))
-
-    # Return `mean_ptp` over `mad`
-    mad = np.median(mad_chunks, axis=0)
+    # MAD of the noise, computed once in chunks for all channels of the file
+    mad = noise_mad(ephys_file, ch.ravel())
+
     ptp_sigma = mean_ptp / mad
     return ptp_sigma
 
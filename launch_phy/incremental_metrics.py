@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental cluster metrics for phy curation.
+
+Partial aggregates of each cluster are kept, and the aggregates of a cluster created by a
+merge are combined from those of the merged clusters:
+    - number of spikes, mean amplitude and sum of squared deviations from the mean (cv_amp),
+      merged with the pairwise update of Chan et al. so that cv_amp matches np.std
+    - spike counts in the 10 s bins of pres_ratio
+    - numbers of pairs of spikes within the refractory periods of FP_RP, a merge adds the
+      pairs across the merged clusters (see contamination.cross_pair_counts)
+Quantities that depend on the order of spikes in the merged train (ISI violations, drifts)
+and histograms whose bins depend on the cluster extent (noise_cutoff, feat_cutoff, firing
+rate) are computed in one vectorised pass over the spikes of the new cluster. Clusters
+created by splits are computed from their spikes, other clusters are not touched.
+
+"""
+
+import numpy as np
+from contamination import (to_samples, pair_counts, cross_pair_counts, contamination_test,
+                           PAIR_DELAYS)
+from defined_metrics import noise_cutoff, feat_cutoff
+
+# Refractory period of isi_viol and fp_est (in s)
+RP = 0.002
+# Time window of pres_ratio (in s)
+PRES_RATIO_WIN = 10
+
+
+def firing_rate(ts, hist_win=0.01, fr_win=0.5):
+    '''
+    Same as brainbox.singlecell.firing_rate, with the moving sum of spike counts computed
+    without a python loop over the `fr_win` windows.
+    '''
+    t_tot = ts[-1] - ts[0]
+    counts = np.histogram(ts, int(t_tot / hist_win))[0]
+    n_bins_fr = int(t_tot / fr_win)
+    step_sz = int(len(counts) / n_bins_fr)
+    return counts[:step_sz * n_bins_fr].reshape(n_bins_fr, step_sz).sum(axis=1) / fr_win
+
+
+def merge_moments(a, b):
+    '''
+    Number of values, mean and sum of squared deviations from the mean of the union of two
+    sets of values, from those of each set (Chan et al. pairwise update).
+    '''
+    (n_a, mean_a, m2_a), (n_b, mean_b, m2_b) = a, b
+    n = n_a + n_b
+    if n == 0:
+        return 0, 0., 0.
+    delta = mean_b - mean_a
+    return n, mean_a + delta * n_b / n, m2_a + m2_b + delta ** 2 * n_a * n_b / n
+
+
+class ClusterAggregates:
+    def __init__(self, spike_ids, times, amps, depths=None, edges=None, parents=None):
+        '''
+        Partial aggregates of the metrics of a cluster.
+
+        Parameters
+        ----------
+        spike_ids : ndarray
+            The sorted spike ids of the cluster.
+        times, amps, depths : ndarray
+            The times, amplitudes and depths (optional) of all spikes.
+        edges : ndarray
+            Edges of the presence ratio bins of the recording.
+        parents : list of ClusterAggregates (optional)
+            Aggregates of the clusters merged into this cluster, if given they are combined
+            instead of being computed from the spikes.
+        '''
+        self.spike_ids = np.asarray(spike_ids, dtype=np.int64)
+        # spike features are read from the arrays of all spikes when needed, only the
+        # aggregates and spike samples are kept in memory
+        self._spikes = (times, amps, depths)
+        self.n = self.spike_ids.size
+        self._metrics = None
+
+        if parents:
+            self.amp_moments = (0, 0., 0.)
+            for p in parents:
+                self.amp_moments = merge_moments(self.amp_moments, p.amp_moments)
+            self.pres_counts = np.zeros(max(p.pres_counts.size for p in parents), dtype=int)
+            for p in parents:
+                self.pres_counts[:p.pres_counts.size] += p.pres_counts
+            self.samples = np.sort(np.concatenate([p.samples for p in parents]))
+            self.n_pairs = sum(p.n_pairs for p in parents)
+            for i, p in enumerate(parents):
+                for q in parents[i + 1:]:
+                    self.n_pairs = self.n_pairs + cross_pair_counts(p.samples, q.samples)
+        else:
+            amps = self.amps
+            mean_amp = np.mean(amps) if self.n else 0.
+            self.amp_moments = (self.n, mean_amp, np.sum((amps - mean_amp) ** 2))
+            ts = self.times
+            spk_bin = np.searchsorted(edges, ts, side='right') - 1
+            self.pres_counts = np.bincount(spk_bin[spk_bin >= 0], minlength=1)
+            self.samples = to_samples(ts)
+            self.n_pairs = pair_counts(self.samples) if self.n else \
+                np.zeros(len(PAIR_DELAYS), dtype=np.int64)
+
+    @property
+    def times(self):
+        return self._spikes[0][self.spike_ids]
+
+    @property
+    def amps(self):
+        return np.asarray(self._spikes[1][self.spike_ids], dtype=float)
+
+    @property
+    def depths(self):
+        return self._spikes[2][self.spike_ids] if self._spikes[2] is not None else None
+
+    def metrics(self):
+        '''
+        Metrics of the cluster, with the names of the IBLMetricsPlugin metrics.
+        '''
+        if self._metrics is None:
+            self._metrics = self._compute_metrics()
+        return self._metrics
+
+    def _compute_metrics(self):
+        n, ts, amps = self.n, self.times, self.amps
+        m = dict.fromkeys(['cv_amp', 'cum_amp_drift', 'cum_depth_drift', 'cv_fr',
+                           'frac_isi_viol', 'frac_missing_spikes', 'fp_estimate',
+                           'presence_ratio', 'presence_ratio_std', 'refp_viol', 'noise_cutoff',
+                           'metrics_label'], np.nan)
+        if n == 0:
+            return m
+        with np.errstate(divide='ignore', invalid='ignore'):
+            _, mean_amp, m2_amp = self.amp_moments
+            m['cv_amp'] = np.sqrt(m2_amp / n) / mean_amp
+            m['cum_amp_drift'] = np.sum(np.abs(np.diff(amps))) / n if n >= 2 else 0
+            depths = self.depths
+            if depths is not None:
+                m['cum_depth_drift'] = np.sum(np.abs(np.diff(depths))) / n if n >= 2 else 0
+
+            # ISI violations, see isi_viol and fp_est
+            n_isi_viol = np.count_nonzero(np.diff(ts) < RP)
+            m['frac_isi_viol'] = n_isi_viol / n
+            c = ((ts[-1] - ts[0]) * n_isi_viol) / (2 * RP * n ** 2)
+            m['fp_estimate'] = (np.sqrt(1 + 4 * c) - 1) / 2
+
+            # Presence ratio from the bin counts, see pres_ratio
+            n_bins = np.arange(0, ts[-1] + PRES_RATIO_WIN, PRES_RATIO_WIN).size - 1
+            if n_bins > 0:
+                counts = np.zeros(n_bins, dtype=int)
+                counts[:min(n_bins, self.pres_counts.size)] = self.pres_counts[:n_bins]
+                # the last edge is included in the last bin
+                counts[-1] += np.sum(self.pres_counts[n_bins:])
+                m['presence_ratio'] = np.count_nonzero(counts) / n_bins
+                m['presence_ratio_std'] = m['presence_ratio'] / np.std(counts)
+
+        m['refp_viol'] = contamination_test(ts, self.n_pairs)
+        m['noise_cutoff'] = noise_cutoff(amps, quartile_length=.25)
+        m['metrics_label'] = int(m['refp_viol'] and m['noise_cutoff'] < 20)
+        try:
+            fr = firing_rate(ts, hist_win=0.01, fr_win=0.25)
+            m['cv_fr'] = np.std(fr) / np.mean(fr) if len(fr) >= 1 else 0
+        except Exception:
+            pass
+        try:
+            m['frac_missing_spikes'], _, _ = feat_cutoff(
+                amps, spks_per_bin=10, sigma=4, min_num_bins=50)
+        except Exception:
+            pass
+        return m
+
+
+class IncrementalMetrics:
+    def __init__(self, spike_times, spike_amps, get_spike_ids, spike_depths=None):
+        '''
+        Cluster metrics updated incrementally on phy cluster events.
+
+        Parameters
+        ----------
+        spike_times, spike_amps : ndarray
+            The times and amplitudes of all spikes.
+        get_spike_ids : function
+            Returns the sorted spike ids of a cluster id.
+        spike_depths : ndarray (optional)
+            The depths of all spikes.
+        '''
+        self.times = spike_times
+        self.amps = spike_amps
+        self.depths = spike_depths
+        self.get_spike_ids = get_spike_ids
+        last = np.max(spike_times) if len(spike_times) else 0
+        self.edges = np.arange(0, last + PRES_RATIO_WIN, PRES_RATIO_WIN)
+        # Aggregates by cluster id. Phy never reuses cluster ids, so aggregates of deleted
+        # clusters are kept and reused when a merge or split is undone
+        self.clusters = {}
+
+    def _aggregates(self, spike_ids, parents=None):
+        return ClusterAggregates(spike_ids, self.times, self.amps, self.depths, self.edges,
+                                 parents=parents)
+
+    def get(self, cluster_id):
+        '''
+        Aggregates of a cluster, computed from its spikes the first time.
+        '''
+        if cluster_id not in self.clusters:
+            self.clusters[cluster_id] = self._aggregates(self.get_spike_ids(cluster_id))
+        return self.clusters[cluster_id]
+
+    def metric(self, name, cluster_id):
+        return self.get(cluster_id).metrics()[name]
+
+    def on_cluster(self, up):
+        '''
+        Updates the aggregates after a phy cluster event (see phylib UpdateInfo): the
+        aggregates of a merged cluster are combined from the merged clusters, clusters created
+        by splits are computed from their spikes the next time their metrics are requested.
+        '''
+        added = [c for c in getattr(up, 'added', []) if c not in self.clusters]
+        if getattr(up, 'description', None) != 'merge' or len(added) != 1:
+            return
+        deleted = list(getattr(up, 'deleted', []))
+        old_spikes = getattr(up, 'old_spikes_per_cluster', None) or {}
+        parents = []
+        for cluster_id in deleted:
+            if cluster_id not in self.clusters and cluster_id in old_spikes:
+                self.clusters[cluster_id] = self._aggregates(old_spikes[cluster_id])
+            if cluster_id not in self.clusters:
+                return
+            parents.append(self.clusters[cluster_id])
+        spike_ids = np.sort(np.concatenate([p.spike_ids for p in parents]))
+        self.clusters[added[0]] = self._aggregates(spike_ids, parents=parents)
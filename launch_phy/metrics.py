@@ -26,6 +26,7 @@ import brainbox as bb
 from phylib.stats import correlograms
 import pandas as pd
 from defined_metrics import *
+from batch_metrics import gen_unit_metrics
 
 
 
@@ -37,12 +38,6 @@ def gen_metrics_labels(eid,probe_name):
     alf_probe_dir = os.path.join(ses_path, 'alf', probe_name)
     ks_dir = alf_probe_dir
     spks_b = aio.load_object(alf_probe_dir, 'spikes')
-    units_b = bb.processing.get_units_bunch(spks_b)
-    units = list(units_b.amps.keys())
-    lengths_samples = [len(v) for k, v in units_b.samples.items()]
-    units_nonzeros=[i for i,d in enumerate(lengths_samples) if d>0]
-    n_units = len(units_nonzeros) #only compute metrics for units with no samples
-
 
     #for cases where raw data is available locally:
     ephys_file_dir = os.path.join(ses_path, 'raw_ephys_data', probe_name)
@@ -59,135 +54,26 @@ def gen_metrics_labels(eid,probe_name):
         uidx=0''' )
         f.close()
 
-    # Initialize metrics
-    cum_amp_drift = np.full((n_units,), np.nan)
-    cum_depth_drift = np.full((n_units,), np.nan)
-    cv_amp = np.full((n_units,), np.nan)
-    cv_fr = np.full((n_units,), np.nan)
-    frac_isi_viol = np.full((n_units,), np.nan)
-    frac_missing_spks = np.full((n_units,), np.nan)
-    fp_estimate = np.full((n_units,), np.nan)
-    presence_ratio = np.full((n_units,), np.nan)
-    pres_ratio_std = np.full((n_units,), np.nan)
-    ptp_sigma = np.full((n_units,), np.nan)
-
-    units_missing_metrics = set()
-    label=np.empty([len(units)])
-    RefPViol = np.empty([len(units)])
-    NoiseCutoff = np.empty([len(units)])
-    MeanAmpTrue = np.empty([len(units)])
-
-    for idx,unit in enumerate(units_nonzeros):
-        if unit == units_nonzeros[0]:
-            t0 = time.perf_counter()  # used for computation time estimate
-
-        print('computing metrics for unit ' + str(unit) + '...' )
-
-        #load relevant data for unit
-        ts = units_b['times'][str(unit)]
-        amps = units_b['amps'][str(unit)]
-        samples = units_b['samples'][str(unit)]
-        depths = units_b['depths'][str(unit)]
-
-
-        RefPViol[idx] = FP_RP(ts)
-        NoiseCutoff[idx] = noise_cutoff(amps,quartile_length=.25)
-
-        #create 'label' based on RPviol,NoiseCutoff, and MeanAmp
-        if len(samples>50): #only compute mean amplitude for units with more than 50 samples
-            try:
-                MeanAmpTrue[int(unit)] = peak_to_peak_amp(ephys_file, samples, nsamps=20)
-
-                if (FP_RP(ts) and noise_cutoff(amps,quartile_length=.25)<20 and MeanAmpTrue[int(unit)]>50) :
-                    label[idx] = 1
-                else:
-                    label[idx] = 0
-            except:
-                if (FP_RP(ts) and noise_cutoff(amps,quartile_length=.25)<20) :
-                    label[idx] = 1
-                else:
-                    label[idx] = 0
-
-        else: #no ephys file, do not include true mean amps
-            if (FP_RP(ts) and noise_cutoff(amps,quartile_length=.25)<20) :
-                label[idx] = 1
-            else:
-                label[idx] = 0
-
-
-
-        #now compute additional metrics that label does not depend on:
-
-        # Cumulative drift of spike amplitudes, normalized by total number of spikes.
-        try:
-            cum_amp_drift[idx] = cum_drift(amps)
-        except Exception as err:
-            print("Failed to compute 'cum_drift(amps)' for unit {}. Details: \n {}"
-                  .format(unit, err))
-            units_missing_metrics.add(unit)
-
-        # Cumulative drift of spike depths, normalized by total number of spikes.
-        try:
-            cum_depth_drift[idx] = cum_drift(depths)
-        except Exception as err:
-            print("Failed to compute 'cum_drift(depths)' for unit {}. Details: \n {}"
-                  .format(unit, err))
-            units_missing_metrics.add(unit)
-
-        # Coefficient of variation of spike amplitudes.
-        try:
-            cv_amp[idx] = np.std(amps) / np.mean(amps)
-        except Exception as err:
-            print("Failed to compute 'cv_amp' for unit {}. Details: \n {}".format(unit, err))
-            units_missing_metrics.add(unit)
-
-        # Coefficient of variation of computed instantaneous firing rate.
-        try:
-            fr = bb.singlecell.firing_rate(ts, hist_win=0.01, fr_win=0.25)
-            cv_fr[idx] = np.std(fr) / np.mean(fr)
-        except Exception as err:
-            print("Failed to compute 'cv_fr' for unit {}. Details: \n {}".format(unit, err))
-            units_missing_metrics.add(unit)
-
-        # Fraction of isi violations.
-        try:
-            frac_isi_viol[idx], _, _ = isi_viol(ts, rp=0.002)
-        except Exception as err:
-            print("Failed to compute 'frac_isi_viol' for unit {}. Details: \n {}"
-                  .format(unit, err))
-            units_missing_metrics.add(unit)
-
-        # Estimated fraction of missing spikes.
-        try:
-            frac_missing_spks[idx], _, _ = feat_cutoff(
-                amps, spks_per_bin=10, sigma=4, min_num_bins=50)
-        except Exception as err:
-            print("Failed to compute 'frac_missing_spks' for unit {}. Details: \n {}"
-                  .format(unit, err))
-            units_missing_metrics.add(unit)
-
-        # Estimated fraction of false positives.
-        try:
-            fp_estimate[idx] = fp_est(ts, rp=0.002)
-        except Exception as err:
-            print("Failed to compute 'fp_est' for unit {}. Details: \n {}".format(unit, err))
-            units_missing_metrics.add(unit)
-
-        # Presence ratio
-        try:
-            presence_ratio[idx], _ = pres_ratio(ts, hist_win=10)
-        except Exception as err:
-            print("Failed to compute 'pres_ratio' for unit {}. Details: \n {}".format(unit, err))
-            units_missing_metrics.add(unit)
-
-        # Presence ratio over the standard deviation of spike counts in each bin
-        try:
-            pr, pr_bins = pres_ratio(ts, hist_win=10)
-            pres_ratio_std[idx] = pr / np.std(pr_bins)
-        except Exception as err:
-            print("Failed to compute 'pres_ratio_std' for unit {}. Details: \n {}"
-                  .format(unit, err))
-            units_missing_metrics.add(unit)
+    # Compute metrics and labels of all units at once, see batch_metrics
+    t0 = time.perf_counter()
+    unit_metrics = gen_unit_metrics(spks_b, ephys_file)
+    print('computed metrics of {} units in {:.1f} s'.format(
+        len(unit_metrics['units_nonzeros']), time.perf_counter() - t0))
+    units = unit_metrics['units']
+    label = unit_metrics['label']
+    RefPViol = unit_metrics['refp_viol']
+    NoiseCutoff = unit_metrics['noise_cutoff']
+    MeanAmpTrue = unit_metrics['mean_amp_true']
+    cum_amp_drift = unit_metrics['cum_amp_drift']
+    cum_depth_drift = unit_metrics['cum_depth_drift']
+    cv_amp = unit_metrics['cv_amp']
+    cv_fr = unit_metrics['cv_fr']
+    frac_isi_viol = unit_metrics['frac_isi_viol']
+    frac_missing_spks = unit_metrics['frac_missing_spks']
+    fp_estimate = unit_metrics['fp_est']
+    presence_ratio = unit_metrics['pres_ratio']
+    pres_ratio_std = unit_metrics['pres_ratio_std']
+    units_missing_metrics = unit_metrics['units_missing_metrics']
 
 
     #append metrics to the current clusters.metrics
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Precomputed cluster metrics of the IBLMetricsPlugin.
+
+The metrics shown in phy are computed for all clusters in one batch (see batch_metrics) and
+saved as columns in a sidecar file next to the spikes. The plugin reads a metric from the
+sidecar when the cluster id and its number of spikes match the sidecar, i.e. when the spikes
+of the cluster did not change, and only computes metrics of clusters created by merges or
+splits. Phy never reuses cluster ids, so new clusters are never mistaken for old ones.
+
+"""
+
+import os
+from pathlib import Path
+import numpy as np
+import alf.io as aio
+import brainbox as bb
+from batch_metrics import SortedSpikes, batch_unit_metrics
+from contamination import contamination_test, contamination_tests
+from defined_metrics import noise_cutoff, feat_cutoff
+
+SIDECAR_FILE = 'clusters.iblMetrics.npz'
+# Columns of the plugin metrics saved in the sidecar, the waveform based mean_amp is computed
+# by phy
+SIDECAR_METRICS = ['cv_amp', 'cum_amp_drift', 'cum_depth_drift', 'cv_fr', 'frac_isi_viol',
+                   'frac_missing_spikes', 'fp_estimate', 'presence_ratio', 'presence_ratio_std',
+                   'refp_viol', 'noise_cutoff', 'metrics_label']
+
+
+def compute_cluster_metrics(spks_b):
+    '''
+    Computes the metrics of the IBLMetricsPlugin for all clusters with spikes.
+
+    Parameters
+    ----------
+    spks_b : bunch
+        A spikes bunch with fields 'clusters', 'times', 'amps' and 'depths'.
+
+    Returns
+    -------
+    metrics : dict
+        'cluster_id', 'n_spikes' and a column for each metric of SIDECAR_METRICS.
+    '''
+    s = SortedSpikes(spks_b)
+    cluster_ids = np.where(s.counts > 0)[0]
+    batch = {key: val[cluster_ids] for key, val in batch_unit_metrics(s).items()}
+    metrics = {'cluster_id': cluster_ids, 'n_spikes': s.counts[cluster_ids],
+               'cv_amp': batch['cv_amp'],
+               'cum_amp_drift': batch['cum_amp_drift'],
+               'cum_depth_drift': batch['cum_depth_drift'],
+               'frac_isi_viol': batch['frac_isi_viol'],
+               'fp_estimate': batch['fp_est'],
+               'presence_ratio': batch['pres_ratio'],
+               'presence_ratio_std': batch['pres_ratio_std']}
+
+    try:
+        metrics['refp_viol'] = contamination_tests([s.get('times', c) for c in cluster_ids])
+    except Exception:
+        # Test the clusters one by one so that a single cluster does not fail all of them
+        metrics['refp_viol'] = np.full(cluster_ids.size, np.nan)
+        for idx, cluster_id in enumerate(cluster_ids):
+            try:
+                metrics['refp_viol'][idx] = contamination_test(s.get('times', cluster_id))
+            except Exception:
+                pass
+    for name in ['cv_fr', 'frac_missing_spikes', 'noise_cutoff']:
+        metrics[name] = np.full(cluster_ids.size, np.nan)
+    for idx, cluster_id in enumerate(cluster_ids):
+        ts = s.get('times', cluster_id)
+        amps = s.get('amps', cluster_id)
+        try:
+            metrics['noise_cutoff'][idx] = noise_cutoff(amps, quartile_length=.25)
+        except Exception:
+            pass
+        try:
+            fr = bb.singlecell.firing_rate(ts, hist_win=0.01, fr_win=0.25)
+            metrics['cv_fr'][idx] = np.std(fr) / np.mean(fr) if len(fr) >= 1 else 0
+        except Exception:
+            pass
+        try:
+            metrics['frac_missing_spikes'][idx], _, _ = feat_cutoff(
+                amps, spks_per_bin=10, sigma=4, min_num_bins=50)
+        except Exception:
+            pass
+    metrics['metrics_label'] = ((metrics['refp_viol'] == 1) &
+                                (metrics['noise_cutoff'] < 20)).astype(int)
+    return metrics
+
+
+def write_sidecar(alf_probe_dir):
+    '''
+    Computes the plugin metrics of all clusters and saves them in the sidecar file.
+
+    Parameters
+    ----------
+    alf_probe_dir : string
+        The folder of the spikes of a probe.
+
+    Returns
+    -------
+    sidecar_file : Path
+    '''
+    spks_b = aio.load_object(alf_probe_dir, 'spikes')
+    metrics = compute_cluster_metrics(spks_b)
+    sidecar_file = Path(alf_probe_dir, SIDECAR_FILE)
+    tmp_file = sidecar_file.with_suffix('.tmp.npz')
+    np.savez(tmp_file, **metrics)
+    os.replace(tmp_file, sidecar_file)
+    return sidecar_file
+
+
+def is_stale(alf_probe_dir):
+    '''
+    Whether the sidecar is missing or older than the spike clusters it was computed from.
+    '''
+    sidecar_file = Path(alf_probe_dir, SIDECAR_FILE)
+    if not sidecar_file.exists():
+        return True
+    clusters_files = list(Path(alf_probe_dir).glob('spikes.clusters*.npy'))
+    return any(f.stat().st_mtime > sidecar_file.stat().st_mtime for f in clusters_files)
+
+
+class MetricsSidecar:
+    def __init__(self, sidecar_file):
+        '''
+        Metrics of a sidecar file, looked up by cluster id.
+
+        Parameters
+        ----------
+        sidecar_file : string
+            The file path to the sidecar.
+        '''
+        with np.load(sidecar_file) as data:
+            self.columns = {key: data[key] for key in data.files}
+        self.rows = {int(c): i for i, c in enumerate(self.columns['cluster_id'])}
+
+    @classmethod
+    def load(cls, alf_probe_dir):
+        '''
+        The sidecar of a probe folder, None if there is none.
+        '''
+        sidecar_file = Path(alf_probe_dir, SIDECAR_FILE)
+        if not sidecar_file.exists():
+            return None
+        try:
+            return cls(sidecar_file)
+        except Exception as err:
+            print("Could not load metrics sidecar {}. Details: \n {}".format(sidecar_file, err))
+            return None
+
+    def get(self, name, cluster_id, n_spikes):
+        '''
+        Metric of a cluster, None if the cluster or metric is not in the sidecar or the
+        number of spikes of the cluster changed.
+        '''
+        row = self.rows.get(int(cluster_id))
+        if (row is None or name not in self.columns or
+                self.columns['n_spikes'][row] != n_spikes):
+            return None
+        return self.columns[name][row].item()
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Precompute the metrics shown in phy for a probe')
+    parser.add_argument('alf_probe_dir', help='Folder with the spikes of a probe')
+    args = parser.parse_args()
+    print('Metrics saved in {}'.format(write_sidecar(args.alf_probe_dir)))
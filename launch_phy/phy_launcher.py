@@ -7,13 +7,19 @@ from phy.gui.qt import create_app, run_app
 from phylib import add_default_handler
 from oneibl.one import ONE
 from metrics import gen_metrics_labels
+from metrics_sidecar import SIDECAR_FILE, is_stale, write_sidecar
 from defined_metrics import *
 
 
-def launch_phy(probe_name, eid=None, subj=None, date=None, sess_no=None, one=None):
+def launch_phy(probe_name, eid=None, subj=None, date=None, sess_no=None, one=None,
+               precompute_metrics=True):
     """
     Launch phy given an eid and probe name.
 
+    If precompute_metrics, the metrics shown in phy are computed for all clusters before
+    launching and saved in a sidecar file (see metrics_sidecar), so phy only computes metrics
+    of clusters changed during curation.
+
     TODO calculate metrics and save as .tsvs to include in GUI when launching?
     """
 
@@ -62,6 +68,17 @@ def launch_phy(probe_name, eid=None, subj=None, date=None, sess_no=None, one=Non
 
     # TODO download ephys meta-data, and extract TemplateController input arg params
 
+    if precompute_metrics and is_stale(alf_probe_dir):
+        print('Precomputing cluster metrics...')
+        try:
+            write_sidecar(alf_probe_dir)
+        except Exception as err:
+            # Launch without a sidecar, the plugin computes the metrics of each cluster
+            print("Could not precompute cluster metrics. Details: \n {}".format(err))
+            sidecar_file = os.path.join(alf_probe_dir, SIDECAR_FILE)
+            if os.path.exists(sidecar_file):
+                os.remove(sidecar_file)
+
     # Launch phy #
     # -------------------- #
     add_default_handler('DEBUG', logging.getLogger("phy"))
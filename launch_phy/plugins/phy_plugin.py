@@ -1,11 +1,14 @@
 # import from plugins/cluster_metrics.py
 """Show how to add a custom cluster metrics."""
 
+import functools
 import logging
 import numpy as np
-from phy import IPlugin
+from phy import IPlugin, connect
 #import brainbox as bb
 from defined_metrics import *
+from metrics_sidecar import MetricsSidecar
+from incremental_metrics import IncrementalMetrics
 
 
 class IBLMetricsPlugin(IPlugin):
@@ -123,6 +126,47 @@ class IBLMetricsPlugin(IPlugin):
             # if amplitudes are correct (i.e. raw data or sample wfs exist):
             #metrics_label = (FP_RP(ts) and noise_cutoff(amps,quartile_length=.25)<20 and np.mean(amps)>50)
 
+        # Metrics precomputed by metrics_sidecar for the clusters whose spikes did not change
+        # since. Other clusters (e.g. created by merges or splits) are computed by the
+        # incremental engine, which combines the aggregates of merged clusters
+        sidecar = MetricsSidecar.load(controller.dir_path)
+        engine = IncrementalMetrics(controller.model.spike_times, controller.model.amplitudes,
+                                    controller.get_spike_ids,
+                                    getattr(controller.model, 'spike_depths', None))
+
+        @connect
+        def on_cluster(sender, up):
+            engine.on_cluster(up)
+
+        def ibl_metric(func, name):
+            @functools.wraps(func)
+            def metric(cluster_id):
+                if sidecar is not None:
+                    n_spikes = len(controller.get_spike_ids(cluster_id))
+                    value = sidecar.get(name, cluster_id, n_spikes)
+                    if value is not None:
+                        return value
+                try:
+                    return engine.metric(name, cluster_id)
+                except Exception as err:
+                    print("Failed to compute '{}' incrementally for cluster {}. Details: \n {}"
+                          .format(name, cluster_id, err))
+                    return func(cluster_id)
+            return metric
+
+        cv_amp = ibl_metric(cv_amp, 'cv_amp')
+        cum_amp_drift = ibl_metric(cum_amp_drift, 'cum_amp_drift')
+        cum_depth_drift = ibl_metric(cum_depth_drift, 'cum_depth_drift')
+        cv_fr = ibl_metric(cv_fr, 'cv_fr')
+        frac_isi_viol = ibl_metric(frac_isi_viol, 'frac_isi_viol')
+        frac_missing_spikes = ibl_metric(frac_missing_spikes, 'frac_missing_spikes')
+        fp_estimate = ibl_metric(fp_estimate, 'fp_estimate')
+        presence_ratio = ibl_metric(presence_ratio, 'presence_ratio')
+        presence_ratio_std = ibl_metric(presence_ratio_std, 'presence_ratio_std')
+        refp_viol = ibl_metric(refp_viol, 'refp_viol')
+        n_cutoff = ibl_metric(n_cutoff, 'noise_cutoff')
+        m_label = ibl_metric(m_label, 'metrics_label')
+
         # Use this dictionary to define custom cluster metrics.
         # We memcache the function so that cluster metrics are only computed once and saved
         # within the session, and also between sessions (the memcached values are also saved
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Shared access to the raw ephys data for the waveform based metrics.
+
+One spikeglx reader is kept open per file, the samples requested for all units are read in
+a single pass in file order, and the MAD of the background noise is computed once for all
+channels of a file.
+
+"""
+
+import threading
+import time
+from pathlib import Path
+import numpy as np
+from ibllib.io import spikeglx
+
+# Number of samples per chunk used to compute the MAD of the noise
+N_CHUNK_SAMPLES = 5e6
+# Number of channels read at once when computing the MAD of the noise
+N_CHUNK_CHANNELS = 32
+
+_readers = {}
+_noise_mads = {}
+_lock = threading.Lock()
+
+
+def get_reader(ephys_file):
+    '''
+    Returns the open reader of a raw ephys file, the file is only opened the first time.
+
+    Parameters
+    ----------
+    ephys_file : string
+        The file path to the binary ephys data.
+
+    Returns
+    -------
+    reader : spikeglx.Reader
+    '''
+    key = str(Path(ephys_file).resolve())
+    with _lock:
+        if key not in _readers:
+            _readers[key] = spikeglx.Reader(ephys_file)
+        return _readers[key]
+
+
+def close_readers():
+    '''
+    Closes all open readers and forgets the noise MADs computed.
+    '''
+    with _lock:
+        for reader in _readers.values():
+            try:
+                reader.close()
+            except Exception:
+                pass
+        _readers.clear()
+        _noise_mads.clear()
+
+
+def read_samples(reader, samples):
+    '''
+    Reads the raw data of all channels at given samples, in file order.
+
+    Parameters
+    ----------
+    reader : spikeglx.Reader
+        The reader of the raw ephys data.
+    samples : ndarray
+        The samples to read, in any order and possibly repeated.
+
+    Returns
+    -------
+    data : ndarray
+        The data of shape (len(samples), n_channels), in the order of `samples`.
+    '''
+    samples = np.asarray(samples, dtype=np.int64)
+    unique_samples, inverse = np.unique(samples, return_inverse=True)
+    rows = np.stack([reader.data[int(i)] for i in unique_samples]) if unique_samples.size \
+        else np.zeros((0, reader.data.shape[1]))
+    return rows[inverse]
+
+
+def peak_to_peak_amps(ephys_file, samp_inds_list, nsamps=20):
+    '''
+    Computes peak_to_peak_amp for several units, reading the raw data once for all units.
+
+    Parameters
+    ----------
+    ephys_file : string
+        The file path to the binary ephys data.
+    samp_inds_list : list of ndarray
+        The spike samples of each unit.
+    nsamps : int
+        The number of spikes (drawn with replacement) used for each unit.
+
+    Returns
+    -------
+    mean_amps : ndarray
+        The mean peak to peak amplitude of each unit.
+    '''
+    reader = get_reader(ephys_file)
+    # Draw samples unit by unit, as peak_to_peak_amp does
+    samples = [np.random.choice(samp_inds, nsamps) for samp_inds in samp_inds_list]
+    wfs = read_samples(reader, np.concatenate(samples) if samples else [])
+    # Drop the sync channel, the median baseline does not change the peak to peak amplitudes
+    wfs = wfs[:, :-1].astype(float)
+    amps = np.max(wfs, axis=1) - np.min(wfs, axis=1)
+    return amps.reshape(len(samples), nsamps).mean(axis=1)
+
+
+def _mad(x):
+    return np.median(np.abs(x - np.median(x, axis=0)), axis=0)
+
+
+def noise_mad(ephys_file, ch=None):
+    '''
+    Computes the MAD of the background noise of channels, see ptp_over_noise. The MAD is
+    computed for all channels the first time and kept for the file.
+
+    Parameters
+    ----------
+    ephys_file : string
+        The file path to the binary ephys data.
+    ch : ndarray_like (optional)
+        The channels, all channels if None.
+
+    Returns
+    -------
+    mad : ndarray
+        The median of the MADs of all chunks of the file, for each channel.
+    '''
+    key = str(Path(ephys_file).resolve())
+    if key not in _noise_mads:
+        file_m = get_reader(ephys_file).data
+        n_samples, n_channels = file_m.shape
+        n_chunks = np.ceil(n_samples / N_CHUNK_SAMPLES).astype('int')
+        chunk_sample = np.arange(0, n_samples, N_CHUNK_SAMPLES, dtype=int)
+        chunk_sample = np.append(chunk_sample, n_samples)
+        print('Performing MAD computation of {} chunks. ({})'.format(n_chunks, time.ctime()))
+        mad_chunks = np.zeros((n_chunks, n_channels), dtype=np.int16)
+        for chunk in range(n_chunks):
+            for c0 in range(0, n_channels, N_CHUNK_CHANNELS):
+                c1 = min(c0 + N_CHUNK_CHANNELS, n_channels)
+                mad_chunks[chunk, c0:c1] = _mad(
+                    file_m[chunk_sample[chunk]:chunk_sample[chunk + 1], c0:c1])
+        print('Done. ({})'.format(time.ctime()))
+        with _lock:
+            _noise_mads[key] = np.median(mad_chunks, axis=0)
+    mad = _noise_mads[key]
+    return mad if ch is None else mad[np.asarray(ch)]
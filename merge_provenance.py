@@ -0,0 +1,153 @@
+"""
+Provenance of the clusters curated in phy, shared by the apps of the repository.
+
+Phy merges and splits clusters by reassigning spikes, the template that kilosort assigned to
+each spike is kept. The contingency table of (cluster, template) pairs with their number of
+spikes is built in one pass over the spikes, by sorting combined int64 keys with np.unique,
+and answers the provenance queries without masking the spikes of each cluster:
+
+    from merge_provenance import MergeProvenance
+    provenance = MergeProvenance(spikes_clusters, spikes_templates)
+    merges = provenance.merges()
+    templates = provenance.templates_of(good_clusters)
+"""
+from pathlib import Path
+
+import numpy as np
+
+# Number of spikes scanned at once when looking for the first spike of templates
+CHUNK_SPIKES = 2 ** 20
+
+
+class MergeProvenance:
+    def __init__(self, spike_clusters, spike_templates):
+        """
+        Table of the number of spikes of each template in each cluster, only pairs with
+        spikes are stored (sparse COO table sorted by cluster then template)
+        :param spike_clusters: cluster of each spike after curation
+        :type spike_clusters: np.array(int)
+        :param spike_templates: template (original cluster) of each spike
+        :type spike_templates: np.array(int)
+        """
+        spike_clusters = np.asarray(spike_clusters)
+        spike_templates = np.asarray(spike_templates)
+        assert spike_clusters.shape == spike_templates.shape
+        n_templates = int(spike_templates.max()) + 1 if spike_templates.size else 1
+        keys = spike_clusters.astype(np.int64) * n_templates + spike_templates
+        keys, n_spikes = np.unique(keys, return_counts=True)
+
+        self.clusters = keys // n_templates
+        self.templates = keys % n_templates
+        self.n_spikes = n_spikes
+        # spikes are kept to look up the first spike of templates split across clusters
+        self.spike_clusters = spike_clusters
+        self.spike_templates = spike_templates
+
+    @classmethod
+    def from_folder(cls, folder, clusters_file='spikes.clusters.npy',
+                    templates_file='spikes.templates.npy'):
+        """
+        Table of the spike clusters and templates files of a folder, None if one is missing
+        :param folder: alf probe folder, or ks_matlab folder with clusters_file and
+        templates_file set to 'spike_clusters.npy' and 'spike_templates.npy'
+        :type folder: str or Path
+        :return: MergeProvenance or None
+        """
+        clusters_path = Path(folder, clusters_file)
+        templates_path = Path(folder, templates_file)
+        if not (clusters_path.exists() and templates_path.exists()):
+            return None
+        return cls(np.load(clusters_path, mmap_mode='r'), np.load(templates_path, mmap_mode='r'))
+
+    def cluster_ids(self):
+        """
+        :return: ids of clusters with spikes
+        :type: np.array(int)
+        """
+        return np.unique(self.clusters)
+
+    def template_ids(self):
+        """
+        :return: ids of templates with spikes
+        :type: np.array(int)
+        """
+        return np.unique(self.templates)
+
+    def merged_templates(self):
+        """
+        Templates whose id is not a cluster id anymore, i.e. that were merged into another
+        cluster (or whose spikes were all moved to new clusters by splits)
+        :return: ids of merged templates
+        :type: np.array(int)
+        """
+        return np.setdiff1d(self.template_ids(), self.cluster_ids())
+
+    def first_spikes(self, templates):
+        """
+        Index of the first spike of each template. The spikes are scanned in chunks until all
+        templates are found, which is usually in the first chunk
+        :param templates: ids of templates with spikes
+        :type templates: np.array(int)
+        :return: spike index of each template
+        :type: np.array(int)
+        """
+        templates = np.asarray(templates)
+        order = np.argsort(templates)
+        sorted_templates = templates[order]
+        first = np.full(templates.size, -1, dtype=np.int64)
+        for start in range(0, self.spike_templates.size, CHUNK_SPIKES):
+            if np.all(first >= 0):
+                break
+            chunk_templates, idx = np.unique(self.spike_templates[start:start + CHUNK_SPIKES],
+                                             return_index=True)
+            pos = np.searchsorted(sorted_templates, chunk_templates)
+            found = pos < sorted_templates.size
+            found[found] = sorted_templates[pos[found]] == chunk_templates[found]
+            new = order[pos[found]]
+            keep = first[new] < 0
+            first[new[keep]] = start + idx[found][keep]
+        assert np.all(first >= 0)
+        return first
+
+    def cluster_of_templates(self, templates):
+        """
+        Cluster that the first spike of each template belongs to
+        :param templates: ids of templates with spikes
+        :type templates: np.array(int)
+        :return: cluster id of each template
+        :type: np.array(int)
+        """
+        return np.asarray(self.spike_clusters[self.first_spikes(templates)], dtype=np.int64)
+
+    def merges(self):
+        """
+        Templates merged into each cluster, the merged templates are assigned to the cluster of
+        their first spike
+        :return: dict of cluster id: list of merged template ids in ascending order, clusters
+        ordered by their first merged template
+        :type: dict
+        """
+        merged = self.merged_templates()
+        merges = {}
+        for cluster, template in zip(self.cluster_of_templates(merged).tolist(),
+                                     merged.tolist()):
+            merges.setdefault(cluster, []).append(template)
+        return merges
+
+    def templates_of(self, clusters, min_fraction=0.5):
+        """
+        Templates whose spikes are mostly in the given clusters, e.g. to map clusters labelled
+        in phy to the original clusters of the alf spikes
+        :param clusters: cluster ids
+        :type clusters: np.array(int)
+        :param min_fraction: minimum fraction of the spikes of a template in the clusters
+        :type min_fraction: float
+        :return: template ids
+        :type: np.array(int)
+        """
+        templates, inv = np.unique(self.templates, return_inverse=True)
+        n_total = np.bincount(inv, weights=self.n_spikes)
+        in_clusters = np.isin(self.clusters, clusters)
+        n_in = np.bincount(inv[in_clusters], weights=self.n_spikes[in_clusters],
+                           minlength=templates.size)
+        return templates[(n_in > 0) & (n_in >= min_fraction * n_total)]
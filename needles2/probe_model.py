@@ -2,7 +2,8 @@ import numpy as np
 from brainbox.numerical import ismember
 from oneibl.one import ONE
 from ibllib.pipes import histology
-from ibllib.atlas import AllenAtlas, atlas
+from ibllib.atlas import atlas
+from atlas_provider import get_atlas
 from ibllib.ephys.neuropixel import TIP_SIZE_UM, SITES_COORDINATES
 from ibllib.pipes.ephys_alignment import EphysAlignment
 import time
@@ -23,7 +24,7 @@ class ProbeModel:
     def __init__(self, one=None, ba=None, lazy=False):
 
         self.one = one or ONE()
-        self.ba = ba or AllenAtlas(25)
+        self.ba = ba or get_atlas(25)
         self.traj = {'Planned': {},
                      'Micro-manipulator': {},
                      'Histology track': {},
@@ -8,6 +8,7 @@ import pyqtgraph as pg
 import matplotlib
 
 from ibllib.atlas import AllenAtlas, regions
+from atlas_provider import get_atlas
 import qt
 
 from PyQt5 import Qt
@@ -40,7 +41,7 @@ class MainWindow(QtWidgets.QMainWindow):
         super(MainWindow, self).__init__()
         uic.loadUi(Path(__file__).parent.joinpath('mainUI.ui'), self)
 
-        self.atlas = AllenAtlas(25)
+        self.atlas = get_atlas(25)
 
         # Configure the Menu bar
         menu_bar = QtWidgets.QMenuBar(self)
@@ -0,0 +1,109 @@
+import unittest
+import tempfile
+import copy
+from pathlib import Path
+
+from atlaselectrophysiology.alyx_snapshot import AlyxSnapshot
+
+
+class FakeAlyx:
+    """
+    Minimal in memory alyx server implementing the rest calls used by LoadData
+    """
+    def __init__(self, records):
+        self.records = records
+        self.online = True
+        self.n_calls = 0
+
+    def rest(self, url, action, id=None, data=None, **kwargs):
+        if not self.online:
+            raise ConnectionError('alyx is not reachable')
+        self.n_calls += 1
+        if action == 'list':
+            return [copy.deepcopy(rec) for rec in self.records[url]
+                    if all(rec.get(key) == val for key, val in kwargs.items())]
+        rec = next(rec for rec in self.records[url] if rec['id'] == id)
+        if action == 'partial_update':
+            rec.update(data)
+        return copy.deepcopy(rec)
+
+
+class TestAlyxSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_file = Path(self.tmp_dir.name).joinpath('snapshot.sqlite')
+        trajectories = [{'id': f'traj{i}', 'provenance': 'Histology track', 'x': float(i),
+                         'probe_insertion': f'probe{i}', 'json': None} for i in range(5)]
+        trajectories.append({'id': 'align0', 'provenance': 'Ephys aligned histology track',
+                             'probe_insertion': 'probe0', 'json': {'2020-01-01_user': [1, 2]}})
+        insertions = [{'id': f'probe{i}', 'json': {'xyz_picks': [[i, i, i]]}} for i in range(5)]
+        self.alyx = FakeAlyx({'trajectories': trajectories, 'insertions': insertions})
+        self.snapshot = AlyxSnapshot(self.db_file, self.alyx, refresh='always')
+
+    def tearDown(self):
+        self.snapshot.close()
+        self.tmp_dir.cleanup()
+
+    def test_offline(self):
+        hist = self.snapshot.rest('trajectories', 'list', provenance='Histology track')
+        ins = self.snapshot.rest('insertions', 'read', id='probe3')
+        self.assertEqual(len(hist), 5)
+
+        # Queries are answered from the snapshot when alyx can not be reached
+        self.alyx.online = False
+        self.assertEqual(self.snapshot.rest('trajectories', 'list',
+                                            provenance='Histology track'), hist)
+        self.assertEqual(self.snapshot.rest('insertions', 'read', id='probe3'), ins)
+        # Queries never made before are not available
+        with self.assertRaises(ConnectionError):
+            self.snapshot.rest('insertions', 'read', id='probe4')
+
+        # A snapshot without alyx connection, e.g in offline processing rooms
+        self.snapshot.close()
+        self.snapshot = AlyxSnapshot(self.db_file, None)
+        self.assertEqual(self.snapshot.rest('trajectories', 'list',
+                                            provenance='Histology track'), hist)
+
+    def test_background(self):
+        self.snapshot.rest('trajectories', 'list', provenance='Histology track')
+        self.snapshot.close()
+        self.snapshot = AlyxSnapshot(self.db_file, self.alyx, refresh='background')
+        self.alyx.online = False
+        # Answered from the snapshot, the refresh fails in the background
+        hist = self.snapshot.rest('trajectories', 'list', provenance='Histology track')
+        self.assertEqual(len(hist), 5)
+
+    def test_incremental_sync(self):
+        self.snapshot.rest('trajectories', 'list', provenance='Histology track')
+        self.snapshot.rest('insertions', 'read', id='probe1')
+        self.assertEqual(self.snapshot.sync(), 0)
+
+        self.alyx.records['trajectories'][2]['x'] = 10.
+        self.alyx.records['trajectories'].append({'id': 'traj5', 'x': 5.,
+                                                  'provenance': 'Histology track'})
+        # Only the changed and new trajectories are written
+        self.assertEqual(self.snapshot.sync(), 2)
+        self.alyx.online = False
+        hist = self.snapshot.rest('trajectories', 'list', provenance='Histology track')
+        self.assertEqual(len(hist), 6)
+        self.assertEqual(hist[2]['x'], 10.)
+
+    def test_write(self):
+        traj = self.snapshot.rest('trajectories', 'list', probe_insertion='probe0',
+                                  provenance='Ephys aligned histology track')
+        alignments = dict(traj[0]['json'], **{'2020-02-02_user': [3, 4]})
+        self.snapshot.rest('trajectories', 'partial_update', id=traj[0]['id'],
+                           data={'json': alignments})
+        self.assertEqual(self.alyx.records['trajectories'][-1]['json'], alignments)
+
+        # Writes are mirrored in the snapshot
+        self.alyx.online = False
+        traj = self.snapshot.rest('trajectories', 'list', probe_insertion='probe0',
+                                  provenance='Ephys aligned histology track')
+        self.assertEqual(traj[0]['json'], alignments)
+        with self.assertRaises(ConnectionError):
+            self.snapshot.rest('trajectories', 'partial_update', id='align0', data={})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import sys
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+# The phy scripts import each other by module name
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'launch_phy'))
+from batch_metrics import SortedSpikes, batch_unit_metrics, gen_unit_metrics  # noqa: E402
+from defined_metrics import cum_drift, isi_viol, fp_est, pres_ratio  # noqa: E402
+
+
+class TestBatchMetrics(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        n_spikes = 30000
+        times = np.sort(rng.uniform(0, 600, n_spikes))
+        # unit 2 has no spikes, unit 5 is only active in the first minute
+        clusters = rng.choice([0, 1, 3, 4, 5], n_spikes, p=[.4, .3, .2, .09, .01])
+        clusters[(clusters == 5) & (times > 60)] = 4
+        # unit 6 has all its spikes at time 0, so no presence ratio bins
+        self.spks = {'times': np.r_[times, 0, 0, 0],
+                     'clusters': np.r_[clusters, 6, 6, 6],
+                     'amps': rng.uniform(50e-6, 300e-6, n_spikes + 3),
+                     'depths': rng.uniform(0, 3840, n_spikes + 3),
+                     'samples': rng.integers(0, 18000000, n_spikes + 3)}
+
+    def test_unit_metrics(self):
+        metrics = batch_unit_metrics(SortedSpikes(self.spks))
+        for unit in [0, 1, 3, 4, 5]:
+            idx = self.spks['clusters'] == unit
+            ts = self.spks['times'][idx]
+            amps = self.spks['amps'][idx]
+            np.testing.assert_allclose(metrics['cum_amp_drift'][unit], cum_drift(amps))
+            np.testing.assert_allclose(metrics['cum_depth_drift'][unit],
+                                       cum_drift(self.spks['depths'][idx]))
+            np.testing.assert_allclose(metrics['cv_amp'][unit], np.std(amps) / np.mean(amps))
+            np.testing.assert_allclose(metrics['frac_isi_viol'][unit], isi_viol(ts)[0])
+            np.testing.assert_allclose(metrics['fp_est'][unit], fp_est(ts))
+            pr, spks_bins = pres_ratio(ts)
+            np.testing.assert_allclose(metrics['pres_ratio'][unit], pr)
+            np.testing.assert_allclose(metrics['pres_ratio_std'][unit], pr / np.std(spks_bins))
+        for unit in [2, 6]:
+            self.assertTrue(np.isnan(metrics['pres_ratio'][unit]))
+
+    def test_units_missing_metrics(self):
+        metrics = gen_unit_metrics(self.spks)
+        self.assertIn(6, metrics['units_missing_metrics'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import unittest
+import copy
+from datetime import datetime
+
+import pandas as pd
+
+from launch_phy.cluster_sync import sync_cluster_labels
+
+
+class FakeTransaction:
+    def __init__(self, tables):
+        self.tables = tables
+
+    def __enter__(self):
+        self.saved = [copy.deepcopy(table.rows) for table in self.tables]
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            for table, rows in zip(self.tables, self.saved):
+                table.rows = rows
+
+
+class FakeConnection:
+    def __init__(self):
+        self.tables = []
+
+    @property
+    def transaction(self):
+        return FakeTransaction(self.tables)
+
+
+class FakeTable:
+    """
+    In memory stand-in of a datajoint table, implementing the calls used by the sync
+    """
+    def __init__(self, connection, primary_key, rows=None):
+        self.connection = connection
+        connection.tables.append(self)
+        self.primary_key = primary_key
+        self.rows = rows or []
+        self.restrictions = []
+        self.n_inserts = 0
+        self.fail = False
+
+    def __and__(self, restriction):
+        restricted = FakeTable(FakeConnection(), self.primary_key, self.rows)
+        restricted.restrictions = self.restrictions + [restriction]
+        return restricted
+
+    def _match(self, row):
+        for restriction in self.restrictions:
+            restriction = restriction if isinstance(restriction, list) else [restriction]
+            if not any(all(str(row[key]) == str(val) for key, val in res.items())
+                       for res in restriction):
+                return False
+        return True
+
+    def fetch(self, *attrs, as_dict=False):
+        return [{attr: row[attr] for attr in attrs} for row in self.rows if self._match(row)]
+
+    def insert(self, rows, allow_direct_insert=False, replace=False):
+        self.n_inserts += 1
+        for row in rows:
+            if self.fail:
+                raise IOError('connection lost')
+            key = tuple(row[k] for k in self.primary_key)
+            existing = [r for r in self.rows if tuple(r[k] for k in self.primary_key) == key]
+            if existing and not replace:
+                raise ValueError('duplicate entry')
+            self.rows = [r for r in self.rows if r not in existing] + [dict(row)]
+
+
+class TestClusterSync(unittest.TestCase):
+    def setUp(self):
+        connection = FakeConnection()
+        self.cluster = FakeTable(connection, ['cluster_uuid', 'user_name'])
+        self.merge = FakeTable(connection, ['cluster_uuid'])
+        # Labels of another user are not affected
+        self.cluster.rows.append(dict(cluster_uuid='uuid0', user_name='other',
+                                      cluster_label='noise', cluster_note=None,
+                                      label_time=datetime(2020, 1, 1)))
+        self.cluster_info = pd.DataFrame({
+            'cluster_id': [0, 1, 2],
+            'cluster_uuid': ['uuid0', 'uuid1', 'uuid2'],
+            'group': ['good', 'mua', 'noise'],
+            'notes': [None, 'drift', None]})
+
+    def test_sync(self):
+        n_new, n_changed = sync_cluster_labels(self.cluster, self.cluster_info, 'user')
+        self.assertEqual((n_new, n_changed), (3, 0))
+        self.assertEqual(self.cluster.n_inserts, 1)
+        self.assertEqual(len(self.cluster.rows), 4)
+
+        # Nothing is inserted when nothing changed
+        n_new, n_changed = sync_cluster_labels(self.cluster, self.cluster_info, 'user')
+        self.assertEqual((n_new, n_changed), (0, 0))
+        self.assertEqual(self.cluster.n_inserts, 1)
+
+        # Only changed labels and notes are replaced
+        self.cluster_info.loc[0, 'group'] = 'mua'
+        self.cluster_info.loc[2, 'notes'] = 'artefact'
+        n_new, n_changed = sync_cluster_labels(self.cluster, self.cluster_info, 'user')
+        self.assertEqual((n_new, n_changed), (0, 2))
+        rows = {(r['cluster_uuid'], r['user_name']): r for r in self.cluster.rows}
+        self.assertEqual(rows[('uuid0', 'user')]['cluster_label'], 'mua')
+        self.assertEqual(rows[('uuid0', 'other')]['cluster_label'], 'noise')
+        self.assertEqual(rows[('uuid2', 'user')]['cluster_note'], 'artefact')
+
+    def test_transaction(self):
+        merge_rows = [dict(cluster_uuid='uuid3', merged_uuid=('uuid4', 'uuid5'))]
+        self.cluster.fail = True
+        with self.assertRaises(IOError):
+            sync_cluster_labels(self.cluster, self.cluster_info, 'user', merge=self.merge,
+                                merge_rows=merge_rows)
+        # Merges are rolled back with the labels
+        self.assertEqual(len(self.merge.rows), 0)
+        self.assertEqual(len(self.cluster.rows), 1)
+
+        self.cluster.fail = False
+        sync_cluster_labels(self.cluster, self.cluster_info, 'user', merge=self.merge,
+                            merge_rows=merge_rows)
+        self.assertEqual(self.merge.rows, merge_rows)
+
+
+if __name__ == '__main__':
+    unittest.main()
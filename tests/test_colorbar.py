@@ -0,0 +1,28 @@
+import unittest
+
+import numpy as np
+from PyQt5 import QtWidgets
+import pyqtgraph as pg
+
+import atlaselectrophysiology.ColorBar as cb
+
+app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+class TestColorBar(unittest.TestCase):
+    def test_colour_bar(self):
+        fig = pg.PlotItem()
+        color_bar = cb.ColorBar('seismic')
+        cbar = color_bar.makeColourBar(20, 5, fig, min=-1, max=1, label='Scale Factor')
+        self.assertIsInstance(cbar, cb.HorizontalBar)
+        fig.addItem(cbar)
+
+        lut = color_bar.getColourLookup(10)
+        self.assertEqual(lut.shape, (10, 4))
+        brushes = cb.makeBrushes(lut)
+        self.assertEqual(len(brushes), 10)
+        self.assertIsInstance(brushes[np.array([0, 9])][1], pg.QtGui.QBrush)
+
+
+if __name__ == '__main__':
+    unittest.main()
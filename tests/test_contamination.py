@@ -0,0 +1,76 @@
+import unittest
+
+import numpy as np
+import scipy.stats as stats
+
+from launch_phy.contamination import (contamination_test, contamination_tests, rp_violations,
+                                      pair_counts, cross_pair_counts, to_samples, TEST_BINS,
+                                      RP_GRID, ACCEPT_THRESH, THRESH)
+
+
+def autocorrelogram(ts, bin_size=0.25 / 1000, sample_rate=20000, window_size=2):
+    """
+    Autocorrelogram of phylib.stats.correlograms (symmetrize=False), the first bin is zeroed
+    """
+    samples = (np.asarray(ts, dtype=np.float64) * sample_rate).astype(np.int64)
+    bin_samples = int(sample_rate * bin_size)
+    half_bins = int(.5 * window_size / bin_size)
+    acg = np.zeros(half_bins + 1, dtype=np.int64)
+    mask = np.ones(samples.size, dtype=bool)
+    shift = 1
+    while mask[:-shift].any():
+        bins = (samples[shift:] - samples[:-shift]) // bin_samples
+        mask[:-shift][bins > half_bins] = False
+        np.add.at(acg, bins[mask[:-shift]], 1)
+        shift += 1
+    acg[0] = 0
+    return acg
+
+
+def fp_rp(ts):
+    """
+    FP_RP computed from the autocorrelogram, as before the violations were counted directly
+    """
+    rec_duration = ts[-1] - ts[0]
+    acg = autocorrelogram(ts)
+    res = np.cumsum(acg)[TEST_BINS]
+    n_bins_1s = len(acg) // 2
+    fr = np.sum(acg[n_bins_1s:] / len(ts) / 0.25 * 1000) / n_bins_1s
+    m = []
+    for rp in RP_GRID:
+        expected = fr * ACCEPT_THRESH * rp * 2 * fr * rec_duration
+        max_acceptable = stats.poisson.ppf(THRESH, expected)
+        if max_acceptable == 0 and stats.poisson.pmf(0, expected) > 0:
+            max_acceptable = -1
+        m.append(max_acceptable)
+    return int(np.any(np.less_equal(res, m))), res, fr
+
+
+class TestContamination(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        ts = np.sort(rng.uniform(0, 600, 20000))
+        # near duplicate spikes, closer than the first autocorrelogram bin
+        dup = rng.choice(ts.size, 300, replace=False)
+        self.ts = np.sort(np.r_[ts, ts[dup] + rng.uniform(0, 0.2e-3, dup.size)])
+
+    def test_fp_rp(self):
+        res, fr = rp_violations(self.ts)
+        didpass, res_acg, fr_acg = fp_rp(self.ts)
+        np.testing.assert_array_equal(res, res_acg)
+        self.assertAlmostEqual(fr, fr_acg)
+        self.assertEqual(contamination_test(self.ts), didpass)
+
+        trains = [self.ts[:5000], self.ts[::3], np.array([]), self.ts[:1]]
+        np.testing.assert_array_equal(contamination_tests(trains),
+                                      [fp_rp(ts)[0] for ts in trains[:2]] + [0, 0])
+
+    def test_merge(self):
+        samples = to_samples(self.ts)
+        a, b = samples[::2], samples[1::2]
+        np.testing.assert_array_equal(pair_counts(samples),
+                                      pair_counts(a) + pair_counts(b) + cross_pair_counts(a, b))
+
+
+if __name__ == '__main__':
+    unittest.main()
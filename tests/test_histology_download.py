@@ -0,0 +1,111 @@
+import unittest
+import tempfile
+import threading
+import hashlib
+import functools
+import os
+import re
+from pathlib import Path
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+from atlaselectrophysiology.histology_download import list_files, download_files, download_file
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Static file server supporting single byte range requests, as the FlatIron server does
+    """
+    n_bytes_sent = 0
+
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        self.range = None
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        path = self.translate_path(self.path)
+        if match is None or not os.path.isfile(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        start = int(match.group(1))
+        if start >= size:
+            self.send_error(416)
+            return None
+        f = open(path, 'rb')
+        f.seek(start)
+        self.send_response(206)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Range', f'bytes {start}-{size - 1}/{size}')
+        self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+        return f
+
+    def copyfile(self, source, outputfile):
+        data = source.read()
+        RangeRequestHandler.n_bytes_sent += len(data)
+        outputfile.write(data)
+
+
+class TestHistologyDownload(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.server_dir = Path(self.tmp_dir.name).joinpath('server')
+        self.cache_dir = Path(self.tmp_dir.name).joinpath('cache')
+        self.server_dir.mkdir()
+        self.files = ['subject_GR.tif', 'subject_RD.tif', 'subject_BL.tif']
+        for i, file in enumerate(self.files):
+            self.server_dir.joinpath(file).write_bytes(os.urandom(100000 + i))
+        self.server_dir.joinpath('notes.txt').write_text('not a tif')
+
+        handler = functools.partial(RangeRequestHandler, directory=str(self.server_dir))
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/'
+        RangeRequestHandler.n_bytes_sent = 0
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp_dir.cleanup()
+
+    def md5(self, file):
+        return hashlib.md5(Path(file).read_bytes()).hexdigest()
+
+    def test_download(self):
+        files = list_files(self.url, extension='.tif')
+        self.assertEqual(sorted(files), sorted(self.files))
+
+        paths = download_files(self.url, files, self.cache_dir)
+        self.assertEqual([path.name for path in paths], files)
+        for path in paths:
+            self.assertEqual(self.md5(path), self.md5(self.server_dir.joinpath(path.name)))
+        n_bytes = RangeRequestHandler.n_bytes_sent
+
+        # Files already downloaded are not downloaded again
+        download_files(self.url, files, self.cache_dir)
+        self.assertEqual(RangeRequestHandler.n_bytes_sent, n_bytes)
+
+    def test_resume(self):
+        file = self.files[0]
+        content = self.server_dir.joinpath(file).read_bytes()
+        self.cache_dir.mkdir()
+        self.cache_dir.joinpath(file + '.part').write_bytes(content[:40000])
+
+        path = download_file(self.url + file, self.cache_dir.joinpath(file),
+                             checksum=self.md5(self.server_dir.joinpath(file)))
+        self.assertEqual(path.read_bytes(), content)
+        self.assertEqual(RangeRequestHandler.n_bytes_sent, len(content) - 40000)
+        self.assertFalse(self.cache_dir.joinpath(file + '.part').exists())
+
+    def test_corrupted(self):
+        file = self.files[1]
+        with self.assertRaises(IOError):
+            download_file(self.url + file, Path(self.tmp_dir.name).joinpath(file),
+                          checksum='0' * 32)
+        self.assertFalse(Path(self.tmp_dir.name).joinpath(file).exists())
+        self.assertFalse(Path(self.tmp_dir.name).joinpath(file + '.part').exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import unittest
+
+import numpy as np
+
+from merge_provenance import MergeProvenance
+
+
+class TestMergeProvenance(unittest.TestCase):
+    def setUp(self):
+        # Templates 0 and 2 merged into cluster 5, template 3 split into clusters 6 and 7,
+        # template 1 untouched
+        self.templates = np.array([0, 1, 2, 3, 3, 0, 2, 3, 1, 3])
+        self.clusters = np.array([5, 1, 5, 7, 6, 5, 5, 6, 1, 6])
+        self.provenance = MergeProvenance(self.clusters, self.templates)
+
+    def test_table(self):
+        np.testing.assert_array_equal(self.provenance.clusters, [1, 5, 5, 6, 7])
+        np.testing.assert_array_equal(self.provenance.templates, [1, 0, 2, 3, 3])
+        np.testing.assert_array_equal(self.provenance.n_spikes, [2, 2, 2, 3, 1])
+
+    def test_merges(self):
+        # The split template is assigned to the cluster of its first spike
+        self.assertEqual(self.provenance.merges(), {5: [0, 2], 7: [3]})
+
+    def test_templates_of(self):
+        np.testing.assert_array_equal(self.provenance.templates_of([1, 5]), [0, 1, 2])
+        np.testing.assert_array_equal(self.provenance.templates_of([6]), [3])
+        np.testing.assert_array_equal(self.provenance.templates_of([7]), [])
+        np.testing.assert_array_equal(self.provenance.templates_of([7], min_fraction=0), [3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,12 +4,12 @@ import matplotlib.pyplot as plt
 import scipy.signal
 import pyqtgraph as pg
 
-import ibllib.atlas as atlas
+from atlas_provider import get_atlas
 from ibllib.ephys.neuropixel import SITES_COORDINATES
 from ibllib.pipes.ephys_alignment import EphysAlignment
 from ibllib.plots import wiggle, color_cycle
 
-brain_atlas = atlas.AllenAtlas()
+brain_atlas = get_atlas(25)
 # Instantiate brain atlas and one
 
 